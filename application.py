@@ -1,22 +1,42 @@
 import pandas as pd
 import numpy as np
-import hdbscan
 import warnings
-import urllib.parse
 import base64
 import io
-import plotly.graph_objects as go
+import json
+import os
+import sys
+import uuid
 import dash
+import flask
 import dash_table as dt
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 from datetime import datetime
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler, MinMaxScaler, FunctionTransformer, LabelEncoder
-from sklearn.utils.random import sample_without_replacement
-from sklearn.manifold import TSNE
+import batch
+import cache
+import clustering
+import compression
+import coreset
+import embedding
+import export
+import generations
+import governor
+import hdbscan_session
+import jobs
+import metrics
+import models
+import pipeline
+import profiler
+import registry
+import shared_data
+import singleflight
+
+# plotly is only imported when the first plot is built
+go = registry.LazyModule("plotly.graph_objects")
+
 pd.options.mode.chained_assignment = None
 warnings.filterwarnings("ignore")
 
@@ -29,9 +49,18 @@ app.css.config.serve_locally = True
 app.scripts.config.serve_locally = True
 app.config.suppress_callback_exceptions = True
 
+# measure every callback registered below, the totals are served at /metrics
+metrics.instrument(app)
+
 application = app.server
 
-app.layout = html.Div(children=[
+# names of the background jobs, which can be profiled like the callbacks
+JOB_NAMES = ["Clustering", "K-Means sweep", "Cluster size sweep"]
+
+# admin page for profiling the callbacks and the jobs of a session
+profiler.register(application, lambda: list(metrics.METRICS) + JOB_NAMES)
+
+layout = html.Div(children=[
 
     # header
     html.Div(children=[
@@ -67,6 +96,31 @@ app.layout = html.Div(children=[
 
                     ], style={"margin": "0vw 0vw 0vw 1vw"}),
 
+                    # controls used for sampling the file while it is being parsed
+                    html.Div(children=[
+
+                        html.Label("Upload Sampling:", style={"margin": "1vw 0vw 0.5vw 0vw"}),
+                        dcc.RadioItems(id="upload_sampling", value="none", options=[{"label": "None", "value": "none"},
+                        {"label": "Reservoir", "value": "reservoir"}, {"label": "Stratified", "value": "stratified"}],
+                        labelStyle={"font-size": "95%", "display": "inline-block", "margin": "0vw 0.5vw 0vw 0vw"}),
+
+                        html.Label("Sample Rows:", style={"margin": "1vw 0vw 0vw 0vw"}),
+                        html.P("If sampling the upload, enter the number of rows to keep. Only the sample is "
+                        "preprocessed, reduced and clustered.", style={"font-size": "80%", "margin": "0vw 2vw 0vw 0vw",
+                        "text-align": "justify"}),
+                        dcc.Input(id="upload_sample_rows", type="number", min=1, placeholder=10000, debounce=True,
+                        style={"font-size": "95%"}),
+
+                        html.Label("Stratify By:", style={"margin": "1vw 0vw 0.3vw 0vw"}),
+                        dcc.Dropdown(id="upload_strata_column", style={"font-size": "95%", "width": "90%"},
+                        optionHeight=25, multi=False, searchable=True, clearable=True, placeholder="Select Feature"),
+
+                        html.Label("Seed:", style={"margin": "1vw 0vw 0vw 0vw"}),
+                        dcc.Input(id="upload_seed", type="number", value=0, min=0, debounce=True,
+                        style={"font-size": "95%"}),
+
+                    ], style={"margin": "0vw 0vw 0vw 1vw"}),
+
                     # run button used for updating the data after making a selection
                     html.Div(children=[
 
@@ -97,15 +151,25 @@ app.layout = html.Div(children=[
                     dcc.Input(id="cluster_sample_size", type="number", min=1, max=100, placeholder=80,
                     style={"margin-left": "1vw", "font-size": "95%"}),
 
+                    # radio buttons used for choosing how to treat the rows left out of the sample
+                    html.Label("Unsampled Rows:", style={"margin": "1vw 0vw 0vw 1vw"}),
+                    html.P("If using random sampling, choose whether the rows left out of the sample are dropped "
+                    "or projected and assigned to the clusters fitted on the sample.", style={"font-size": "80%",
+                    "margin": "0vw 2vw 0vw 1vw", "text-align": "justify"}),
+                    dcc.RadioItems(id="cluster_out_of_sample", value="drop", options=[{"label": "Drop", "value": "drop"},
+                    {"label": "Project", "value": "project"}], labelStyle={"font-size": "95%", "display": "inline-block",
+                    "margin": "0vw 0.5vw 0vw 0vw"}, style={"margin-left": "1vw"}),
+
                     # radio buttons used for selecting the dimension reduction technique
                     html.Label("Dimension Reduction:", style={"margin": "1vw 0vw 0.5vw 1vw"}),
                     dcc.RadioItems(id="cluster_dimension_reduction", value="pca", options=[{"label": "PCA", "value": "pca"},
-                    {"label": "T-SNE", "value": "tsne"}, {"label": "None", "value": "none"}], style={"margin-left": "1vw"},
+                    {"label": "T-SNE", "value": "tsne"}, {"label": "UMAP", "value": "umap"}, {"label": "None", "value": "none"}],
+                    style={"margin-left": "1vw"},
                     labelStyle={"font-size": "95%", "display": "inline-block", "margin": "0vw 0.5vw 0vw 0vw"}),
 
                     # numeric input used for entering the number of components
                     html.Label("Number of Components:", style={"margin": "1vw 0vw 0vw 1vw"}),
-                    html.P("If using PCA or T-SNE, enter the number of components.", style={"font-size": "80%",
+                    html.P("If using PCA, T-SNE or UMAP, enter the number of components.", style={"font-size": "80%",
                     "margin": "0vw 2vw 0vw 1vw", "text-align": "justify"}),
                     dcc.Input(id="cluster_components", type="number", placeholder=3, value=3, min=1,
                     style={"margin-left": "1vw", "font-size": "95%"}),
@@ -113,13 +177,23 @@ app.layout = html.Div(children=[
                     # radio buttons used for selecting the clustering algorithm
                     html.Label("Clustering Algorithm:", style={"margin": "1vw 0vw 0.5vw 1vw"}),
                     dcc.RadioItems(id="cluster_algorithm", value="kmeans", options=[{"label": "K-Means", "value": "kmeans"},
-                    {"label": "HDBSCAN", "value": "hdbscan"}], labelStyle={"font-size": "95%", "display": "inline-block",
+                    {"label": "Mini-Batch K-Means", "value": "minibatch"}, {"label": "BIRCH", "value": "birch"},
+                    {"label": "Coreset K-Means", "value": "coreset"}, {"label": "HDBSCAN", "value": "hdbscan"}], labelStyle={"font-size": "95%", "display": "inline-block",
+                    "margin": "0vw 0.5vw 0vw 0vw"}, style={"margin-left": "1vw"}),
+
+                    # radio buttons used for choosing whether to collapse the duplicate rows
+                    html.Label("Compress Duplicates:", style={"margin": "1vw 0vw 0vw 1vw"}),
+                    html.P("If using K-Means, choose whether identical rows are clustered once, weighted by their "
+                    "number of occurrences.", style={"font-size": "80%", "margin": "0vw 2vw 0vw 1vw",
+                    "text-align": "justify"}),
+                    dcc.RadioItems(id="cluster_compress", value="True", options=[{"label": "True", "value": "True"},
+                    {"label": "False", "value": "False"}], labelStyle={"font-size": "95%", "display": "inline-block",
                     "margin": "0vw 0.5vw 0vw 0vw"}, style={"margin-left": "1vw"}),
 
                     # numeric input used for entering the number of clusters
                     html.Label("Number of Clusters:", style={"margin": "1vw 0vw 0vw 1vw"}),
-                    html.P("If using K-Means, enter the number of clusters.", style={"font-size": "80%",
-                    "margin": "0vw 2vw 0vw 1vw", "text-align": "justify"}),
+                    html.P("If using K-Means, Mini-Batch K-Means, BIRCH or Coreset K-Means, enter the number of clusters.",
+                    style={"font-size": "80%", "margin": "0vw 2vw 0vw 1vw", "text-align": "justify"}),
                     dcc.Input(id="cluster_number", type="number", placeholder=3, value=3, min=1,
                     style={"margin-left": "1vw", "font-size": "95%"}),
 
@@ -130,12 +204,64 @@ app.layout = html.Div(children=[
                     dcc.Input(id="cluster_size", type="number", placeholder=2, min=2, value=2,
                     style={"margin-left": "1vw", "font-size": "95%"}),
 
+                    # numeric input used for entering the HDBSCAN min_samples
+                    html.Label("Minimum Samples:", style={"margin": "1vw 0vw 0vw 1vw"}),
+                    html.P("If using HDBSCAN, optionally enter the number of samples defining a core point. When set, "
+                    "changing the minimum cluster size reuses the cached cluster tree.", style={"font-size": "80%",
+                    "margin": "0vw 2vw 0vw 1vw", "text-align": "justify"}),
+                    dcc.Input(id="cluster_min_samples", type="number", min=1,
+                    style={"margin-left": "1vw", "font-size": "95%"}),
+
+                    # numeric input used for entering the batch size of the streaming engines
+                    html.Label("Batch Size:", style={"margin": "1vw 0vw 0vw 1vw"}),
+                    html.P("If using Mini-Batch K-Means, BIRCH or Coreset K-Means, enter the number of rows processed at once. "
+                    "Smaller batches use less memory.", style={"font-size": "80%", "margin": "0vw 2vw 0vw 1vw",
+                    "text-align": "justify"}),
+                    dcc.Input(id="cluster_batch_size", type="number", placeholder=clustering.BATCH_SIZE,
+                    value=clustering.BATCH_SIZE, min=1, style={"margin-left": "1vw", "font-size": "95%"}),
+
+                    # numeric input used for entering the BIRCH threshold
+                    html.Label("BIRCH Threshold:", style={"margin": "1vw 0vw 0vw 1vw"}),
+                    html.P("If using BIRCH, enter the subcluster radius threshold. Larger thresholds build a smaller "
+                    "CF-tree and use less memory.", style={"font-size": "80%", "margin": "0vw 2vw 0vw 1vw",
+                    "text-align": "justify"}),
+                    dcc.Input(id="cluster_threshold", type="number", placeholder=clustering.THRESHOLD,
+                    value=clustering.THRESHOLD, min=0, step=0.1, style={"margin-left": "1vw", "font-size": "95%"}),
+
+                    # numeric input used for entering the coreset size
+                    html.Label("Coreset Size:", style={"margin": "1vw 0vw 0vw 1vw"}),
+                    html.P("If using Coreset K-Means, enter the number of weighted points summarizing the data. "
+                    "Smaller coresets answer faster.", style={"font-size": "80%", "margin": "0vw 2vw 0vw 1vw",
+                    "text-align": "justify"}),
+                    dcc.Input(id="cluster_coreset_size", type="number", placeholder=coreset.CORESET_SIZE,
+                    value=coreset.CORESET_SIZE, min=1, style={"margin-left": "1vw", "font-size": "95%"}),
+
+                    # radio buttons used for choosing whether to save the fitted pipeline
+                    html.Label("Save Model:", style={"margin": "1vw 0vw 0vw 1vw"}),
+                    html.P("Choose whether the fitted preprocessing, dimension reduction and clusters are saved, so "
+                    "that new rows can be labeled without clustering again. Not available with T-SNE.",
+                    style={"font-size": "80%", "margin": "0vw 2vw 0vw 1vw", "text-align": "justify"}),
+                    dcc.RadioItems(id="cluster_save_model", value="False", options=[{"label": "True", "value": "True"},
+                    {"label": "False", "value": "False"}], labelStyle={"font-size": "95%", "display": "inline-block",
+                    "margin": "0vw 0.5vw 0vw 0vw"}, style={"margin-left": "1vw"}),
+
                     # run button used for updating the results
                     html.Label("Update Results:", style={"margin": "1vw 0vw 0.3vw 1vw"}),
                     html.Button(id="cluster_button", n_clicks=0, children=["update"], style={"background-color": "#3288BD",
                     "font-size": "80%", "margin-left": "1vw", "font-weight": "500", "text-align": "center", "width": "60%",
                     "color": "white"}),
 
+                    # cancel button, progress and results of the background clustering job
+                    html.Button(id="cluster_cancel", n_clicks=0, children=["cancel"], style={"background-color": "#D53E4F",
+                    "font-size": "80%", "margin": "0.5vw 0vw 0vw 1vw", "font-weight": "500", "text-align": "center",
+                    "width": "60%", "color": "white"}),
+
+                    html.P(id="cluster_job_status", style={"font-size": "80%", "margin": "0.5vw 2vw 0vw 1vw",
+                    "text-align": "justify"}),
+
+                    html.A(id="cluster_job_link", children=["Download Results"], target="_blank",
+                    style={"display": "none"}),
+
                 ]),
 
             ]),
@@ -284,12 +410,12 @@ app.layout = html.Div(children=[
                         html.Label("Dimension Reduction:", style={"margin": "1vw 0vw 0.5vw 1vw"}),
                         dcc.RadioItems(id="plot_dimension_reduction", value="pca",
                         options=[{"label": "PCA", "value": "pca"}, {"label": "T-SNE", "value": "tsne"},
-                        {"label": "None", "value": "none"}], style={"margin-left": "1vw"},
+                        {"label": "UMAP", "value": "umap"}, {"label": "None", "value": "none"}], style={"margin-left": "1vw"},
                         labelStyle={"font-size": "95%", "display": "inline-block", "margin": "0vw 0.5vw 0vw 0vw"}),
 
                         # numeric input used for entering the number of components
                         html.Label("Number of Components:", style={"margin": "1vw 0vw 0vw 1vw"}),
-                        html.P("If using PCA or T-SNE, enter the number of components.",
+                        html.P("If using PCA, T-SNE or UMAP, enter the number of components.",
                         style={"font-size": "80%", "margin": "0vw 2vw 0vw 1vw", "text-align": "justify"}),
                         dcc.Input(id="plot_components", type="number", placeholder=3, value=3, min=1,
                         style={"margin-left": "1vw", "font-size": "95%"}),
@@ -308,6 +434,10 @@ app.layout = html.Div(children=[
                             style={"background-color": "#3288BD", "font-size": "80%", "font-weight": "500",
                             "text-align": "center", "width": "60%", "color": "white"}),
 
+                            # message displayed when the plot exceeds the resources of the session
+                            html.P(id="plot_status", style={"font-size": "80%", "margin": "0.5vw 2vw 0vw 0vw",
+                            "text-align": "justify"}),
+
                         ], style={"margin": "0vw 0vw 0vw 1vw"}),
 
                     ], style={"display": "inline-block", "vertical-align": "top", "width": "17.5vw"}),
@@ -358,7 +488,13 @@ app.layout = html.Div(children=[
 
                     html.Div(children=[
 
-                        html.Label(children=["Download CSV"], style={"margin": "1vw 0vw 0vw 50vw",
+                        # radio buttons used for selecting the format of the download
+                        dcc.RadioItems(id="download_format", value="csv", options=[{"label": "CSV", "value": "csv"},
+                        {"label": "CSV (gzip)", "value": "csv.gz"}, {"label": "Parquet", "value": "parquet"}],
+                        style={"margin": "1vw 0vw 0vw 30vw", "display": "inline-block", "vertical-align": "middle"},
+                        labelStyle={"font-size": "80%", "display": "inline-block", "margin": "0vw 0.5vw 0vw 0vw"}),
+
+                        html.Label(children=["Download"], style={"margin": "1vw 0vw 0vw 1vw",
                            "display": "inline-block", "vertical-align": "middle"}),
 
                             html.A(id="cluster_data_link", target="_blank", children=[
@@ -388,6 +524,53 @@ app.layout = html.Div(children=[
 
                         html.Div(id="scree_plot", style={"margin": "1vw 1vw 1vw 1vw"}),
 
+                        # numeric inputs and run button used for sweeping the number of K-Means clusters
+                        html.Div(children=[
+
+                            html.Label("Sweep K from:", style={"margin": "1vw 0.5vw 0vw 0vw", "display": "inline-block"}),
+                            dcc.Input(id="sweep_min", type="number", placeholder=2, value=2, min=1,
+                            style={"font-size": "95%", "width": "6vw"}),
+
+                            html.Label("to:", style={"margin": "1vw 0.5vw 0vw 1vw", "display": "inline-block"}),
+                            dcc.Input(id="sweep_max", type="number", placeholder=10, value=10, min=1,
+                            style={"font-size": "95%", "width": "6vw"}),
+
+                            html.Button(id="sweep_button", n_clicks=0, children=["sweep"],
+                            style={"background-color": "#3288BD", "font-size": "80%", "font-weight": "500",
+                            "text-align": "center", "margin-left": "1vw", "color": "white"}),
+
+                            html.Button(id="sweep_cancel", n_clicks=0, children=["cancel"],
+                            style={"background-color": "#D53E4F", "font-size": "80%", "font-weight": "500",
+                            "text-align": "center", "margin-left": "0.5vw", "color": "white"}),
+
+                        ], style={"margin": "0vw 1vw 0vw 1vw"}),
+
+                        html.Div(id="sweep_plot", style={"margin": "1vw 1vw 1vw 1vw"}),
+
+                        # numeric inputs and run button used for sweeping the HDBSCAN minimum cluster size
+                        html.Div(children=[
+
+                            html.Label("Sweep Minimum Cluster Size from:", style={"margin": "1vw 0.5vw 0vw 0vw",
+                            "display": "inline-block"}),
+                            dcc.Input(id="size_sweep_min", type="number", placeholder=2, value=2, min=2,
+                            style={"font-size": "95%", "width": "6vw"}),
+
+                            html.Label("to:", style={"margin": "1vw 0.5vw 0vw 1vw", "display": "inline-block"}),
+                            dcc.Input(id="size_sweep_max", type="number", placeholder=20, value=20, min=2,
+                            style={"font-size": "95%", "width": "6vw"}),
+
+                            html.Button(id="size_sweep_button", n_clicks=0, children=["sweep"],
+                            style={"background-color": "#3288BD", "font-size": "80%", "font-weight": "500",
+                            "text-align": "center", "margin-left": "1vw", "color": "white"}),
+
+                            html.Button(id="size_sweep_cancel", n_clicks=0, children=["cancel"],
+                            style={"background-color": "#D53E4F", "font-size": "80%", "font-weight": "500",
+                            "text-align": "center", "margin-left": "0.5vw", "color": "white"}),
+
+                        ], style={"margin": "0vw 1vw 0vw 1vw"}),
+
+                        html.Div(id="size_sweep_plot", style={"margin": "1vw 1vw 1vw 1vw"}),
+
                 ]),
 
             ]),
@@ -399,68 +582,99 @@ app.layout = html.Div(children=[
 
     # hidden divs used for storing the data shared across callbacks
     html.Div(id="uploaded_data", style={"display": "none"}),
+    dcc.Store(id="dataset_present", data=False),
     html.Div(id="raw_data", style={"display": "none"}),
     html.Div(id="processed_data", style={"display": "none"}),
+    html.Div(id="processed_selection", style={"display": "none"}),
     html.Div(id="clustered_data", style={"display": "none"}),
     html.Div(id="plot_data", style={"display": "none"}),
 
+    # stores used for keeping the ids of the background jobs, also after the browser reconnects
+    dcc.Store(id="cluster_job", storage_type="local"),
+    dcc.Store(id="sweep_job", storage_type="local"),
+    dcc.Store(id="size_sweep_job", storage_type="local"),
+
+    # intervals used for polling the progress of the background jobs
+    dcc.Interval(id="cluster_job_interval", interval=1000, disabled=True),
+    dcc.Interval(id="sweep_job_interval", interval=1000, disabled=True),
+    dcc.Interval(id="size_sweep_job_interval", interval=1000, disabled=True),
+
 ])
 
+def serve_layout():
+
+    # assign a new id to every page load, used for keeping the state of the session on the server
+    return html.Div(children=[layout, html.Div(id="session_id", children=str(uuid.uuid4()), style={"display": "none"})])
+
+app.layout = serve_layout
+
 ####################################################
 # maximum number of features to be processed;
 # it can be changed if required
 N = 20
 ####################################################
 
-@app.callback([Output("alert_output", "style"), Output("data_output", "style"), Output("cluster_output", "style")],
-              [Input("uploaded_data", "children"), Input("control_tab", "value")])
-def render_switch(uploaded_data, tab):
+# the panels are toggled in the browser (assets/clientside.js), from a flag rather than from the uploaded data
+for output, function_name in [("alert_output", "alert_display"), ("data_output", "data_display"),
+                              ("cluster_output", "cluster_display")]:
 
-    if uploaded_data is None:
+    app.clientside_callback(ClientsideFunction(namespace="clientside", function_name=function_name),
+                            Output(output, "style"), [Input("dataset_present", "data"), Input("control_tab", "value")])
 
-        return [{"display": "block"}, {"display": "none"}, {"display": "none"}]
+def parse_contents(contents, filename, sampling_mode="none", sample_rows=None, strata_column=None, seed=0):
 
-    elif tab == "tab1":
+    content_type, content_string = contents.split(",")
+    decoded = base64.b64decode(content_string)
 
-        return [{"display": "none"}, {"display": "block"}, {"display": "none"}]
+    # parse the file in chunks, so that the sampler only ever holds the sample and one chunk
+    load = pipeline.LoadStage(sampling_mode, sample_rows, strata_column, seed)
 
-    elif tab == "tab2":
+    try:
 
-        return [{"display": "none"}, {"display": "none"}, {"display": "block"}]
+        df = load(decoded, filename)
 
-def parse_contents(contents, filename):
+    except Exception as e:
+        print(e)
+
+    return df.to_json()
+
+def parse_columns(contents, filename):
 
     content_type, content_string = contents.split(",")
-    decoded = base64.b64decode(content_string)
 
-    try:
+    # only decode the beginning of delimited files, which contains the header
+    if "csv" in filename or "txt" in filename or "tsv" in filename:
 
-        if "csv" in filename:
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
+        decoded = base64.b64decode(content_string[:87380])
+        delimiter = "," if "csv" in filename else r"\s+"
 
-        elif "xls" in filename:
-            df = pd.read_excel(io.BytesIO(decoded))
+        return list(pd.read_csv(io.BytesIO(decoded), delimiter=delimiter, nrows=1).columns)
 
-        elif "json" in filename:
-            df = pd.read_json(contents)
+    return list(metrics.read_json(parse_contents(contents, filename)).columns)
 
-        elif "txt" or "tsv" in filename:
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), delimiter=r"\s+")
+@app.callback(Output("upload_strata_column", "options"), [Input("uploaded_file", "contents")],
+              [State("uploaded_file", "filename")])
+def update_strata_options(contents, file_name):
 
-    except Exception as e:
-        print(e)
+    if contents is not None:
 
-    return df.to_json()
+        return [{"value": x, "label": x} for x in parse_columns(contents, file_name)]
 
-@app.callback(Output("uploaded_data", "children"), [Input("uploaded_file", "contents")],
+    return []
+
+@app.callback([Output("uploaded_data", "children"), Output("dataset_present", "data")],
+              [Input("uploaded_file", "contents"), Input("upload_sampling", "value"),
+              Input("upload_sample_rows", "value"), Input("upload_strata_column", "value"), Input("upload_seed", "value")],
               [State("uploaded_file", "filename")])
-def load_file(contents, file_name):
+def load_file(contents, sampling_mode, sample_rows, strata_column, seed, file_name):
 
     if contents is not None:
 
-        df_json = parse_contents(contents, file_name)
+        df_json = parse_contents(contents, file_name, sampling_mode, sample_rows, strata_column, seed)
+
+        return [df_json, True]
 
-        return df_json
+    return [None, False]
 
 @app.callback([Output("data_controls", "children"), Output("data_controls", "style"),
                Output("raw_data_table", "data"), Output("raw_data_table", "columns"),
@@ -470,24 +684,8 @@ def load_data(data):
 
     if data is not None:
 
-        # load the data
-        df = pd.read_json(data)
-
-        # process the missing values
-        df[df == "-"] = np.nan
-        df[df == "?"] = np.nan
-        df[df == "."] = np.nan
-        df[df == " "] = np.nan
-
-        # drop the missing values
-        df.dropna(inplace=True)
-        df.reset_index(drop=True, inplace=True)
-
-        # include the indices in the first columns
-        df.rename(columns={"Unnamed: 0": "index"}, inplace=True)
-
-        # make sure that the indices are treated as integers
-        df["index"] = df["index"].astype(int)
+        # load the data, process the missing values and identify the rows by their indices
+        df = pipeline.CleanStage()(metrics.read_json(data))
 
         # display the data in the table
         data_rows = df.to_dict(orient="records")
@@ -500,11 +698,7 @@ def load_data(data):
         "max-width": str(1 + len(df.columns) * 15) +"vw"}
 
         # define the initial data types, weights and transformations
-        selection = pd.DataFrame({"feature": df.columns, "type": df.dtypes, "weight": np.ones(df.shape[1]),
-        "transformation": ["none"] * df.shape[1]})
-        selection["type"][(selection["type"] == "object") | (selection["type"] == "category")] = "categorical"
-        selection["type"][-(selection["type"] == "categorical")] = "numerical"
-        selection.reset_index(drop=True, inplace=True)
+        selection = pipeline.default_selection(df)
 
         # display the data types, weights and transformations in the dropdown menus
         dropdowns = []
@@ -596,7 +790,7 @@ for j in range(1, N):
             Input("selections_" + str(j-1), "children")])
     def update_selection(dtype, weight, transformation, selection, k=j):
 
-        selection = pd.read_json(selection)
+        selection = metrics.read_json(selection)
 
         selection["type"][k] = dtype
         selection["weight"][k] = weight
@@ -606,7 +800,8 @@ for j in range(1, N):
 
 @app.callback([Output("processed_data", "children"), Output("preprocessed_data_table", "data"),
                Output("preprocessed_data_table", "columns"), Output("correlation_features", "options"),
-               Output("histogram_features", "options")], [Input("data_button", "n_clicks"),
+               Output("histogram_features", "options"), Output("processed_selection", "children")],
+              [Input("data_button", "n_clicks"),
                Input("raw_data", "children")], [State("selections_" + str(0), "children"),
                State("selections_" + str(N-1), "children")])
 def process_data(n_clicks, data, initial_selection, final_selection):
@@ -614,147 +809,118 @@ def process_data(n_clicks, data, initial_selection, final_selection):
     if data is not None:
 
         # load the raw data from the hidden div
-        df = pd.read_json(data)
+        df = metrics.read_json(data)
 
         # load the user's selection from the hidden div
         if final_selection is None:
 
-            selection = pd.read_json(initial_selection)
+            selection = metrics.read_json(initial_selection)
 
         else:
 
-            selection = pd.read_json(final_selection)
-
-        # discard the features with zero weight and / or "none" data type
-        selection = selection[(selection["weight"] != 0) & (selection["type"] != "none")]
-        df = df[list(selection["feature"])]
-
-        # discard the index
-        selection = selection[selection["feature"] != "index"]
-        features = list(selection["feature"])
-
-        # normalize the weights
-        selection["weight"] = selection["weight"] / selection["weight"].sum()
-
-        # process the data
-        for feature in features:
-
-            x = df[[feature,]]
-
-            dtype = selection["type"][selection["feature"] == feature].values[0]
-            weight = selection["weight"][selection["feature"] == feature].values[0]
-            transformation = selection["transformation"][selection["feature"] == feature].values[0]
-
-            if (x.dtypes == "object")[0] and dtype == "numerical": # from categorical to numerical
-
-                x = LabelEncoder().fit_transform(x)
-
-                x = weight * x
-
-                x = x.reshape(-1,1)
-
-                if transformation == "log":
-
-                    x = FunctionTransformer(np.log1p, validate=True).fit_transform(x)
+            selection = metrics.read_json(final_selection)
 
-                elif transformation == "z-score":
+        # encode, weight and transform the selected features
+        df = pipeline.PreprocessStage(selection)(df)
 
-                    x = StandardScaler().fit_transform(x)
-
-                elif transformation == "minmax":
-
-                    x = MinMaxScaler().fit_transform(x)
-
-                df[feature] = x
-
-            elif (x.dtypes != "object")[0] and dtype == "categorical": # from numerical to categorical
-
-                x = pd.get_dummies(pd.cut(x[feature], 3, labels=[feature + "_cat1", feature + "_cat2", feature + "_cat3"]))
-
-                x = weight * x
+        # round all values to 2 digits
+        processed_data = df.astype(float).round(2)
 
-                if transformation == "log":
+        # display the data in the table
+        processed_data_rows = processed_data.to_dict(orient="records")
+        processed_data_columns = [{"id": x, "name": x} for x in list(processed_data.columns)]
 
-                    x = pd.DataFrame(FunctionTransformer(np.log1p, validate=True).fit_transform(x), index=x.index, columns=x.columns)
+        # create the lists of features to be shown in the dropdown menus
+        new_features = list(df.columns)
+        new_features.remove("index")
 
-                elif transformation == "z-score":
+        new_features_list = [{"value": new_features[0], "label": new_features[0]}]
 
-                    x = pd.DataFrame(StandardScaler().fit_transform(x), index=x.index, columns=x.columns)
+        if len(new_features) > 1:
+            for j in range(1, len(new_features)):
+                new_features_list.append({"value": new_features[j], "label": new_features[j]})
 
-                elif transformation == "minmax":
+        correlation_features = new_features_list
+        histogram_features = new_features_list
 
-                    x = pd.DataFrame(MinMaxScaler().fit_transform(x), index=x.index, columns=x.columns)
+        # save the data in the hidden div
+        processed_data = df.to_json()
 
-                df.drop(feature, axis=1, inplace=True)
+        # keep the selection the data was processed with, for refitting the saved pipelines
+        return [processed_data, processed_data_rows, processed_data_columns, correlation_features, histogram_features,
+                selection.to_json()]
 
-                df = df.join(x)
+def publish_data(data, key):
 
-            elif (x.dtypes != "object")[0] and dtype == "numerical": # from numerical to numerical
+    descriptor = shared_data.lookup(key)
 
-                x = weight * x.values
+    if descriptor is None:
+        descriptor = shared_data.publish(metrics.read_json(data), key)
 
-                x = x.reshape(-1, 1)
+    return descriptor
 
-                if transformation == "log":
+def read_data(data):
 
-                    x = FunctionTransformer(np.log1p, validate=True).fit_transform(x)
+    key = cache.digest(data)
 
-                elif transformation == "z-score":
+    # the data is parsed and published once, then the callbacks and the other server workers all
+    # map the same shared copy instead of parsing their own
+    for attempt in range(3):
 
-                    x = StandardScaler().fit_transform(x)
+        descriptor = singleflight.call("read_json", key, None, publish_data, data, key)
 
-                elif transformation == "minmax":
+        if descriptor is None:
+            break
 
-                    x = MinMaxScaler().fit_transform(x)
+        try:
 
-                df[feature] = x
+            return shared_data.attach_frame(descriptor)
 
-            elif (x.dtypes == "object")[0] and dtype == "categorical": # from categorical to categorical
+        except FileNotFoundError:
 
-                x = pd.get_dummies(x)
+            # the matrix was removed by the cleanup of another process after the lookup, publish it again
+            continue
 
-                x = weight * x
+    return metrics.read_json(data)
 
-                if transformation == "log":
+def share_data(data):
 
-                    x = pd.DataFrame(FunctionTransformer(np.log1p, validate=True).fit_transform(x), index=x.index, columns=x.columns)
+    # the jobs receive the descriptor of the published data instead of the data itself; it is pinned
+    # until the job attaches it, so that the cleanup keeps it while the job waits in the queue
+    key = cache.digest(data)
 
-                elif transformation == "z-score":
+    for attempt in range(3):
 
-                    x = pd.DataFrame(StandardScaler().fit_transform(x), index=x.index, columns=x.columns)
+        descriptor = singleflight.call("read_json", key, None, publish_data, data, key)
 
-                elif transformation == "minmax":
+        if descriptor is None:
+            break
 
-                    x = pd.DataFrame(MinMaxScaler().fit_transform(x), index=x.index, columns=x.columns)
+        descriptor = shared_data.pin(descriptor)
 
-                df.drop(feature, axis=1, inplace=True)
+        if descriptor is not None:
+            return descriptor
 
-                df = df.join(x)
+    # the data which cannot be shared as a matrix is passed as it is
+    return data
 
-        # round all values to 2 digits
-        processed_data = df.astype(float).round(2)
+def share_text(text):
 
-        # display the data in the table
-        processed_data_rows = processed_data.to_dict(orient="records")
-        processed_data_columns = [{"id": x, "name": x} for x in list(processed_data.columns)]
+    descriptor = shared_data.pin(shared_data.publish_text(text, cache.digest(text)))
 
-        # create the lists of features to be shown in the dropdown menus
-        new_features = list(df.columns)
-        new_features.remove("index")
+    return text if descriptor is None else descriptor
 
-        new_features_list = [{"value": new_features[0], "label": new_features[0]}]
+def attach_source(source):
 
-        if len(new_features) > 1:
-            for j in range(1, len(new_features)):
-                new_features_list.append({"value": new_features[j], "label": new_features[j]})
+    # in the jobs: the data shared by the server, or the data itself, and the key identifying it
+    if isinstance(source, dict):
+        return shared_data.attach_frame(source), source["key"]
 
-        correlation_features = new_features_list
-        histogram_features = new_features_list
+    return pd.read_json(source), cache.digest(source)
 
-        # save the data in the hidden div
-        processed_data = df.to_json()
+def read_source_text(source):
 
-        return [processed_data, processed_data_rows, processed_data_columns, correlation_features, histogram_features]
+    return shared_data.read_text(source) if isinstance(source, dict) else source
 
 @app.callback([Output("stats_data_table", "data"), Output("stats_data_table", "columns")],
               [Input("processed_data", "children")])
@@ -763,13 +929,14 @@ def update_statistics(data):
     if data is not None:
 
         # load the processed data from the hidden div
-        df = pd.read_json(data)
+        df = read_data(data)
 
         # drop the index
         df.drop("index", axis=1, inplace=True)
 
-        # calculate the descriptive statistics
-        stats = df.describe().transpose()
+        # calculate the descriptive statistics on the unique rows weighted by their multiplicities
+        unique, inverse, counts = compression.compress_rows(df.values)
+        stats = compression.weighted_describe(unique, counts, df.columns)
 
         # round all values to 2 digits
         stats = stats.astype(float).round(2)
@@ -787,32 +954,47 @@ def update_statistics(data):
 
         return [stats_data_rows, stats_data_columns]
 
+def discard_if_superseded(session_id, output, generation):
+
+    # a newer request for the same output has arrived, so stop before doing more work
+    if not generations.is_current(session_id, output, generation):
+        raise PreventUpdate
+
 @app.callback(Output("correlation_plot", "children"), [Input("processed_data", "children"),
-              Input("correlation_features", "value")])
-def update_correlation_matrix(data, features):
+              Input("correlation_features", "value")], [State("session_id", "children")])
+def update_correlation_matrix(data, features, session_id):
 
     if data is not None:
 
+        generation = generations.begin(session_id, "correlation_plot")
+
         # load the processed data from the hidden div
-        df = pd.read_json(data)
+        df = read_data(data)
+
+        discard_if_superseded(session_id, "correlation_plot", generation)
 
         # drop the index
         df.drop("index", axis=1, inplace=True)
 
-        # calculate the sample correlation matrix
+        # select the features of the sample correlation matrix
         if features is not None:
 
             if len(features) > 0:
 
-                sigma = df[features].corr()
+                columns = list(features)
 
             else:
 
-                sigma = df.iloc[:,:10].corr()
+                columns = list(df.columns[:10])
 
         else:
 
-            sigma = df.iloc[:, :10].corr()
+            columns = list(df.columns[:10])
+
+        # calculate the sample correlation matrix once for all the identical requests
+        sigma = singleflight.call("correlation", cache.digest(data), tuple(columns), df[columns].corr)
+
+        discard_if_superseded(session_id, "correlation_plot", generation)
 
         # plot the sample correlation matrix
         y = list(sigma.index)
@@ -832,19 +1014,25 @@ def update_correlation_matrix(data, features):
 
         figure = go.Figure(data=traces, layout=layout).to_dict()
 
+        discard_if_superseded(session_id, "correlation_plot", generation)
+
         correlation_plot = dcc.Graph(figure=figure, config={"responsive": True, "autosizable": True,
                             "showTips": True, "displaylogo": False})
 
         return correlation_plot
 
 @app.callback(Output("histogram_plot", "children"), [Input("processed_data", "children"),
-              Input("histogram_features", "value")])
-def update_histogram(data, features):
+              Input("histogram_features", "value")], [State("session_id", "children")])
+def update_histogram(data, features, session_id):
 
     if data is not None:
 
+        generation = generations.begin(session_id, "histogram_plot")
+
         # load the processed data from the hidden div
-        df = pd.read_json(data)
+        df = read_data(data)
+
+        discard_if_superseded(session_id, "histogram_plot", generation)
 
         # drop the index
         df.drop("index", axis=1, inplace=True)
@@ -878,6 +1066,8 @@ def update_histogram(data, features):
 
         figure = go.Figure(data=traces, layout=layout).to_dict()
 
+        discard_if_superseded(session_id, "histogram_plot", generation)
+
         histogram_plot = [
 
             html.Label(children=["Histogram of " + name], style={"margin": "0vw 0vw 0.5vw 0vw", "text-align": "center"}),
@@ -894,14 +1084,19 @@ def update_scree_plot(data):
     if data is not None:
 
         # load the processed data from the hidden div
-        df = pd.read_json(data)
+        df = read_data(data)
 
         # drop the index
         df.drop("index", axis=1, inplace=True)
 
-        # run the PCA
-        y = list(PCA(n_components=np.min([10, df.shape[1]]), random_state=0).fit(df).explained_variance_ratio_)
-        x = [z + 1 for z in range(np.min([10, df.shape[1]]))]
+        # run the PCA once for all the identical requests
+        n_components = np.min([10, df.shape[1]])
+
+        pca = singleflight.call("scree_pca", cache.digest(data), n_components,
+                                registry.get("pca")(n_components=n_components, random_state=0).fit, df)
+
+        y = list(pca.explained_variance_ratio_)
+        x = [z + 1 for z in range(n_components)]
 
         # generate the scree plot
         layout = dict(plot_bgcolor="white", paper_bgcolor="white", showlegend=False,
@@ -922,149 +1117,494 @@ def update_scree_plot(data):
 
         return scree_plot
 
-@app.callback([Output("cluster_data_table", "data"), Output("cluster_data_table", "columns"),
-               Output("clustered_data", "children")], [Input("cluster_button", "n_clicks"),
-               Input("processed_data", "children")], [State("cluster_random_sampling", "value"),
-               State("cluster_sample_size", "value"), State("cluster_dimension_reduction", "value"),
-               State("cluster_components", "value"), State("cluster_algorithm", "value"),
-               State("cluster_number", "value"), State("cluster_size", "value")])
-def cluster_analysis(clicks, data, random_sampling, sample_size, dimension_reduction, num_components,
-                     cluster_algorithm, num_clusters, cluster_size):
+def sample_stage(random_sampling, sample_size):
+
+    return pipeline.SampleStage(sample_size if random_sampling == "True" else None)
+
+def estimate_cost(data, random_sampling, sample_size, out_of_sample=None, dimension_reduction=None,
+                  num_components=None, cluster_algorithm=None, num_clusters=None, min_samples=None, batch_size=None,
+                  coreset_size=None):
+
+    # the shape of the published data is known without parsing it again
+    n_rows, n_columns = read_data(data).shape
+    n_columns -= 1
+
+    fitted_rows = n_rows
+
+    if random_sampling == "True" and sample_size is not None:
+        fitted_rows = int(sample_size * n_rows / 100)
+
+    projected_rows = n_rows - fitted_rows if out_of_sample == "project" else 0
+
+    return governor.estimate_cost(fitted_rows, n_columns, dimension_reduction, num_components, cluster_algorithm,
+                                  num_clusters, min_samples, batch_size, coreset_size, projected_rows)
+
+def sweep_input(source, random_sampling, sample_size, dimension_reduction, num_components):
+
+    # load the processed data shared by the server and prepare it as in the cluster analysis
+    df, key = attach_source(source)
+    df, sample = sample_stage(random_sampling, sample_size)(df)
+    df = df.drop("index", axis=1)
+
+    data_key = cache.digest(key, None if sample is None else sample_size)
+
+    reduce = pipeline.ReduceStage(dimension_reduction, num_components, key=data_key)
+
+    if reduce.active:
+        jobs.report(0.1, "reducing dimensions")
+
+    return reduce(df), data_key
+
+def triggered_by(component_id):
+
+    return any(x["prop_id"].split(".")[0] == component_id for x in dash.callback_context.triggered)
+
+def cancel_job(job_id):
+
+    if job_id is None:
+        raise PreventUpdate
+
+    # keep the id, so that the polling callback displays the outcome
+    jobs.cancel(job_id)
+
+    return job_id
+
+def submit_job(job_id, name, fn, *args, session_id=None, estimate=None):
+
+    # a new job replaces the previous one
+    jobs.cancel(job_id)
+
+    # the job runs in a worker, where it is profiled if the admin armed the profiler for it; the jobs of
+    # a session share a worker, which keeps the models and the reductions they fit for the next ones
+    if profiler.take(name, session_id):
+        fn = profiler.Profiled(fn, name, session_id)
+
+    if estimate is None:
+        return jobs.submit(name, fn, *args, affinity=session_id)
+
+    # reject the jobs which exceed the quotas of the session, and queue the others until they fit
+    message = governor.GOVERNOR.check(estimate)
+
+    if message is not None:
+        return jobs.reject(name, message)
+
+    grant = governor.GOVERNOR.grant(estimate)
+
+    return jobs.submit(name, governor.run_limited, grant["threads"], fn, *args,
+                       admit=lambda: governor.GOVERNOR.try_acquire(session_id, grant),
+                       release=lambda: governor.GOVERNOR.release(session_id, grant), affinity=session_id)
+
+def job_progress(job_id):
+
+    # status of a job which has not delivered its results yet, together with the interval state
+    job = jobs.get_job(job_id)
+
+    if job is not None and job.status == "done":
+        return job, None, True
+
+    status = html.P(jobs.describe(job), style={"font-size": "80%", "color": "#BDBDBD"})
+
+    return job, status, job is None or job.done
+
+def run_size_sweep(source, random_sampling, sample_size, dimension_reduction, num_components, min_samples, size_min,
+                   size_max):
+
+    df, data_key = sweep_input(source, random_sampling, sample_size, dimension_reduction, num_components)
+
+    # extract the HDBSCAN clusters for every minimum cluster size from a single cluster tree
+    if size_min is None or size_min < 2:
+        size_min = 2
+
+    if size_max is None or size_max < size_min:
+        size_max = size_min + 18
+
+    if min_samples is None or min_samples < 1:
+        min_samples = size_min
+
+    jobs.report(0.5, "building the cluster tree")
+
+    session = hdbscan_session.get_session(df.values, min_samples,
+                                          key=(data_key, dimension_reduction, num_components, False),
+                                          shared_neighbors=True)
+
+    jobs.report(0.9, "extracting the clusters")
+
+    return session.sweep(range(size_min, size_max + 1))
+
+@app.callback(Output("size_sweep_job", "data"), [Input("size_sweep_button", "n_clicks"),
+              Input("size_sweep_cancel", "n_clicks")], [State("processed_data", "children"),
+              State("cluster_random_sampling", "value"), State("cluster_sample_size", "value"),
+              State("cluster_dimension_reduction", "value"), State("cluster_components", "value"),
+              State("cluster_min_samples", "value"), State("size_sweep_min", "value"), State("size_sweep_max", "value"),
+              State("size_sweep_job", "data"), State("session_id", "children")])
+def update_size_sweep(n_clicks, cancel_clicks, data, random_sampling, sample_size, dimension_reduction, num_components,
+                      min_samples, size_min, size_max, job_id, session_id):
+
+    if triggered_by("size_sweep_cancel"):
+
+        return cancel_job(job_id)
+
+    if data is not None and n_clicks > 0:
+
+        estimate = estimate_cost(data, random_sampling, sample_size, None, dimension_reduction, num_components,
+                                 "hdbscan", min_samples=min_samples)
+
+        return submit_job(job_id, "Cluster size sweep", run_size_sweep, share_data(data), random_sampling,
+                          sample_size, dimension_reduction, num_components, min_samples, size_min, size_max,
+                          session_id=session_id, estimate=estimate)
+
+    raise PreventUpdate
+
+@app.callback([Output("size_sweep_plot", "children"), Output("size_sweep_job_interval", "disabled")],
+              [Input("size_sweep_job", "data"), Input("size_sweep_job_interval", "n_intervals")])
+def poll_size_sweep(job_id, n_intervals):
+
+    if job_id is None:
+        raise PreventUpdate
+
+    job, status, finished = job_progress(job_id)
+
+    if status is not None:
+
+        return [status, finished]
+
+    results = pd.DataFrame(job.result)
+
+    # plot the number of clusters and the fraction of noise points
+    layout = dict(plot_bgcolor="white", paper_bgcolor="white", showlegend=True, legend=dict(orientation="h"),
+                font=dict(family="Open Sans", size=9), margin=dict(t=20, l=20, r=20, b=20),
+                xaxis=dict(zeroline=False, showgrid=False, mirror=True, linecolor="#d9d9d9", tickangle=0,
+                title_text="Minimum Cluster Size"), yaxis=dict(zeroline=False, showgrid=False, mirror=True,
+                linecolor="#d9d9d9", tickangle=0, title_text="Number of Clusters"), yaxis2=dict(range=[-0.05, 1.05],
+                zeroline=False, showgrid=False, linecolor="#d9d9d9", tickangle=0, overlaying="y", side="right",
+                title_text="Noise Fraction"))
+
+    traces = []
+    traces.append(go.Scatter(x=list(results["size"]), y=list(results["clusters"]), name="Number of Clusters",
+            mode="lines+markers", hoverinfo="x+y", marker=dict(size=10, color="#cbe1ee",
+            line=dict(color="#3288BD", width=1)), line=dict(color="#3288BD", width=2)))
+    traces.append(go.Scatter(x=list(results["size"]), y=list(results["noise"]), name="Noise Fraction",
+            yaxis="y2", mode="lines+markers", hoverinfo="x+y", marker=dict(size=10, color="#fee08b",
+            line=dict(color="#D53E4F", width=1)), line=dict(color="#D53E4F", width=2)))
+
+    figure = go.Figure(data=traces, layout=layout).to_dict()
+
+    size_sweep_plot = dcc.Graph(figure=figure, config={"responsive": True, "autosizable": True,
+    "showTips": True, "displaylogo": False}, style={"height": "30vw", "width": "60vw"})
+
+    return [size_sweep_plot, True]
+
+def run_k_sweep(source, random_sampling, sample_size, dimension_reduction, num_components, compress, k_min, k_max):
+
+    df, data_key = sweep_input(source, random_sampling, sample_size, dimension_reduction, num_components)
+
+    # fit K-Means for every K in the range
+    if k_min is None or k_min < 1:
+        k_min = 2
+
+    if k_max is None or k_max < k_min:
+        k_max = k_min + 8
+
+    compress = compress == "True"
+
+    jobs.report(0.5, "fitting K-Means")
+
+    return clustering.sweep_kmeans(df.values, range(k_min, k_max + 1),
+                                   key=(data_key, dimension_reduction, num_components, compress), compress=compress)
+
+@app.callback(Output("sweep_job", "data"), [Input("sweep_button", "n_clicks"), Input("sweep_cancel", "n_clicks")],
+              [State("processed_data", "children"), State("cluster_random_sampling", "value"),
+              State("cluster_sample_size", "value"), State("cluster_dimension_reduction", "value"),
+              State("cluster_components", "value"), State("cluster_compress", "value"), State("sweep_min", "value"),
+              State("sweep_max", "value"), State("sweep_job", "data"), State("session_id", "children")])
+def update_k_sweep(n_clicks, cancel_clicks, data, random_sampling, sample_size, dimension_reduction, num_components,
+                   compress, k_min, k_max, job_id, session_id):
+
+    if triggered_by("sweep_cancel"):
+
+        return cancel_job(job_id)
+
+    if data is not None and n_clicks > 0:
+
+        estimate = estimate_cost(data, random_sampling, sample_size, None, dimension_reduction, num_components,
+                                 "kmeans", k_max)
+
+        return submit_job(job_id, "K-Means sweep", run_k_sweep, share_data(data), random_sampling, sample_size,
+                          dimension_reduction, num_components, compress, k_min, k_max, session_id=session_id,
+                          estimate=estimate)
+
+    raise PreventUpdate
+
+@app.callback([Output("sweep_plot", "children"), Output("sweep_job_interval", "disabled")],
+              [Input("sweep_job", "data"), Input("sweep_job_interval", "n_intervals")])
+def poll_k_sweep(job_id, n_intervals):
+
+    if job_id is None:
+        raise PreventUpdate
+
+    job, status, finished = job_progress(job_id)
+
+    if status is not None:
+
+        return [status, finished]
+
+    results = pd.DataFrame(job.result)
+
+    # plot the inertia (elbow) and the silhouette score
+    layout = dict(plot_bgcolor="white", paper_bgcolor="white", showlegend=True, legend=dict(orientation="h"),
+                font=dict(family="Open Sans", size=9), margin=dict(t=20, l=20, r=20, b=20),
+                xaxis=dict(zeroline=False, showgrid=False, mirror=True, linecolor="#d9d9d9", tickangle=0,
+                tickmode="array", tickvals=list(results["k"]), title_text="Number of Clusters"),
+                yaxis=dict(zeroline=False, showgrid=False, mirror=True, linecolor="#d9d9d9", tickangle=0,
+                title_text="Inertia"), yaxis2=dict(zeroline=False, showgrid=False, linecolor="#d9d9d9",
+                tickangle=0, overlaying="y", side="right", title_text="Silhouette Score"))
+
+    traces = []
+    traces.append(go.Scatter(x=list(results["k"]), y=list(results["inertia"]), name="Inertia",
+            mode="lines+markers", hoverinfo="x+y", marker=dict(size=10, color="#cbe1ee",
+            line=dict(color="#3288BD", width=1)), line=dict(color="#3288BD", width=2)))
+    traces.append(go.Scatter(x=list(results["k"]), y=list(results["silhouette"]), name="Silhouette Score",
+            yaxis="y2", mode="lines+markers", hoverinfo="x+y", marker=dict(size=10, color="#fee08b",
+            line=dict(color="#D53E4F", width=1)), line=dict(color="#D53E4F", width=2)))
+
+    figure = go.Figure(data=traces, layout=layout).to_dict()
+
+    sweep_plot = dcc.Graph(figure=figure, config={"responsive": True, "autosizable": True,
+    "showTips": True, "displaylogo": False}, style={"height": "30vw", "width": "60vw"})
+
+    return [sweep_plot, True]
+
+def run_cluster_analysis(source, random_sampling, sample_size, out_of_sample, dimension_reduction, num_components,
+                         cluster_algorithm, num_clusters, cluster_size, min_samples, batch_size, threshold, coreset_size,
+                         compress, session_id, raw_source=None, selection=None, save_model="False"):
+
+    # the processed data shared by the server
+    df, key = attach_source(source)
+
+    sample = sample_stage(random_sampling, sample_size)
+
+    # identify the dataset and the sample, used for reusing the cached reductions and models
+    data_key = cache.digest(key, None if sample.sample_size is None else sample_size)
+
+    # warm-start K-Means from the centroids of the previous run
+    cluster = pipeline.ClusterStage(cluster_algorithm, num_clusters, cluster_size, min_samples, batch_size, threshold,
+                                    coreset_size, compress == "True", key=(data_key, dimension_reduction, num_components),
+                                    init=lambda features: clustering.last_centroids(session_id, features))
+
+    analysis = pipeline.Pipeline(sample=sample, reduce=pipeline.ReduceStage(dimension_reduction, num_components,
+                                 key=data_key), cluster=cluster,
+                                 project=pipeline.ProjectStage() if out_of_sample == "project" else None,
+                                 progress=jobs.report, keep_model=save_model == "True")
+
+    df = analysis.analyze(df)
+
+    # save the fitted pipeline, after fitting the preprocessing on the raw data again as it is not kept
+    model_id, model_message = None, None
+
+    if save_model == "True" and raw_source is not None and selection is not None:
+
+        jobs.report(0.9, "saving the model")
+
+        raw = pd.read_json(read_source_text(raw_source))
+        analysis.preprocess = pipeline.PreprocessStage(pd.read_json(selection)).fit(lambda: [raw])
+
+        try:
+
+            model_id = models.save(analysis)
+            model_message = "Model saved as " + model_id + ". Label new rows with POST /models/" + model_id + "/score."
+
+        except ValueError as e:
+
+            model_message = str(e)
+
+    # the worker keeps the centroids for warm-starting the next run of the session
+    clustering.set_centroids(session_id, cluster.features, cluster.centroids)
+
+    return {"cluster_data": df.to_json(), "messages": analysis.messages, "model_id": model_id,
+            "model_message": model_message}
+
+@app.callback(Output("cluster_job", "data"), [Input("cluster_button", "n_clicks"), Input("processed_data", "children"),
+               Input("cluster_cancel", "n_clicks")], [State("cluster_random_sampling", "value"),
+               State("cluster_sample_size", "value"), State("cluster_out_of_sample", "value"),
+               State("cluster_dimension_reduction", "value"), State("cluster_components", "value"),
+               State("cluster_algorithm", "value"), State("cluster_number", "value"), State("cluster_size", "value"),
+               State("cluster_min_samples", "value"), State("cluster_batch_size", "value"),
+               State("cluster_threshold", "value"), State("cluster_coreset_size", "value"),
+               State("cluster_compress", "value"), State("session_id", "children"), State("cluster_job", "data"),
+               State("raw_data", "children"), State("processed_selection", "children"),
+               State("cluster_save_model", "value")])
+def cluster_analysis(clicks, data, cancel_clicks, random_sampling, sample_size, out_of_sample, dimension_reduction,
+                     num_components, cluster_algorithm, num_clusters, cluster_size, min_samples, batch_size, threshold,
+                     coreset_size, compress, session_id, job_id, raw_data, selection, save_model):
+
+    if triggered_by("cluster_cancel"):
+
+        return cancel_job(job_id)
 
     if data is not None:
 
-        # load the processed data from the hidden div
-        df = pd.read_json(data)
+        estimate = estimate_cost(data, random_sampling, sample_size, out_of_sample, dimension_reduction,
+                                 num_components, cluster_algorithm, num_clusters, min_samples, batch_size, coreset_size)
 
-        # create a copy of the data frame
-        df_copy = df.copy()
+        # the raw data is only needed for saving the model
+        raw_source = share_text(raw_data) if save_model == "True" and raw_data is not None else None
 
-        # perform random sampling
-        if random_sampling == "True":
+        # run the analysis in the background, the browser polls for the progress
+        return submit_job(job_id, "Clustering", run_cluster_analysis, share_data(data), random_sampling, sample_size,
+                          out_of_sample, dimension_reduction, num_components, cluster_algorithm, num_clusters,
+                          cluster_size, min_samples, batch_size, threshold, coreset_size, compress, session_id,
+                          raw_source, selection, save_model, session_id=session_id, estimate=estimate)
 
-            if sample_size is not None:
+    raise PreventUpdate
 
-                # calculate the number of samples
-                n_samples = np.int(sample_size * df.shape[0] / 100)
+@app.callback([Output("cluster_job_status", "children"), Output("cluster_job_interval", "disabled"),
+               Output("cluster_job_link", "href"), Output("cluster_job_link", "style"),
+               Output("cluster_data_table", "data"), Output("cluster_data_table", "columns"),
+               Output("clustered_data", "children")], [Input("cluster_job", "data"),
+               Input("cluster_job_interval", "n_intervals")])
+def poll_cluster_analysis(job_id, n_intervals):
 
-                # generate the random sample
-                sample = sample_without_replacement(n_population=df.shape[0], n_samples=n_samples, random_state=0)
-                sample = np.sort(sample)
+    if job_id is None:
+        raise PreventUpdate
 
-                # extract the random sample
-                df = df.iloc[sample, :]
-                df.reset_index(inplace=True, drop=True)
+    job, status, finished = job_progress(job_id)
 
-        # drop the indices
-        indices = df["index"]
-        df.drop("index", axis=1, inplace=True)
+    if status is not None:
 
-        # run the dimension reduction algorithm
-        if dimension_reduction == "pca":
+        return [status, finished, dash.no_update, {"display": "none"}, dash.no_update, dash.no_update, dash.no_update]
 
-            if num_components > 0 and num_components <= df.shape[1]:
+    result = job.result
 
-                df = PCA(n_components=np.int(num_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component " + str(x) for x in range(1, num_components + 1)])
+    # the results stay on the server, so that they can be downloaded after reconnecting
+    link_style = {"display": "block", "font-size": "80%", "margin": "0.5vw 0vw 0vw 1vw", "color": "#3288BD"}
 
-            else:
+    # save the results in the hidden div
+    cluster_data = result["cluster_data"]
 
-                df = PCA(n_components=3, random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component " + str(x) for x in range(1, 4)])
+    df = metrics.read_json(cluster_data)
 
-        elif dimension_reduction == "tsne":
+    # keep the parsed results for the downloads, under the id of the job
+    export.store_result(df, job_id)
 
-            if num_components > 0 and num_components <= 3:
+    # round all values to 2 digits
+    df = df.copy()
+    df.iloc[:,2:] = df.iloc[:,2:].astype(float).round(2)
 
-                df = TSNE(n_components=np.int(num_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component" + str(x) for x in range(1, num_components + 1)])
+    # display the results in the table
+    cluster_data_rows = df.to_dict("records")
+    cluster_data_columns = [{"id": x, "name": x} for x in list(df.columns)]
 
-            else:
+    status = " ".join([jobs.describe(job)] + result["messages"])
 
-                df = TSNE(n_components=3, random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component" + str(x) for x in range(1, 4)])
+    if result.get("model_message") is not None:
+        status = status + " " + result["model_message"]
 
-        # run the clustering algorithm
-        if cluster_algorithm == "kmeans":
+    return [status, True, "/results/" + job_id + ".csv", link_style, cluster_data_rows, cluster_data_columns,
+            cluster_data]
 
-            if num_clusters > 0 and num_clusters <= df.shape[0]:
+@application.route("/results/<result_id>.<path:fmt>")
+def download_result(result_id, fmt):
 
-                algo = KMeans(n_clusters=num_clusters, random_state=0).fit(df)
+    df = export.load_result(result_id)
 
-            else:
+    if df is None:
+        flask.abort(404)
 
-                algo = KMeans(n_clusters=3).fit(df)
+    # use the current time as the file name
+    file_name = "clustering_" + datetime.now().strftime("%Y%m%d_%H%M%S")
 
-        elif cluster_algorithm == "hdbscan":
+    return export.stream(df, fmt, file_name)
 
-            if cluster_size > 1 and cluster_size <= df.shape[0]:
+@application.route("/resources")
+def resources():
 
-                algo = hdbscan.HDBSCAN(min_cluster_size=cluster_size).fit(df)
+    # current utilization of the threads and the memory, by session
+    return flask.jsonify(governor.GOVERNOR.utilization())
 
-            else:
+@application.route("/models")
+def list_models():
 
-                algo = hdbscan.HDBSCAN(min_cluster_size=2).fit(df)
+    return flask.jsonify(models.list_models())
 
-        # add the cluster labels
-        df["cluster labels"] = algo.labels_
-        df["cluster labels"] = 1 + df["cluster labels"]
+@application.route("/models/<model_id>")
+def model_metadata(model_id):
 
-        # add back the indices
-        df["index"] = indices
-        df = df[["index", "cluster labels"]]
-        df = pd.merge(left=df, right=df_copy, on="index", how="left")
+    try:
+        return flask.jsonify(models.metadata(model_id))
+    except (KeyError, OSError):
+        flask.abort(404)
 
-        # save the results in the hidden div
-        cluster_data = df.to_json()
+@application.route("/models/<model_id>/score", methods=["POST"])
+def score_rows(model_id):
 
-        # round all values to 2 digits
-        df.iloc[:,2:] = df.iloc[:,2:].astype(float).round(2)
+    # an unknown model is reported before the rows are read
+    try:
+        models.load(model_id)
+    except (KeyError, OSError):
+        flask.abort(404)
 
-        # display the results in the table
-        cluster_data_rows = df.to_dict("records")
-        cluster_data_columns = [{"id": x, "name": x} for x in list(df.columns)]
+    # the rows are sent as a JSON list of records, as a JSON object of columns, or as a CSV file
+    try:
+
+        if flask.request.mimetype == "text/csv":
+
+            df = pd.read_csv(io.BytesIO(flask.request.get_data()))
+
+        else:
+
+            rows = flask.request.get_json(force=True, silent=True)
 
-        return [cluster_data_rows, cluster_data_columns, cluster_data]
+            if not isinstance(rows, (list, dict)):
+                raise ValueError("The body is not a JSON list of records or object of columns.")
+
+            df = pd.DataFrame(rows)
+
+        result, summary = models.score(model_id, df)
+
+    except ValueError as e:
+
+        # malformed rows and missing columns are errors of the request
+        return flask.jsonify({"error": str(e)}), 400
+
+    # numpy types are not serializable by flask, pandas converts them
+    summary["labels"] = json.loads(result.to_json(orient="records"))
+
+    return flask.jsonify(summary)
 
 @app.callback([Output("x-axis", "options"), Output("y-axis", "options"), Output("z-axis", "options"),
-               Output("plot_data", "children")], [Input("clustered_data", "children"), Input("plot_button", "n_clicks")],
-              [State("plot_dimension_reduction", "value"), State("plot_components", "value")])
-def update_plot_data(data, plot_button, plot_dimension_reduction, plot_components):
+               Output("plot_data", "children"), Output("plot_status", "children")],
+              [Input("clustered_data", "children"), Input("plot_button", "n_clicks")],
+              [State("plot_dimension_reduction", "value"), State("plot_components", "value"),
+              State("session_id", "children")])
+def update_plot_data(data, plot_button, plot_dimension_reduction, plot_components, session_id):
 
     if data is not None:
 
         # load the clustering results from the hidden div
-        df = pd.read_json(data)
+        df = metrics.read_json(data)
 
-        # drop the indices and the cluster labels
+        # drop the indices, the cluster labels and the membership strengths
         indices = df["index"]
         labels = df["cluster labels"]
         df.drop(["index", "cluster labels"], axis=1, inplace=True)
 
-        # run the dimension reduction algorithm
-        if plot_dimension_reduction == "pca":
-
-            if plot_components > 0 and plot_components <= df.shape[1]:
+        if "membership strength" in df.columns:
+            df.drop("membership strength", axis=1, inplace=True)
 
-                df = PCA(n_components=np.int(plot_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component " + str(x) for x in range(1, plot_components + 1)])
+        # run the dimension reduction algorithm within the resources of the session
+        if plot_dimension_reduction in embedding.ENGINES:
 
-            else:
+            estimate = governor.estimate_cost(df.shape[0], df.shape[1], plot_dimension_reduction, plot_components)
 
-                df = PCA(n_components=3, random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component " + str(x) for x in range(1, 4)])
+            try:
 
-        elif plot_dimension_reduction == "tsne":
+                with governor.governed(session_id, estimate) as grant:
 
-            if plot_components > 0 and plot_components <= 3:
+                    df = pipeline.ReduceStage(plot_dimension_reduction, plot_components, n_jobs=grant["threads"])(df)
 
-                df = TSNE(n_components=np.int(plot_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component" + str(x) for x in range(1, plot_components + 1)])
+            except RuntimeError as e:
 
-            else:
-
-                df = TSNE(n_components=3, random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component" + str(x) for x in range(1, 4)])
+                return [dash.no_update, dash.no_update, dash.no_update, dash.no_update, str(e)]
 
         # create the lists of features to be shown in the dropdown menus
         columns = list(df.columns)
@@ -1083,15 +1623,20 @@ def update_plot_data(data, plot_button, plot_dimension_reduction, plot_component
         df["cluster labels"] = labels
         plot_data = df.to_json()
 
-        return [x_axis_options, y_axis_options, z_axis_options, plot_data]
+        return [x_axis_options, y_axis_options, z_axis_options, plot_data, ""]
 
 @app.callback(Output("cluster_plot", "children"), [Input("plot_data", "children"), Input("x-axis", "value"),
-              Input("y-axis", "value"), Input("z-axis", "value")], [State("plot_dimensions", "value")])
-def update_scatter_plot(data, x_axis, y_axis, z_axis, plot_dimensions):
+              Input("y-axis", "value"), Input("z-axis", "value")], [State("plot_dimensions", "value"),
+              State("session_id", "children")])
+def update_scatter_plot(data, x_axis, y_axis, z_axis, plot_dimensions, session_id):
 
     if data is not None:
 
-        df = pd.read_json(data)
+        generation = generations.begin(session_id, "cluster_plot")
+
+        df = metrics.read_json(data)
+
+        discard_if_superseded(session_id, "cluster_plot", generation)
 
         if plot_dimensions == "2d":
 
@@ -1165,28 +1710,30 @@ def update_scatter_plot(data, x_axis, y_axis, z_axis, plot_dimensions):
             scatter_plot = dcc.Graph(figure=figure, config={"responsive": True, "autosizable": True, "showTips": True,
             "displaylogo": False}, style={"height": "25vw", "width": "40vw"})
 
+        discard_if_superseded(session_id, "cluster_plot", generation)
+
         return scatter_plot
 
 @app.callback([Output("cluster_data_link", "href"), Output("cluster_data_link", "download")],
-              [Input("cluster_data_button", "n_clicks"), Input("clustered_data", "children")])
-def download_file(n_clicks, data):
-
-    if data is not None:
-
-        # load the clustering results from the hidden div
-        df = pd.read_json(data)
+              [Input("cluster_job", "data"), Input("download_format", "value")])
+def download_file(job_id, download_format):
 
-        # convert the table to csv
-        csv = df.to_csv(index=False, encoding="utf-8")
+    if job_id is not None:
 
-        # create the file for download
-        file_for_download = "data:text/csv;charset=utf-8," + urllib.parse.quote(csv)
+        # point the link to the download route, which only generates the file when the link is clicked
+        file_for_download = "/results/" + job_id + "." + download_format
 
         # use the current time as the file name
-        file_name = "clustering_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".csv"
+        file_name = "clustering_" + datetime.now().strftime("%Y%m%d_%H%M%S") + "." + download_format
 
         return file_for_download, file_name
 
 if __name__ == "__main__":
-    app.run_server(port=8080, debug=False) # use this for running on local machine
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch.main(sys.argv[2:]) # use this for clustering a file without the web server
+    else:
+        if os.environ.get("PRELOAD", "0") == "1":
+            registry.preload()
+            print(registry.format_report())
+        app.run_server(port=8080, debug=False) # use this for running on local machine
     #application.run_server(port=8080, debug=False) # use this for deploying on AWS
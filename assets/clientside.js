@@ -0,0 +1,28 @@
+// callbacks which only toggle the display of components, run in the browser
+// instead of a round trip to the server
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    clientside: {
+
+        // the panels of the controls: the upload alert until a dataset is loaded, then the selected tab
+        alert_display: function(dataset_present, tab) {
+            return {"display": dataset_present ? "none" : "block"};
+        },
+
+        data_display: function(dataset_present, tab) {
+            return {"display": dataset_present && tab === "tab1" ? "block" : "none"};
+        },
+
+        cluster_display: function(dataset_present, tab) {
+            return {"display": dataset_present && tab === "tab2" ? "block" : "none"};
+        },
+
+        // the alerts are displayed until their button is clicked
+        data_messages: function(messages, n_clicks) {
+            return {"display": messages !== null && messages !== undefined && n_clicks === 0 ? "block" : "none"};
+        },
+
+        cluster_messages: function(n_clicks) {
+            return {"display": n_clicks === 0 ? "block" : "none"};
+        }
+    }
+});
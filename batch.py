@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+# usage: python batch.py input.csv output.parquet [options], or python application.py batch ...
+
+import argparse
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import governor
+import pipeline
+import sampling
+
+####################################################
+# number of rows the reduction and the clustering
+# are fitted on; the other rows are assigned to the
+# fitted clusters while they are streamed
+SAMPLE_ROWS = 100000
+####################################################
+
+
+def common_dtype(a, b):
+
+    if a == b:
+        return a
+
+    # e.g. float when a column of integers has missing values in another chunk, text otherwise
+    if a != object and b != object:
+        return np.result_type(a, b)
+
+    return np.dtype(object)
+
+
+def coerce_numbers(chunk):
+
+    # a numeric column is read as text when a chunk has a missing value marker, e.g. "?"; once the
+    # markers are cleaned, the text columns whose values are all numbers are numbers
+    for column in chunk.columns:
+
+        x = chunk[column]
+
+        if not pd.api.types.is_numeric_dtype(x.dtype) and x.notnull().any():
+
+            y = pd.to_numeric(x, errors="coerce")
+
+            if y.notnull().sum() == x.notnull().sum():
+                chunk[column] = y
+
+    return chunk
+
+
+def conform_dtypes(chunk, dtypes):
+
+    # cast the columns of a chunk to the types they have over the chunks, so that the encodings see
+    # numbers in the numeric columns and only text in the text columns
+    for column in chunk.columns:
+
+        dtype = dtypes.get(column)
+        x = chunk[column]
+
+        if dtype is None:
+            continue
+
+        if dtype == object and pd.api.types.is_numeric_dtype(x.dtype):
+            chunk[column] = x.astype(str).where(x.notnull(), None)
+        elif dtype != object and not pd.api.types.is_numeric_dtype(x.dtype):
+            chunk[column] = pd.to_numeric(x, errors="coerce")
+
+    return chunk
+
+
+def update_dtypes(dtypes, chunk):
+
+    # the dtypes of the columns over all the chunks read so far, numbers or text; a column without
+    # any value in a chunk says nothing about its type
+    for column in chunk.columns:
+
+        dtype = chunk[column].dtype
+
+        if not pd.api.types.is_numeric_dtype(dtype):
+            dtype = np.dtype(object)
+
+        if chunk[column].isnull().all():
+
+            dtypes.setdefault(column, None)
+
+        elif dtypes.get(column) is None:
+
+            dtypes[column] = dtype
+
+        else:
+
+            dtypes[column] = common_dtype(dtypes[column], dtype)
+
+    return dtypes
+
+
+class WriteStage(pipeline.Stage):
+
+    # append the labeled chunks to a Parquet file, one row group per chunk; the columns are cast
+    # to the dtypes they have over all the chunks, which a single chunk does not tell, and the file
+    # only replaces the output once every chunk is written
+    name = "write"
+
+    def __init__(self, path, dtypes=None):
+
+        pipeline.Stage.__init__(self)
+
+        self.path = path
+        self.dtypes = dtypes if dtypes is not None else {}
+        self.writer = None
+
+    def conform(self, df):
+
+        df = df.copy()
+
+        for column in df.columns:
+
+            dtype = self.dtypes.get(column, df[column].dtype)
+
+            # text, and the columns without any value, are written as strings
+            if dtype is None or dtype == object:
+                df[column] = df[column].astype(str).where(df[column].notnull(), None)
+            else:
+                df[column] = df[column].astype(dtype)
+
+        return df
+
+    def schema(self, df):
+
+        import pyarrow as pa
+
+        return pa.schema([pa.field(column, pa.from_numpy_dtype(df[column].dtype)
+                                   if pd.api.types.is_numeric_dtype(df[column].dtype) else pa.string())
+                          for column in df.columns])
+
+    def run(self, df):
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        df = self.conform(df)
+
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path + ".partial", self.schema(df))
+
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False))
+
+    def close(self, complete=True):
+
+        if self.writer is None:
+            return
+
+        self.writer.close()
+        self.writer = None
+
+        if complete:
+            os.replace(self.path + ".partial", self.path)
+        else:
+            os.remove(self.path + ".partial")
+
+
+def read_selection(path):
+
+    # the same frame as the selections of the preprocessing tab: feature, type, weight and transformation
+    if path is None:
+        return None
+
+    selection = pd.read_json(path)
+    selection.reset_index(drop=True, inplace=True)
+
+    return selection
+
+
+def run_batch(input_path, output_path, selection=None, dimension_reduction="none", num_components=None,
+              cluster_algorithm="kmeans", num_clusters=None, cluster_size=None, min_samples=None, batch_size=None,
+              threshold=None, coreset_size=None, compress=False, sample_rows=SAMPLE_ROWS,
+              chunk_size=sampling.CHUNK_SIZE, seed=0, labels_only=False, progress=None):
+
+    # progress receives a message at the start of every pass, e.g. print
+    if progress is None:
+        progress = lambda message: None
+
+    load = pipeline.LoadStage(chunk_size=chunk_size)
+    clean = pipeline.CleanStage()
+    preprocess = pipeline.PreprocessStage(selection)
+    reduce = pipeline.ReduceStage(dimension_reduction, num_components)
+    cluster = pipeline.ClusterStage(cluster_algorithm, num_clusters, cluster_size, min_samples, batch_size, threshold,
+                                    coreset_size, compress)
+    project = pipeline.ProjectStage()
+    dtypes = OrderedDict()
+    write = WriteStage(output_path, dtypes)
+
+    filename = os.path.basename(input_path)
+    retyped = []
+
+    def read_chunks(infer=False):
+
+        # every pass reads the file again, so only the current chunk is held in memory; the first
+        # pass infers the types of the columns, the chunks are cast to the types known so far
+        chunks = load.chunks(input_path, filename)
+        offset = 0
+
+        while True:
+
+            chunk = load.timed(next, chunks, None)
+
+            if chunk is None:
+                return
+
+            n_rows = chunk.shape[0]
+
+            chunk = clean(chunk, offset)
+            offset += n_rows
+
+            if infer:
+
+                numeric = [column for column, dtype in dtypes.items() if dtype is not None and dtype != object]
+                update_dtypes(dtypes, coerce_numbers(chunk))
+
+                # a column of numbers in the previous chunks has text in this one
+                retyped.extend(column for column in numeric if dtypes[column] == object)
+
+            yield conform_dtypes(chunk, dtypes)
+
+    def accumulate(chunks):
+
+        for chunk in chunks:
+
+            preprocess.timed(preprocess.accumulate, chunk)
+
+            yield chunk
+
+    # first pass: the categories and the ranges of the features, and the dtypes of the output
+    progress("learning the encodings")
+
+    for chunk in read_chunks(infer=True):
+        preprocess.timed(preprocess.learn, chunk)
+
+    # the encodings of the previous chunks were learned with the wrong types
+    if retyped:
+
+        progress("learning the encodings again, " + ", ".join(sorted(set(retyped))) + " have text")
+
+        preprocess.features = None
+
+        for chunk in read_chunks():
+            preprocess.timed(preprocess.learn, chunk)
+
+    preprocess.learned()
+
+    # second pass: the moments used by the scalers, while drawing the sample the models are fitted on
+    progress("fitting the scalers and sampling " + str(sample_rows) + " rows")
+
+    sample = sampling.reservoir_sample(accumulate(read_chunks()), sample_rows, seed)
+
+    # fit the reduction and the clustering on the sample
+    progress("fitting the models on " + str(sample.shape[0]) + " rows")
+
+    x = preprocess.timed(preprocess.transform, sample).drop("index", axis=1, errors="ignore")
+    x = reduce(x, keep_model=True)
+
+    if reduce.active and reduce.model is None:
+        raise ValueError("The selected dimension reduction cannot project new rows. Choose PCA or UMAP.")
+
+    cluster(x, prediction_data=True)
+
+    del sample, x
+
+    # third pass: label every row, including the sampled ones, and write the results
+    progress("labeling the rows")
+
+    n_rows = 0
+    complete = False
+
+    try:
+
+        for chunk in read_chunks():
+
+            x = preprocess.timed(preprocess.transform, chunk).drop("index", axis=1, errors="ignore")
+            labels, strengths = project(x, reduce, cluster)
+
+            result = pd.DataFrame({"index": chunk["index"].values, "cluster labels": 1 + labels})
+
+            if cluster_algorithm == "hdbscan":
+                result["membership strength"] = strengths
+
+            if not labels_only:
+                result = pd.concat([result, chunk.drop("index", axis=1)], axis=1)
+
+            write(result)
+
+            n_rows += result.shape[0]
+
+        complete = True
+
+    finally:
+
+        write.close(complete)
+
+    progress("wrote " + str(n_rows) + " rows to " + output_path)
+
+    return [load, clean, preprocess, reduce, cluster, project, write]
+
+
+def summary(stages):
+
+    # time spent in every stage and the peak memory of the process after it
+    rows = []
+
+    for stage in stages:
+
+        if stage.seconds is not None:
+
+            memory = governor.format_bytes(stage.memory) if stage.memory is not None else "n/a"
+
+            rows.append({"stage": stage.name, "seconds": round(stage.seconds, 2), "peak memory": memory})
+
+    return pd.DataFrame(rows).to_string(index=False)
+
+
+def parse_arguments(argv):
+
+    parser = argparse.ArgumentParser(prog="batch", description="Cluster a large file in chunks and write the labeled "
+                                                                "rows as Parquet.")
+
+    parser.add_argument("input", help="csv, txt, tsv, xls or json file")
+    parser.add_argument("output", help="Parquet file with the cluster labels")
+    parser.add_argument("--selection", help="JSON file with the feature, type, weight and transformation of the "
+                                            "features, as in the preprocessing tab")
+    parser.add_argument("--dimension-reduction", default="none", help="none, pca, umap")
+    parser.add_argument("--components", type=int)
+    parser.add_argument("--algorithm", default="kmeans", help="kmeans, minibatch, birch, coreset, hdbscan")
+    parser.add_argument("--clusters", type=int)
+    parser.add_argument("--cluster-size", type=int)
+    parser.add_argument("--min-samples", type=int)
+    parser.add_argument("--batch-size", type=int)
+    parser.add_argument("--threshold", type=float)
+    parser.add_argument("--coreset-size", type=int)
+    parser.add_argument("--compress", action="store_true", help="collapse the identical rows before K-Means")
+    parser.add_argument("--sample-rows", type=int, default=SAMPLE_ROWS)
+    parser.add_argument("--chunk-size", type=int, default=sampling.CHUNK_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--labels-only", action="store_true", help="only write the indices and the labels")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_arguments(argv)
+
+    stages = run_batch(args.input, args.output, read_selection(args.selection), args.dimension_reduction,
+                       args.components, args.algorithm, args.clusters, args.cluster_size, args.min_samples,
+                       args.batch_size, args.threshold, args.coreset_size, args.compress, args.sample_rows,
+                       args.chunk_size, args.seed, args.labels_only, print)
+
+    print(summary(stages))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+# usage: python benchmark.py [number of rows ...] [--columns 15 150 1500] [--quick] [--suites stages ...]
+#                            [--output file.json]
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import cache
+import clustering
+import compression
+import coreset
+import embedding
+import export
+import governor
+import neighbors
+import pipeline
+import registry
+
+####################################################
+# default dataset sizes used by the benchmarks and
+# the smaller ones of the quick preset; they can be
+# overridden on the command line
+SIZES = [10000, 100000, 1000000, 10000000]
+COLUMNS = [15, 150, 1500]
+QUICK_SIZES = [1000, 10000]
+QUICK_COLUMNS = [15]
+####################################################
+
+####################################################
+# largest number of rows the quadratic stages are
+# run on, the larger datasets skip them
+LIMITS = {"tsne": 100000, "hdbscan": 1000000}
+####################################################
+
+# rows generated and written at once by the synthetic dataset generator
+CHUNK_ROWS = 100000
+
+# copies of the data held at once by the stages, used for skipping the datasets which do not fit in memory
+COPIES = 4
+
+# seconds between two samples of the resident memory while a stage runs
+MEMORY_INTERVAL = 0.01
+
+
+def is_index(column):
+
+    # the row numbers written with the data, e.g. by pandas, are not a feature
+    return column in ["index", pipeline.CleanStage().index_column] or str(column).startswith("Unnamed:")
+
+
+def read_sample(path):
+
+    df = pd.read_csv(path)
+
+    return df[[column for column in df.columns if not is_index(column)]]
+
+
+def make_dataset(n_rows, path="data/adult.csv"):
+
+    # load the sample data and encode it as in the preprocessing tab
+    df = read_sample(path)
+    df = pd.get_dummies(df, dummy_na=False).astype(float)
+
+    # replicate the rows and add some noise to reach the requested size
+    rng = np.random.RandomState(0)
+    x = df.values[rng.randint(0, df.shape[0], n_rows), :]
+    x = x + rng.normal(scale=0.01, size=x.shape) * x.std(axis=0)
+
+    return pd.DataFrame(data=x, columns=df.columns)
+
+
+def profile(path="data/adult.csv"):
+
+    # type, values and frequencies of every column of the sample data; the missing values
+    # are kept as they are written in the file, so that the cleaning has the same work to do;
+    # the index is left out, the cleaning numbers the synthetic rows
+    df = read_sample(path)
+
+    columns = []
+
+    for column in df.columns:
+
+        if df[column].dtype == "object":
+
+            frequencies = df[column].value_counts(normalize=True)
+
+            columns.append({"name": column, "type": "categorical", "values": frequencies.index.values,
+                            "probabilities": frequencies.values})
+
+        else:
+
+            columns.append({"name": column, "type": "numerical", "values": df[column].values})
+
+    return columns
+
+
+def synthesize(n_rows, n_columns, seed=0, chunk_rows=CHUNK_ROWS, path="data/adult.csv"):
+
+    # adult-like chunks: the columns of the sample data are repeated until the requested width,
+    # the categorical columns keep their categories and frequencies, the numerical columns are
+    # resampled with multiplicative noise, which keeps the zeros of the sparse columns
+    columns = profile(path)
+    rng = np.random.RandomState(seed)
+
+    for start in range(0, n_rows, chunk_rows):
+
+        size = min(chunk_rows, n_rows - start)
+        chunk = {}
+
+        for j in range(n_columns):
+
+            column = columns[j % len(columns)]
+            name = column["name"] if j < len(columns) else column["name"] + "_" + str(j // len(columns))
+
+            if column["type"] == "categorical":
+
+                chunk[name] = rng.choice(column["values"], size, p=column["probabilities"])
+
+            else:
+
+                x = rng.choice(column["values"], size)
+                chunk[name] = np.round(x * (1 + rng.normal(scale=0.05, size=size))).astype(int)
+
+        yield pd.DataFrame(chunk)
+
+
+def write_dataset(n_rows, n_columns, path, seed=0):
+
+    # the file is written in chunks, so that only the parsing is measured on the whole dataset
+    for j, chunk in enumerate(synthesize(n_rows, n_columns, seed)):
+        chunk.to_csv(path, mode="w" if j == 0 else "a", header=j == 0, index=False)
+
+
+def time_call(function, *args, **kwargs):
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+
+    return time.perf_counter() - start, result
+
+
+def measure(function, *args, **kwargs):
+
+    # wall time and peak growth of the resident memory while running the function; the memory is
+    # sampled by a thread, which sees the native allocations too, e.g. of openTSNE and of the Cython
+    # extensions, and unlike tracing the allocations does not slow down the stage being timed
+    start = pipeline.current_memory()
+
+    if start is None:
+
+        seconds, result = time_call(function, *args, **kwargs)
+
+        return seconds, None, result
+
+    peak = [start]
+    done = threading.Event()
+
+    def sample():
+
+        while not done.wait(MEMORY_INTERVAL):
+            peak[0] = max(peak[0], pipeline.current_memory())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+
+    try:
+
+        seconds, result = time_call(function, *args, **kwargs)
+
+    finally:
+
+        done.set()
+        thread.join()
+
+    return seconds, max(peak[0], pipeline.current_memory()) - start, result
+
+
+def bench_embedding(df):
+
+    results = []
+
+    for method in ["sklearn-tsne", "tsne", "umap"]:
+
+        if df.shape[0] > LIMITS["tsne"]:
+            continue
+
+        try:
+
+            seconds, _ = time_call(embedding.reduce_dimensions, df, method, 2)
+
+        except ImportError as e:
+
+            print("skipping " + method + ": " + str(e))
+
+            continue
+
+        results.append({"benchmark": "embedding", "method": method, "rows": df.shape[0], "seconds": seconds})
+
+    return results
+
+
+def bench_clustering(df):
+
+    results = []
+
+    # cluster the PCA components, as the cluster analysis tab does by default
+    x = embedding.reduce_dimensions(df, "pca", 3).values
+
+    for algorithm in ["kmeans", "minibatch", "birch", "hdbscan"]:
+
+        if df.shape[0] > LIMITS.get(algorithm, df.shape[0]):
+            continue
+
+        seconds, _ = time_call(clustering.fit_clusters, x, algorithm, 3, 50)
+
+        results.append({"benchmark": "clustering", "method": algorithm, "rows": df.shape[0], "seconds": seconds})
+
+    # HDBSCAN as the cluster analysis runs it, on the shared nearest-neighbor graph
+    if df.shape[0] <= LIMITS["hdbscan"]:
+
+        seconds, _ = time_call(clustering.fit_clusters, x, "hdbscan", 3, 50, shared_neighbors=True)
+
+        results.append({"benchmark": "clustering", "method": "hdbscan (shared graph)", "rows": df.shape[0],
+                        "seconds": seconds})
+
+    return results
+
+
+def bench_neighbors(df):
+
+    results = []
+
+    if df.shape[0] > LIMITS["tsne"]:
+        return results
+
+    # the stages of the cluster analysis: T-SNE on the processed data, then HDBSCAN on the T-SNE
+    # components, twice, and on the PCA components, with and without the shared nearest-neighbor
+    # graphs; every variant starts without graphs, the graphs of the application are restored after
+    graphs = neighbors.GRAPHS
+
+    try:
+
+        for shared in [False, True]:
+
+            neighbors.GRAPHS = cache.LRUCache(8)
+
+            def analysis():
+
+                x = pipeline.ReduceStage("tsne", 2, shared_neighbors=shared)(df)
+                y = pipeline.ReduceStage("pca", 3)(df)
+
+                for z in [x, y, x]:
+                    pipeline.ClusterStage("hdbscan", cluster_size=50, min_samples=10, shared_neighbors=shared)(z)
+
+            seconds, _ = time_call(analysis)
+
+            results.append({"benchmark": "neighbors", "method": "shared" if shared else "separate",
+                            "rows": df.shape[0], "seconds": seconds})
+
+    finally:
+
+        neighbors.GRAPHS = graphs
+
+    return results
+
+
+def bench_coreset(df):
+
+    results = []
+
+    x = embedding.reduce_dimensions(df, "pca", 3).values
+
+    # compare the cost of the coreset centers on the full data with a full K-Means fit
+    seconds, (full, _) = time_call(clustering.fit_clusters, x, "kmeans", 8, 2)
+    full_cost = -full.score(x)
+
+    results.append({"benchmark": "coreset", "method": "kmeans", "rows": df.shape[0], "seconds": seconds,
+                    "cost ratio": 1.0})
+
+    for size in [1000, coreset.CORESET_SIZE]:
+
+        seconds, (algo, _) = time_call(clustering.fit_clusters, x, "coreset", 8, 2, coreset_size=size)
+
+        results.append({"benchmark": "coreset", "method": "coreset " + str(size), "rows": df.shape[0],
+                        "seconds": seconds, "cost ratio": -algo.score(x) / full_cost})
+
+    return results
+
+
+def build_histogram(df, n_features=10):
+
+    go = registry.get("plotly")
+
+    # the histograms of the first features, as built by the exploration tab
+    return [go.Figure(data=[go.Histogram(x=list(df.iloc[:, j].values), name=df.columns[j])]).to_dict()
+            for j in range(min(n_features, df.shape[1]))]
+
+
+def build_scatter(x, labels):
+
+    go = registry.get("plotly")
+
+    # the 3-D scatter plot of the clusters, one trace per cluster
+    traces = [go.Scatter3d(x=x[labels == k, 0], y=x[labels == k, 1], z=x[labels == k, 2], mode="markers")
+              for k in np.unique(labels)]
+
+    return go.Figure(data=traces).to_dict()
+
+
+def export_csv(df):
+
+    return sum(len(chunk) for chunk in export.iter_csv(df))
+
+
+def describe(df):
+
+    unique, inverse, counts = compression.compress_rows(df.values)
+
+    return compression.weighted_describe(unique, counts, df.columns)
+
+
+def bench_stages(n_rows, n_columns):
+
+    # every stage of an analysis in the web application, on a synthetic dataset written to a file
+    results = []
+
+    def record(stage, function, *args, **kwargs):
+
+        seconds, memory, result = measure(function, *args, **kwargs)
+
+        results.append({"benchmark": "stages", "method": stage, "rows": n_rows, "columns": n_columns,
+                        "seconds": seconds, "peak memory": memory})
+
+        return result
+
+    def skip(stage):
+
+        results.append({"benchmark": "stages", "method": stage, "rows": n_rows, "columns": n_columns,
+                        "seconds": None, "peak memory": None, "skipped": True})
+
+    # the largest datasets of the grid do not fit in the memory of most machines
+    if COPIES * 8.0 * n_rows * n_columns > governor.physical_memory():
+
+        for stage in ["parse", "clean", "preprocess", "stats", "correlation", "histogram", "pca", "tsne", "kmeans",
+                      "hdbscan", "plot build", "csv export"]:
+            skip(stage)
+
+        return results
+
+    handle, path = tempfile.mkstemp(suffix=".csv")
+    os.close(handle)
+
+    try:
+
+        write_dataset(n_rows, n_columns, path)
+
+        df = record("parse", pipeline.LoadStage(), path, "synthetic.csv")
+
+    finally:
+
+        os.remove(path)
+
+    df = record("clean", pipeline.CleanStage(), df)
+    df = record("preprocess", pipeline.PreprocessStage(), df)
+
+    x = df.drop("index", axis=1)
+
+    record("stats", describe, x)
+    record("correlation", x.corr)
+    record("histogram", build_histogram, x)
+
+    reducer, y = record("pca", embedding.fit_embedding, x, "pca", 3)
+
+    if n_rows <= LIMITS["tsne"]:
+        record("tsne", embedding.fit_embedding, x, "tsne", 2)
+    else:
+        skip("tsne")
+
+    algo, labels = record("kmeans", clustering.fit_clusters, y.values, "kmeans", 8, 2)
+
+    if n_rows <= LIMITS["hdbscan"]:
+        record("hdbscan", clustering.fit_clusters, y.values, "hdbscan", None, 50, shared_neighbors=True)
+    else:
+        skip("hdbscan")
+
+    record("plot build", build_scatter, y.values, labels)
+
+    df.insert(1, "cluster labels", 1 + labels)
+
+    record("csv export", export_csv, df)
+
+    return results
+
+
+def environment():
+
+    # the versions the results were measured with, so that the files can be compared across versions
+    versions = {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__}
+
+    for name in ["sklearn", "openTSNE", "hdbscan", "plotly"]:
+
+        try:
+            versions[name] = registry.import_module(name).__version__
+        except (ImportError, AttributeError):
+            versions[name] = None
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"commit": commit, "machine": platform.machine(), "cpus": os.cpu_count(), "versions": versions}
+
+
+BENCHMARKS = {
+    "embedding": bench_embedding,
+    "clustering": bench_clustering,
+    "neighbors": bench_neighbors,
+    "coreset": bench_coreset,
+}
+
+
+def parse_arguments(argv):
+
+    parser = argparse.ArgumentParser(prog="benchmark")
+
+    parser.add_argument("rows", type=int, nargs="*", help="numbers of rows, by default 10k, 100k, 1M and 10M")
+    parser.add_argument("--columns", type=int, nargs="+",
+                        help="widths of the synthetic datasets of the stages benchmark, by default 15, 150 and 1500")
+    parser.add_argument("--quick", action="store_true",
+                        help="run the small grid of 1k and 10k rows of 15 columns unless sizes are given")
+    parser.add_argument("--suites", nargs="+", default=["stages"] + list(BENCHMARKS),
+                        choices=["stages"] + list(BENCHMARKS))
+    parser.add_argument("--output", help="JSON file the results are written to")
+
+    return parser.parse_args(argv)
+
+
+def main(argv):
+
+    args = parse_arguments(argv)
+
+    rows = args.rows or (QUICK_SIZES if args.quick else SIZES)
+    columns = args.columns or (QUICK_COLUMNS if args.quick else COLUMNS)
+
+    results = []
+
+    for n_rows in rows:
+
+        if "stages" in args.suites:
+
+            for n_columns in columns:
+                results.extend(bench_stages(n_rows, n_columns))
+
+        suites = [name for name in BENCHMARKS if name in args.suites]
+
+        if len(suites) > 0:
+
+            df = make_dataset(n_rows)
+
+            for name in suites:
+                results.extend(BENCHMARKS[name](df))
+
+    print(pd.DataFrame(results).to_string(index=False))
+
+    if args.output is not None:
+
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
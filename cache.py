@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def digest(*parts):
+
+    # identify a dataset version, e.g. the processed data stored in the hidden div,
+    # together with the parameters it was produced with
+    h = hashlib.sha1()
+
+    for part in parts:
+        h.update(repr(part).encode("utf-8") if not isinstance(part, str) else part.encode("utf-8"))
+        h.update(b"\0")
+
+    return h.hexdigest()
+
+
+def digest_array(x):
+
+    # identify a matrix by its content, so that identical matrices produced by
+    # different callbacks share the same cached results
+    x = np.ascontiguousarray(x)
+
+    h = hashlib.sha1()
+    h.update(repr((x.shape, x.dtype.str)).encode("utf-8"))
+    h.update(x.data)
+
+    return h.hexdigest()
+
+
+class LRUCache:
+
+    # thread-safe dictionary that evicts the least recently used entries
+    def __init__(self, max_size):
+
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+
+        with self.lock:
+
+            if key in self.entries:
+
+                self.entries.move_to_end(key)
+
+                return self.entries[key]
+
+            return default
+
+    def set(self, key, value):
+
+        with self.lock:
+
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+
+        with self.lock:
+
+            return key in self.entries
+
+    def __len__(self):
+
+        with self.lock:
+
+            return len(self.entries)
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+from joblib import Parallel, delayed
+
+import cache
+import coreset
+import hdbscan_session
+import registry
+
+####################################################
+# number of rows labelled at once when assigning the
+# rows that were left out of the sample
+CHUNK_SIZE = 50000
+####################################################
+
+####################################################
+# number of parallel workers used for labelling;
+# it can be changed with the CLUSTERING_JOBS
+# environment variable
+N_JOBS = int(os.environ.get("CLUSTERING_JOBS", os.cpu_count() or 1))
+####################################################
+
+####################################################
+# default settings of the streaming engines: the
+# number of rows per mini-batch and the BIRCH
+# threshold, which bounds the size of the CF-tree
+BATCH_SIZE = 10000
+THRESHOLD = 0.5
+BRANCHING_FACTOR = 50
+####################################################
+
+####################################################
+# maximum number of rows used for estimating the
+# silhouette score during the K sweep
+SILHOUETTE_SIZE = 5000
+####################################################
+
+# fitted models of recent runs and sweeps, keyed by the dataset digest and the parameters
+MODELS = cache.LRUCache(64)
+
+# centroids of the last K-Means run of each session, used for warm-starting the next run
+CENTROIDS = cache.LRUCache(256)
+
+
+def last_centroids(session_id, columns):
+
+    entry = CENTROIDS.get(session_id)
+
+    # the centroids can only be reused in the same feature space
+    if entry is not None and entry[0] == list(columns):
+        return entry[1]
+
+
+def keep_centroids(session_id, columns, algo):
+
+    if hasattr(algo, "cluster_centers_"):
+        set_centroids(session_id, columns, algo.cluster_centers_)
+
+
+def set_centroids(session_id, columns, centers):
+
+    # also used by the background jobs, whose worker keeps the centroids for the next jobs of the session
+    if session_id is not None and centers is not None:
+        CENTROIDS.set(session_id, (list(columns), np.asarray(centers)))
+
+
+def iter_batches(x, batch_size):
+
+    # accept either a matrix or an iterable of chunks, e.g. a chunked reader
+    if hasattr(x, "shape"):
+
+        x = np.asarray(x, dtype=np.float64)
+
+        for j in range(0, x.shape[0], batch_size):
+            yield x[j:j + batch_size, :]
+
+    else:
+
+        for chunk in x:
+            yield np.asarray(chunk, dtype=np.float64)
+
+
+def fit_minibatch_kmeans(x, n_clusters, batch_size=BATCH_SIZE, init=None):
+
+    MiniBatchKMeans = registry.get("minibatch")
+
+    if init is not None:
+        algo = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, init=init, n_init=1, random_state=0)
+    else:
+        algo = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=0)
+
+    # a batch smaller than the number of clusters cannot initialize the centers,
+    # so it is carried over to the next batch
+    carry = None
+
+    for batch in iter_batches(x, batch_size):
+
+        if carry is not None:
+            batch = np.vstack([carry, batch])
+            carry = None
+
+        if not hasattr(algo, "cluster_centers_") and batch.shape[0] < n_clusters:
+            carry = batch
+            continue
+
+        algo.partial_fit(batch)
+
+    if carry is not None:
+        algo.partial_fit(carry)
+
+    return algo
+
+
+def fit_birch(x, n_clusters, batch_size=BATCH_SIZE, threshold=THRESHOLD, branching_factor=BRANCHING_FACTOR):
+
+    Birch = registry.get("birch")
+
+    # build the CF-tree in a single pass, one chunk at a time
+    algo = Birch(n_clusters=None, threshold=threshold, branching_factor=branching_factor)
+
+    for batch in iter_batches(x, batch_size):
+        algo.partial_fit(batch)
+
+    # run the global clustering step on the leaf subclusters
+    algo.set_params(n_clusters=min(n_clusters, algo.subcluster_centers_.shape[0]))
+    algo.partial_fit()
+
+    return algo
+
+
+def fit_coreset_kmeans(x, n_clusters, size=coreset.CORESET_SIZE, batch_size=BATCH_SIZE, init=None):
+
+    KMeans = registry.get("kmeans")
+
+    # summarize the data in a single pass and run weighted K-Means on the summary
+    points, weights = coreset.build_coreset(iter_batches(x, batch_size), size)
+
+    if init is not None:
+        algo = KMeans(n_clusters=n_clusters, init=init, n_init=1, random_state=0)
+    else:
+        algo = KMeans(n_clusters=n_clusters, random_state=0)
+
+    return algo.fit(points, sample_weight=weights)
+
+
+def model_key(key, algorithm, num_clusters, cluster_size, batch_size, threshold, prediction_data, min_samples=None,
+              coreset_size=None, shared_neighbors=False, init=None):
+
+    # only the parameters used by the chosen algorithm identify the model; a warm start from other
+    # centroids can converge to other clusters, so the centroids are part of the key
+    init = None if init is None else cache.digest_array(np.asarray(init, dtype=np.float64))
+
+    if algorithm == "kmeans":
+        return key, algorithm, num_clusters, init
+
+    elif algorithm == "minibatch":
+        return key, algorithm, num_clusters, batch_size, init
+
+    elif algorithm == "birch":
+        return key, algorithm, num_clusters, batch_size, threshold
+
+    elif algorithm == "coreset":
+        return key, algorithm, num_clusters, batch_size, coreset_size, init
+
+    return key, algorithm, cluster_size, min_samples, prediction_data, shared_neighbors
+
+
+def fit_clusters(x, algorithm, num_clusters, cluster_size, batch_size=None, threshold=None, prediction_data=False,
+                 key=None, min_samples=None, init=None, coreset_size=None, sample_weight=None, shared_neighbors=False):
+
+    KMeans = registry.get("kmeans")
+
+    n_rows = x.shape[0]
+
+    if batch_size is None or batch_size < 1:
+        batch_size = BATCH_SIZE
+
+    if threshold is None or threshold <= 0:
+        threshold = THRESHOLD
+
+    if coreset_size is None or coreset_size < 1:
+        coreset_size = coreset.CORESET_SIZE
+
+    # fall back to the default settings if the number of clusters or the cluster size is invalid
+    if num_clusters is None or not 0 < num_clusters <= n_rows:
+        num_clusters = 3
+
+    if algorithm == "coreset":
+        num_clusters = min(num_clusters, coreset_size)
+
+    if cluster_size is None or not 1 < cluster_size <= n_rows:
+        cluster_size = 2
+
+    # as in HDBSCAN, min_samples defaults to the minimum cluster size
+    if min_samples is None or not 0 < min_samples <= n_rows:
+        min_samples = cluster_size
+
+    # warm-start from the given centroids only if they match the number of clusters and features
+    if init is not None and np.shape(init) != (num_clusters, x.shape[1]):
+        init = None
+
+    # keep the dataset key for the HDBSCAN session, which is shared by all cluster sizes
+    data_key = key
+
+    # reuse the model of an identical run or of a K sweep on the same dataset
+    if key is not None:
+
+        key = model_key(key, algorithm, num_clusters, cluster_size, batch_size, threshold, prediction_data,
+                        min_samples, coreset_size, shared_neighbors, init)
+        cached = MODELS.get(key)
+
+        if cached is not None:
+            return cached
+
+    if algorithm == "kmeans":
+
+        # a single run from the previous centroids replaces the 10 k-means++ initializations
+        if init is not None:
+            algo = KMeans(n_clusters=num_clusters, init=init, n_init=1, random_state=0)
+        else:
+            algo = KMeans(n_clusters=num_clusters, random_state=0)
+
+        algo.fit(x, sample_weight=sample_weight)
+
+        labels = algo.labels_
+
+    elif algorithm == "minibatch":
+
+        algo = fit_minibatch_kmeans(x, num_clusters, batch_size, init)
+        labels = assign_labels(algo, x)[0]
+
+    elif algorithm == "birch":
+
+        algo = fit_birch(x, num_clusters, batch_size, threshold)
+        labels = assign_labels(algo, x)[0]
+
+    elif algorithm == "coreset":
+
+        algo = fit_coreset_kmeans(x, num_clusters, coreset_size, batch_size, init)
+        labels = assign_labels(algo, x)[0]
+
+    elif algorithm == "hdbscan":
+
+        # the tree is built on the shared nearest-neighbor graph of the matrix if requested
+        session = hdbscan_session.get_session(x, min_samples, key=data_key, shared_neighbors=shared_neighbors)
+        algo, labels = session.extract(cluster_size, prediction_data)
+
+    if key is not None:
+        MODELS.set(key, (algo, labels))
+
+    return algo, labels
+
+
+def fit_kmeans_k(x, k, silhouette_size, unique=None, inverse=None, counts=None):
+
+    KMeans = registry.get("kmeans")
+    silhouette_score = registry.get("silhouette")
+
+    # fit on the unique rows weighted by their multiplicities if the matrix was compressed
+    if unique is not None:
+
+        algo = KMeans(n_clusters=k, random_state=0).fit(unique, sample_weight=counts)
+        labels = algo.labels_[inverse]
+
+    else:
+
+        algo = KMeans(n_clusters=k, random_state=0).fit(x)
+        labels = algo.labels_
+
+    # estimate the silhouette on a sample, the exact score is quadratic in the number of rows
+    if 1 < len(np.unique(labels)) < x.shape[0]:
+        silhouette = silhouette_score(x, labels, sample_size=min(silhouette_size, x.shape[0]), random_state=0)
+    else:
+        silhouette = np.nan
+
+    return algo, algo.inertia_, silhouette
+
+
+def sweep_kmeans(x, k_values, key=None, n_jobs=None, silhouette_size=SILHOUETTE_SIZE, compress=False):
+
+    import compression
+
+    if n_jobs is None:
+        n_jobs = N_JOBS
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+
+    if compress:
+        unique, inverse, counts = compression.compress_rows(x)
+    else:
+        unique, inverse, counts = None, None, None
+
+    n_rows = x.shape[0] if unique is None else unique.shape[0]
+    k_values = [k for k in k_values if 0 < k <= n_rows]
+
+    # the worker processes attach to a single memory-mapped copy of the matrix
+    # instead of receiving one pickled copy each
+    fits = Parallel(n_jobs=n_jobs, max_nbytes="1M")(delayed(fit_kmeans_k)(x, k, silhouette_size, unique, inverse, counts)
+                                                    for k in k_values)
+
+    results = []
+
+    for k, (algo, inertia, silhouette) in zip(k_values, fits):
+
+        # cache the models so that picking one of them in the cluster analysis is instant
+        if key is not None:
+            MODELS.set(model_key(key, "kmeans", k, None, None, None, False), (algo, algo.labels_))
+
+        results.append({"k": k, "inertia": inertia, "silhouette": silhouette})
+
+    return results
+
+
+def nearest_centroid(centers, x):
+
+    # squared euclidean distances expanded as |x|^2 - 2 x.c + |c|^2,
+    # the |x|^2 term is constant per row and does not change the argmin
+    distances = (centers ** 2).sum(axis=1) - 2 * x.dot(centers.T)
+
+    return np.argmin(distances, axis=1)
+
+
+def predict_chunk(algo, x):
+
+    return algo.predict(x)
+
+
+def hdbscan_chunk(algo, x):
+
+    hdbscan = registry.get("hdbscan")
+
+    return hdbscan.approximate_predict(algo, x)
+
+
+def assign_labels(algo, x, chunk_size=CHUNK_SIZE, n_jobs=None):
+
+    if n_jobs is None:
+        n_jobs = N_JOBS
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+
+    if x.shape[0] == 0:
+        return np.empty(0, dtype=int), np.empty(0)
+
+    chunks = [x[j:j + chunk_size, :] for j in range(0, x.shape[0], chunk_size)]
+
+    if hasattr(algo, "cluster_centers_"):
+
+        # the matrix products release the GIL, so threads are enough
+        centers = np.asarray(algo.cluster_centers_, dtype=np.float64)
+        labels = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(nearest_centroid)(centers, z) for z in chunks)
+
+        labels = np.concatenate(labels)
+        strengths = np.ones(labels.shape[0])
+
+    elif hasattr(algo, "predict"):
+
+        labels = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(predict_chunk)(algo, z) for z in chunks)
+
+        labels = np.concatenate(labels)
+        strengths = np.ones(labels.shape[0])
+
+    else:
+
+        # HDBSCAN must be fitted with prediction_data=True; the model with its prediction data would be
+        # pickled for every chunk sent to a process, the threads share it
+        results = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(hdbscan_chunk)(algo, z) for z in chunks)
+
+        labels = np.concatenate([z[0] for z in results])
+        strengths = np.concatenate([z[1] for z in results])
+
+    return labels, strengths
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+# compressed matrices of recent datasets, keyed by the digest of the matrix
+COMPRESSED = cache.LRUCache(8)
+
+
+def compress_rows(x):
+
+    # collapse identical rows into unique rows with their multiplicities; the inverse
+    # maps every original row to its unique row, so that results can be broadcast back
+    x = np.ascontiguousarray(x, dtype=np.float64)
+
+    key = cache.digest_array(x)
+    cached = COMPRESSED.get(key)
+
+    if cached is not None:
+        return cached
+
+    if x.shape[0] == 0:
+        compressed = (x, np.empty(0, dtype=int), np.empty(0, dtype=int))
+
+    else:
+        unique, inverse, counts = np.unique(x, axis=0, return_inverse=True, return_counts=True)
+        compressed = (unique, inverse.ravel(), counts)
+
+    COMPRESSED.set(key, compressed)
+
+    return compressed
+
+
+def weighted_quantile(values, counts, q):
+
+    # same linear interpolation as pandas on the expanded data, without expanding it
+    order = np.argsort(values, kind="mergesort")
+    values, counts = values[order], counts[order]
+
+    ends = np.cumsum(counts) - 1
+    position = q * (counts.sum() - 1)
+
+    lower = values[np.searchsorted(ends, np.floor(position))]
+    upper = values[np.searchsorted(ends, np.ceil(position))]
+
+    return lower + (upper - lower) * (position - np.floor(position))
+
+
+def weighted_describe(unique, counts, columns):
+
+    # equivalent of DataFrame.describe on the original rows
+    n = counts.sum()
+
+    mean = np.average(unique, axis=0, weights=counts)
+    variance = (counts[:, None] * (unique - mean) ** 2).sum(axis=0) / (n - 1) if n > 1 else np.full(len(columns), np.nan)
+
+    stats = pd.DataFrame(index=columns)
+    stats["count"] = float(n)
+    stats["mean"] = mean
+    stats["std"] = np.sqrt(variance)
+    stats["min"] = unique.min(axis=0)
+
+    for q, name in [(0.25, "25%"), (0.5, "50%"), (0.75, "75%")]:
+        stats[name] = [weighted_quantile(unique[:, j], counts, q) for j in range(unique.shape[1])]
+
+    stats["max"] = unique.max(axis=0)
+
+    return stats
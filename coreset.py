@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+####################################################
+# default number of weighted points in a coreset
+CORESET_SIZE = 5000
+####################################################
+
+
+def lightweight_coreset(x, size, weights=None, random_state=None):
+
+    # importance sampling with the lightweight coreset sensitivities: half uniform,
+    # half proportional to the squared distance from the (weighted) mean, which
+    # keeps points of small, distant clusters in the summary
+    rng = np.random.RandomState(random_state) if not isinstance(random_state, np.random.RandomState) else random_state
+
+    if weights is None:
+        weights = np.ones(x.shape[0])
+
+    mean = np.average(x, axis=0, weights=weights)
+    distances = ((x - mean) ** 2).sum(axis=1)
+
+    total = (weights * distances).sum()
+
+    if total > 0:
+        q = 0.5 * weights / weights.sum() + 0.5 * weights * distances / total
+    else:
+        q = weights / weights.sum()
+
+    sample = rng.choice(x.shape[0], size=size, replace=True, p=q)
+
+    # the weights make the coreset an unbiased estimate of the clustering cost
+    return x[sample, :], weights[sample] / (size * q[sample])
+
+
+def build_coreset(chunks, size=CORESET_SIZE, random_state=0):
+
+    rng = np.random.RandomState(random_state)
+
+    points = []
+    weights = []
+    n_points = 0
+
+    # merge and reduce: summarize every chunk as it streams by, and reduce the
+    # merged summaries again whenever they grow beyond twice the coreset size
+    for chunk in chunks:
+
+        chunk = np.asarray(chunk, dtype=np.float64)
+
+        if chunk.shape[0] > size:
+            chunk, chunk_weights = lightweight_coreset(chunk, size, random_state=rng)
+        else:
+            chunk_weights = np.ones(chunk.shape[0])
+
+        points.append(chunk)
+        weights.append(chunk_weights)
+        n_points += chunk.shape[0]
+
+        if n_points > 2 * size:
+
+            merged, merged_weights = lightweight_coreset(np.vstack(points), size, np.concatenate(weights), rng)
+
+            points, weights, n_points = [merged], [merged_weights], size
+
+    if n_points == 0:
+        return np.empty((0, 0)), np.empty(0)
+
+    points, weights = np.vstack(points), np.concatenate(weights)
+
+    if n_points > size:
+        points, weights = lightweight_coreset(points, size, weights, rng)
+
+    return points, weights
+
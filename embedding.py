@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import cache
+import neighbors
+import registry
+import singleflight
+
+####################################################
+# number of threads used by the embedding engines;
+# it can be changed with the EMBEDDING_THREADS
+# environment variable
+N_JOBS = int(os.environ.get("EMBEDDING_THREADS", os.cpu_count() or 1))
+####################################################
+
+####################################################
+# number of rows projected at once when transforming
+# the rows that were left out of the sample
+CHUNK_SIZE = 50000
+####################################################
+
+# perplexity of the T-SNE affinities, which need three times as many neighbors
+PERPLEXITY = 30
+
+# fitted reductions of recent datasets, keyed by the dataset digest and the parameters
+RESULTS = cache.LRUCache(16)
+
+
+def pca_embedding(x, n_components, n_jobs, shared_neighbors=False):
+
+    PCA = registry.get("pca")
+
+    pca = PCA(n_components=n_components, random_state=0).fit(x)
+
+    return pca, pca.transform(x)
+
+
+def sklearn_tsne_embedding(x, n_components, n_jobs, shared_neighbors=False):
+
+    # original single-threaded implementation, kept as the benchmark baseline;
+    # it cannot project new rows, so no model is returned
+    TSNE = registry.get("sklearn-tsne")
+
+    return None, TSNE(n_components=n_components, random_state=0).fit_transform(x)
+
+
+def fast_tsne_embedding(x, n_components, n_jobs, shared_neighbors=False):
+
+    try:
+
+        TSNE = registry.get("tsne")
+
+    except ImportError:
+
+        warnings.warn("openTSNE is not installed, falling back to the scikit-learn T-SNE.")
+
+        return sklearn_tsne_embedding(x, n_components, n_jobs)
+
+    # the FFT-accelerated gradient only supports up to 2 components,
+    # use multi-threaded Barnes-Hut for 3-D embeddings
+    if n_components <= 2:
+        negative_gradient_method = "fft"
+    else:
+        negative_gradient_method = "bh"
+
+    # approximate nearest neighbors replace the exact neighbor search
+    tsne = TSNE(n_components=n_components, perplexity=PERPLEXITY, neighbors="approx",
+                negative_gradient_method=negative_gradient_method, n_jobs=n_jobs, random_state=0)
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+
+    if shared_neighbors:
+
+        affinity = registry.get("tsne-affinity")
+
+        # compute the perplexity-based affinities from the shared nearest-neighbor graph;
+        # precomputed affinities cannot place new points, so no model is returned
+        graph = neighbors.get_graph(x, 3 * PERPLEXITY)
+        P = affinity.joint_probabilities_nn(graph.indices, graph.distances, [PERPLEXITY], symmetrize=True,
+                                            n_jobs=n_jobs)
+
+        fitted = tsne.fit(x, affinities=affinity.PrecomputedAffinities(P, normalize=False))
+
+        return None, np.asarray(fitted)
+
+    fitted = tsne.fit(x)
+
+    return fitted, np.asarray(fitted)
+
+
+def umap_embedding(x, n_components, n_jobs, shared_neighbors=False):
+
+    umap = registry.get("umap")
+
+    # a fixed random state forces UMAP to run single-threaded,
+    # so it is only used when a single thread is requested
+    if n_jobs == 1:
+        reducer = umap.UMAP(n_components=n_components, random_state=0)
+    else:
+        reducer = umap.UMAP(n_components=n_components, n_jobs=n_jobs)
+
+    return reducer, reducer.fit_transform(x)
+
+
+# available embedding engines and the maximum number of components they support
+ENGINES = {
+    "pca": (pca_embedding, None),
+    "tsne": (fast_tsne_embedding, 3),
+    "sklearn-tsne": (sklearn_tsne_embedding, 3),
+    "umap": (umap_embedding, None),
+}
+
+
+def fit_embedding(df, method, n_components, n_jobs=None, key=None, shared_neighbors=False):
+
+    if n_jobs is None:
+        n_jobs = N_JOBS
+
+    engine, max_components = ENGINES[method]
+
+    if max_components is None:
+        max_components = df.shape[1]
+
+    # fall back to 3 components if the number of components is invalid
+    if n_components is None or not 0 < n_components <= max_components:
+        n_components = 3
+
+    # reuse the result of an identical run on the same dataset
+    if key is not None:
+
+        cached = RESULTS.get((key, method, n_components, shared_neighbors))
+
+        if cached is not None:
+            return cached[0], cached[1].copy()
+
+    if key is not None:
+
+        # concurrent identical runs, e.g. from several sessions on the same data, share one fit
+        model, x = singleflight.call("embedding", key, (method, n_components, shared_neighbors), engine, df,
+                                     int(n_components), n_jobs, shared_neighbors)
+
+    else:
+
+        model, x = engine(df, int(n_components), n_jobs, shared_neighbors)
+
+    # the fitted coordinates may be shared with concurrent callers, so every caller gets a copy
+    x = pd.DataFrame(data=np.array(x, dtype=np.float64),
+                     columns=["Component " + str(j) for j in range(1, n_components + 1)])
+
+    if key is not None:
+        RESULTS.set((key, method, n_components, shared_neighbors), (model, x.copy()))
+
+    return model, x
+
+
+def reduce_dimensions(df, method, n_components, n_jobs=None, shared_neighbors=False):
+
+    return fit_embedding(df, method, n_components, n_jobs, shared_neighbors=shared_neighbors)[1]
+
+
+def transform_embedding(model, df, chunk_size=CHUNK_SIZE):
+
+    if model is None:
+        raise ValueError("The selected dimension reduction does not support projecting new rows.")
+
+    x = np.ascontiguousarray(df, dtype=np.float64)
+
+    # project the rows in chunks to bound the memory used by the transform
+    chunks = [np.asarray(model.transform(x[j:j + chunk_size, :])) for j in range(0, x.shape[0], chunk_size)]
+
+    if len(chunks) == 0:
+        return np.empty((0, 0))
+
+    return np.vstack(chunks)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import importlib.util
+import os
+import pickle
+import re
+import uuid
+import zlib
+
+import flask
+
+import shared_data
+
+####################################################
+# number of rows serialized at once while streaming
+# a download
+CHUNK_ROWS = 50000
+####################################################
+
+# mime types of the supported download formats, by file extension
+FORMATS = {"csv": "text/csv", "csv.gz": "application/gzip", "parquet": "application/octet-stream"}
+
+# number of clustering results kept on the server for download
+MAX_RESULTS = 32
+
+
+def result_path(result_id):
+
+    return os.path.join(shared_data.SHARED_DIR, "results", result_id + ".pkl")
+
+
+def store_result(df, result_id=None):
+
+    # the results are kept in files, by result id or by the id of the job, so that the download can be
+    # served by any server worker
+    if result_id is None:
+        result_id = uuid.uuid4().hex
+
+    path = result_path(result_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    shared_data.write_atomic(path, lambda f: pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    # forget the oldest results
+    paths = []
+
+    for other_path in glob.glob(os.path.join(os.path.dirname(path), "*.pkl")):
+
+        try:
+            paths.append((os.path.getmtime(other_path), other_path))
+        except OSError:
+            pass
+
+    for mtime, other_path in sorted(paths)[:max(0, len(paths) - MAX_RESULTS)]:
+
+        try:
+            os.remove(other_path)
+        except OSError:
+            pass
+
+    return result_id
+
+
+def load_result(result_id):
+
+    # the ids come from the download links, so anything but an id is not looked up
+    if re.fullmatch("[0-9a-f]{32}", result_id) is None:
+        return None
+
+    try:
+
+        with open(result_path(result_id), "rb") as f:
+            return pickle.load(f)
+
+    except OSError:
+
+        return None
+
+
+def iter_csv(df, chunk_rows=CHUNK_ROWS):
+
+    # the header is written with the first chunk, an empty table still gets its header
+    for j in range(0, max(df.shape[0], 1), chunk_rows):
+        yield df.iloc[j:j + chunk_rows].to_csv(index=False, header=j == 0).encode("utf-8")
+
+
+def iter_gzip(chunks):
+
+    # a gzip container around the deflate stream, compressed as the chunks arrive
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+class StreamSink:
+
+    # write-only file which keeps the position in the whole stream, as required by the
+    # parquet footer, but only holds the bytes which have not been sent yet
+    def __init__(self):
+
+        self.buffer = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+
+        data = bytes(data)
+
+        self.buffer.append(data)
+        self.position += len(data)
+
+        return len(data)
+
+    def tell(self):
+
+        return self.position
+
+    def flush(self):
+
+        pass
+
+    def close(self):
+
+        self.closed = True
+
+    def writable(self):
+
+        return True
+
+    def seekable(self):
+
+        return False
+
+    def drain(self):
+
+        data = b"".join(self.buffer)
+        self.buffer = []
+
+        return data
+
+
+def iter_parquet(df, chunk_rows=CHUNK_ROWS):
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = StreamSink()
+    writer = None
+
+    # one row group per chunk, sent as soon as it is written
+    for j in range(0, max(df.shape[0], 1), chunk_rows):
+
+        if writer is None:
+
+            table = pa.Table.from_pandas(df.iloc[j:j + chunk_rows], preserve_index=False)
+            writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), table.schema)
+
+        else:
+
+            table = pa.Table.from_pandas(df.iloc[j:j + chunk_rows], schema=writer.schema, preserve_index=False)
+
+        writer.write_table(table)
+
+        yield sink.drain()
+
+    writer.close()
+
+    yield sink.drain()
+
+
+def stream(df, fmt, file_name, chunk_rows=CHUNK_ROWS):
+
+    if fmt not in FORMATS:
+        flask.abort(404)
+
+    if fmt == "csv":
+
+        chunks = iter_csv(df, chunk_rows)
+
+    elif fmt == "csv.gz":
+
+        chunks = iter_gzip(iter_csv(df, chunk_rows))
+
+    else:
+
+        if importlib.util.find_spec("pyarrow") is None:
+            flask.abort(501, "Parquet downloads require pyarrow.")
+
+        chunks = iter_parquet(df, chunk_rows)
+
+    # the file is generated while it is sent, so it is never held in memory as a whole
+    return flask.Response(chunks, mimetype=FORMATS[fmt],
+                          headers={"Content-Disposition": "attachment; filename=" + file_name + "." + fmt})
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import shared_data
+
+# number of (session, output) pairs whose latest generation is kept
+MAX_ENTRIES = 1024
+
+
+def entry(session_id, output):
+
+    return str(session_id) + "/" + output
+
+
+def begin(session_id, output):
+
+    # register a new request, which supersedes the running requests for the same output; the generations
+    # are shared by the server workers, since a request and the next one may land on different workers
+    with shared_data.locked_state("generations") as state:
+
+        # generations increase across all sessions, so that a generation is never reused
+        generation = state.get("counter", 0) + 1
+        state["counter"] = generation
+
+        latest = state.setdefault("latest", {})
+        latest.pop(entry(session_id, output), None)
+        latest[entry(session_id, output)] = generation
+
+        # forget the pairs which began the longest time ago
+        for key in list(latest)[:max(0, len(latest) - MAX_ENTRIES)]:
+            del latest[key]
+
+    return generation
+
+
+def is_current(session_id, output, generation):
+
+    # a request whose entry was forgotten is kept, since nothing newer is known
+    latest = shared_data.read_state("generations").get("latest", {})
+
+    return latest.get(entry(session_id, output), generation) == generation
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import shared_data
+
+
+def physical_memory():
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return 8 * 1024 ** 3
+
+
+####################################################
+# threads and memory available to the whole server
+TOTAL_THREADS = int(os.environ.get("GOVERNOR_THREADS", os.cpu_count() or 1))
+TOTAL_MEMORY = int(os.environ.get("GOVERNOR_MEMORY", 0.75 * physical_memory()))
+####################################################
+
+####################################################
+# quotas of a single session; by default a session
+# can use half of the threads and a third of the
+# memory of the server
+SESSION_THREADS = int(os.environ.get("GOVERNOR_SESSION_THREADS", max(1, TOTAL_THREADS // 2)))
+SESSION_MEMORY = int(os.environ.get("GOVERNOR_SESSION_MEMORY", TOTAL_MEMORY // 3))
+####################################################
+
+####################################################
+# seconds a synchronous request waits for resources
+# before it is rejected
+QUEUE_TIMEOUT = 30
+####################################################
+
+# seconds between two checks of a request waiting for resources freed by another server worker
+POLL_INTERVAL = 0.1
+
+# seconds between two checks of the memory used by a job
+MEMORY_INTERVAL = 0.5
+
+# number of neighbors stored per row by the neighbor-based reductions
+N_NEIGHBORS = 90
+
+# algorithms which use all the threads they are given
+PARALLEL = ["tsne", "sklearn-tsne", "umap", "kmeans", "hdbscan"]
+
+
+def format_bytes(n_bytes):
+
+    for unit in ["B", "KB", "MB", "GB"]:
+
+        if n_bytes < 1024:
+            return "{:.0f} {}".format(n_bytes, unit)
+
+        n_bytes /= 1024
+
+    return "{:.1f} TB".format(n_bytes)
+
+
+def estimate_cost(n_rows, n_columns, dimension_reduction=None, n_components=None, algorithm=None, num_clusters=None,
+                  min_samples=None, batch_size=None, coreset_size=None, projected_rows=0):
+
+    # rough peak memory in bytes, from the shape of the data and the chosen algorithms
+    n_components = n_components or 3
+    num_clusters = num_clusters or 8
+    min_samples = min_samples or 5
+
+    # the data, its working copy and the labeled results
+    memory = 3 * 8.0 * (n_rows + projected_rows) * n_columns
+    threads = 1
+
+    if dimension_reduction == "pca":
+
+        memory += 8.0 * n_rows * n_components + 8.0 * n_columns ** 2
+
+    elif dimension_reduction in ["tsne", "sklearn-tsne", "umap"]:
+
+        # neighbor graph, symmetric affinities and the optimized coordinates
+        memory += 3 * 16.0 * n_rows * N_NEIGHBORS + 4 * 8.0 * n_rows * n_components
+
+    if dimension_reduction in PARALLEL or algorithm in PARALLEL:
+        threads = SESSION_THREADS
+
+    n_features = n_components if dimension_reduction in ["pca", "tsne", "sklearn-tsne", "umap"] else n_columns
+
+    if algorithm == "kmeans":
+
+        # distances of every row to every centroid
+        memory += 8.0 * n_rows * num_clusters
+
+    elif algorithm == "minibatch":
+
+        memory += 8.0 * (batch_size or 10000) * (num_clusters + n_features)
+
+    elif algorithm == "birch":
+
+        # the CF-tree holds at most one subcluster per row
+        memory += 8.0 * n_rows * n_features
+
+    elif algorithm == "coreset":
+
+        memory += 8.0 * (coreset_size or 5000) * (num_clusters + n_features)
+
+    elif algorithm == "hdbscan":
+
+        # neighbors and core distances, minimum spanning tree, single-linkage and condensed trees
+        memory += 16.0 * n_rows * min_samples + 4 * 24.0 * n_rows
+
+    # the projected rows are reduced and assigned in chunks
+    if projected_rows > 0:
+        memory += 8.0 * min(projected_rows, 50000) * (n_columns + n_components)
+
+    return {"rows": n_rows, "columns": n_columns, "threads": threads, "memory": int(memory)}
+
+
+class Governor:
+
+    # admission control: a request runs only if its estimated threads and memory fit both the
+    # quota of its session and the free capacity of the server, otherwise it waits or is rejected;
+    # the granted resources are kept in a state file shared by the server workers, with the process
+    # holding them, so that the grants of a worker which exited are dropped
+    def __init__(self, total_threads=TOTAL_THREADS, total_memory=TOTAL_MEMORY, session_threads=SESSION_THREADS,
+                 session_memory=SESSION_MEMORY, name="governor"):
+
+        self.total_threads = total_threads
+        self.total_memory = total_memory
+        self.session_threads = min(session_threads, total_threads)
+        self.session_memory = min(session_memory, total_memory)
+        self.name = name
+
+        # wakes up the requests waiting in this process when a grant is released
+        self.condition = threading.Condition()
+
+    def grant(self, estimate):
+
+        return {"threads": max(1, min(estimate["threads"], self.session_threads)), "memory": estimate["memory"]}
+
+    def check(self, estimate):
+
+        # requests which can never fit are rejected right away
+        if estimate["memory"] > self.session_memory:
+
+            return ("The analysis of {} rows and {} columns needs about {} of memory, more than the {} available to "
+                    "a session. Reduce the sample size or the number of components, or choose a lighter "
+                    "algorithm.").format(estimate["rows"], estimate["columns"], format_bytes(estimate["memory"]),
+                                         format_bytes(self.session_memory))
+
+    @contextmanager
+    def holders(self):
+
+        with shared_data.locked_state(self.name) as state:
+
+            holders = state.setdefault("holders", [])
+            holders[:] = [x for x in holders if shared_data.is_alive(x["pid"])]
+
+            yield holders
+
+    def fits(self, holders, session_id, grant):
+
+        threads = sum(x["threads"] for x in holders if x["session"] == session_id)
+        memory = sum(x["memory"] for x in holders if x["session"] == session_id)
+
+        total_threads = sum(x["threads"] for x in holders)
+        total_memory = sum(x["memory"] for x in holders)
+
+        return (threads + grant["threads"] <= self.session_threads and memory + grant["memory"] <= self.session_memory
+                and total_threads + grant["threads"] <= self.total_threads
+                and total_memory + grant["memory"] <= self.total_memory)
+
+    def try_acquire(self, session_id, grant):
+
+        with self.holders() as holders:
+
+            if not self.fits(holders, session_id, grant):
+                return False
+
+            holders.append({"session": session_id, "pid": os.getpid(), "threads": grant["threads"],
+                            "memory": grant["memory"]})
+
+            return True
+
+    def acquire(self, session_id, grant, timeout=QUEUE_TIMEOUT):
+
+        # wait in the queue until the request fits, or give up after the timeout; the grants released
+        # by the other server workers are only seen by polling
+        deadline = time.time() + timeout
+
+        while not self.try_acquire(session_id, grant):
+
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                return False
+
+            with self.condition:
+                self.condition.wait(min(remaining, POLL_INTERVAL))
+
+        return True
+
+    def release(self, session_id, grant):
+
+        with self.holders() as holders:
+
+            for j, x in enumerate(holders):
+
+                if (x["session"] == session_id and x["pid"] == os.getpid() and x["threads"] == grant["threads"]
+                        and x["memory"] == grant["memory"]):
+
+                    del holders[j]
+
+                    break
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def utilization(self):
+
+        with self.holders() as holders:
+
+            sessions = {}
+
+            for x in holders:
+
+                threads, memory, requests = sessions.get(str(x["session"]), (0, 0, 0))
+                sessions[str(x["session"])] = (threads + x["threads"], memory + x["memory"], requests + 1)
+
+            threads = sum(x["threads"] for x in holders)
+            memory = sum(x["memory"] for x in holders)
+
+            return {"threads": {"used": threads, "total": self.total_threads, "session_quota": self.session_threads},
+                    "memory": {"used": memory, "total": self.total_memory, "session_quota": self.session_memory},
+                    "sessions": {session_id: {"threads": x[0], "memory": x[1], "requests": x[2]}
+                                 for session_id, x in sessions.items()}}
+
+
+GOVERNOR = Governor()
+
+
+class SharedLimits:
+
+    # the BLAS pools are process-wide and shared by the request threads, so they stay limited, to the
+    # largest grant among the running requests, until the last of them leaves and the original limits
+    # are restored; restoring in the order of entry would leave the limit of an earlier request behind
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.holders = []
+        self.original = None
+
+    def apply(self):
+
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            return
+
+        limits = threadpool_limits(limits=max(self.holders))
+
+        # only the first limits hold the original ones
+        if self.original is None:
+            self.original = limits
+
+    def enter(self, threads):
+
+        with self.lock:
+
+            self.holders.append(threads)
+            self.apply()
+
+    def leave(self, threads):
+
+        with self.lock:
+
+            self.holders.remove(threads)
+
+            if len(self.holders) > 0:
+
+                self.apply()
+
+            elif self.original is not None:
+
+                self.original.restore_original_limits()
+                self.original = None
+
+
+LIMITS = SharedLimits()
+
+
+def limit_threads(threads):
+
+    # only used in job workers, which run a single job at a time, so the limits can be process-wide
+    # and are set again by every job; the environment is inherited by the processes the job starts
+    for name in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[name] = str(threads)
+
+    try:
+
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(limits=threads)
+
+    except ImportError:
+
+        pass
+
+    import clustering
+    import embedding
+    import neighbors
+
+    clustering.N_JOBS = embedding.N_JOBS = neighbors.N_JOBS = threads
+
+
+def watch_memory(limit, stopped, interval=MEMORY_INTERVAL):
+
+    # the memory of a job is only estimated when it is admitted, so the worker is stopped if the job
+    # grows beyond the memory quota of a session; what the worker held before the job is not counted
+    import jobs
+    import pipeline
+
+    baseline = pipeline.current_memory()
+
+    if baseline is None:
+        return
+
+    while not stopped.wait(interval):
+
+        used = pipeline.current_memory() - baseline
+
+        if used > limit:
+
+            jobs.abort(("The analysis used {} of memory, more than the {} available to a session, and was "
+                        "stopped. Reduce the sample size or the number of components, or choose a lighter "
+                        "algorithm.").format(format_bytes(used), format_bytes(limit)))
+
+            return
+
+
+def run_limited(threads, fn, *args):
+
+    limit_threads(threads)
+
+    stopped = threading.Event()
+    watchdog = threading.Thread(target=watch_memory, args=(GOVERNOR.session_memory, stopped), daemon=True)
+    watchdog.start()
+
+    try:
+
+        return fn(*args)
+
+    finally:
+
+        stopped.set()
+
+
+@contextmanager
+def governed(session_id, estimate, timeout=QUEUE_TIMEOUT):
+
+    # synchronous requests wait for their resources in the server and raise if they do not get them; their
+    # memory is shared with the server, so it is only checked against the estimate when they are admitted
+    message = GOVERNOR.check(estimate)
+
+    if message is not None:
+        raise RuntimeError(message)
+
+    grant = GOVERNOR.grant(estimate)
+
+    if not GOVERNOR.acquire(session_id, grant, timeout):
+        raise RuntimeError("The server is busy. Try again in a few moments.")
+
+    LIMITS.enter(grant["threads"])
+
+    try:
+
+        yield grant
+
+    finally:
+
+        LIMITS.leave(grant["threads"])
+        GOVERNOR.release(session_id, grant)
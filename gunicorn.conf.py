@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+# usage: gunicorn -c gunicorn.conf.py application:application
+
+import os
+
+import registry
+
+bind = os.environ.get("BIND", "0.0.0.0:8080")
+
+# the state the requests of a session share, i.e. the status of the jobs, the results to download, the
+# callback generations and the admission counters of the governor, is kept in the shared directory,
+# so a poll or a download can land on any worker
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("THREADS", 4))
+timeout = 120
+
+# load the application once in the master process and fork the workers from it, so that
+# they start without importing anything and share the memory of the imported modules
+preload_app = os.environ.get("PRELOAD", "1") == "1"
+
+
+def on_starting(server):
+
+    # the algorithm modules are otherwise imported by every worker on first use
+    if preload_app:
+        registry.preload()
+
+
+def when_ready(server):
+
+    server.log.info(registry.format_report())
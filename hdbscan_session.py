@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import scipy.sparse
+
+import cache
+import neighbors
+import registry
+import singleflight
+
+####################################################
+# minimum number of neighbors of the graph the tree
+# is built on; the spanning tree only has the edges
+# of the graph, so it needs more neighbors than the
+# core distances
+GRAPH_NEIGHBORS = 30
+####################################################
+
+# HDBSCAN sessions of recent datasets, keyed by the dataset digest, min_samples, metric and graph use
+SESSIONS = cache.LRUCache(8)
+
+
+def graph_linkage_tree(graph, min_samples):
+
+    minimum_spanning_tree = registry.get("minimum-spanning-tree")
+    linkage = registry.get("hdbscan-linkage")
+
+    # the neighbors are sorted, so the core distance is the distance to the min_samples-th of them
+    core_distances = graph.distances[:, min(min_samples, graph.k) - 1]
+
+    # mutual reachability distances on the edges of the graph
+    edges = graph.to_csr().tocoo()
+    distances = np.maximum(np.maximum(core_distances[edges.row], core_distances[edges.col]), edges.data)
+
+    # the sparse spanning tree takes the zero distances of duplicated rows for missing edges, so they
+    # are raised below the smallest distance, which keeps the order of the merges
+    positive = distances[distances > 0]
+    distances[distances == 0] = positive.min() / 2 if positive.size > 0 else 1.0
+
+    tree = minimum_spanning_tree(scipy.sparse.csr_matrix((distances, (edges.row, edges.col)), shape=edges.shape))
+    tree = tree.tocoo()
+
+    # the edges sorted by distance, in the format of the single-linkage tree of HDBSCAN
+    edges = np.vstack([tree.row, tree.col, tree.data]).T.astype(np.float64)
+
+    return linkage.label(edges[np.argsort(edges[:, 2], kind="mergesort")])
+
+
+class HDBSCANSession:
+
+    # the core distances, the minimum spanning tree and the single-linkage tree only
+    # depend on min_samples and the metric, so they are computed once per session and
+    # only the condensed tree is rebuilt for each min_cluster_size; with shared_neighbors
+    # the tree is built on the shared nearest-neighbor graph, whose spanning tree only
+    # approximates the exact one, as the graph lacks the edges between distant rows
+    def __init__(self, x, min_samples, metric="euclidean", shared_neighbors=False):
+
+        hdbscan = registry.get("hdbscan")
+
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.min_samples = min_samples
+        self.metric = metric
+
+        # min_cluster_size does not affect the single-linkage tree
+        self.single_linkage_tree = None
+        self.min_spanning_tree = None
+        self.metric_kwargs = {}
+
+        if shared_neighbors and metric == "euclidean" and self.x.shape[0] > 1:
+
+            # the graph must be connected, otherwise the exact tree is built
+            graph = neighbors.get_graph(self.x, max(min_samples, GRAPH_NEIGHBORS))
+
+            if graph.is_connected():
+                self.single_linkage_tree = graph_linkage_tree(graph, min_samples)
+
+        # whether the tree was built on the graph
+        self.shared_neighbors = self.single_linkage_tree is not None
+
+        if self.single_linkage_tree is None:
+
+            base = hdbscan.HDBSCAN(min_cluster_size=2, min_samples=min_samples, metric=metric).fit(self.x)
+
+            self.single_linkage_tree = base._single_linkage_tree
+            self.min_spanning_tree = base._min_spanning_tree
+
+        # flat clusterings by min_cluster_size, shared by the callbacks which use the session at the same time
+        self.models = cache.LRUCache(64)
+
+    def extract(self, min_cluster_size, prediction_data=False):
+
+        hdbscan = registry.get("hdbscan")
+        tree = registry.get("hdbscan-tree")
+
+        cached = self.models.get(min_cluster_size)
+
+        if cached is not None and (not prediction_data or cached[2]):
+            return cached[:2]
+
+        # extract the flat clustering from the cached single-linkage tree
+        condensed_tree = tree.condense_tree(self.single_linkage_tree, min_cluster_size)
+        stability = tree.compute_stability(condensed_tree)
+        labels, probabilities, stabilities = tree.get_clusters(condensed_tree, stability, cluster_selection_method="eom",
+                                                          allow_single_cluster=False,
+                                                          match_reference_implementation=False)
+
+        # rebuild a fitted estimator, so that it can be used for the approximate prediction
+        algo = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, min_samples=self.min_samples, metric=self.metric)
+
+        algo._raw_data = self.x
+        algo._metric_kwargs = self.metric_kwargs
+        algo._condensed_tree = condensed_tree
+        algo._single_linkage_tree = self.single_linkage_tree
+        algo._min_spanning_tree = self.min_spanning_tree
+        algo._outlier_scores = None
+        algo._prediction_data = None
+        algo._relative_validity = None
+        algo.labels_ = labels
+        algo.probabilities_ = probabilities
+        algo.cluster_persistence_ = stabilities
+
+        if prediction_data:
+            algo.generate_prediction_data()
+
+        self.models.set(min_cluster_size, (algo, labels, prediction_data))
+
+        return algo, labels
+
+    def sweep(self, sizes):
+
+        results = []
+
+        for size in sizes:
+
+            algo, labels = self.extract(size)
+
+            results.append({"size": size, "clusters": len(set(labels) - {-1}),
+                            "noise": float(np.mean(labels == -1)) if len(labels) > 0 else np.nan})
+
+        return results
+
+
+def get_session(x, min_samples, metric="euclidean", key=None, shared_neighbors=False):
+
+    if key is None:
+        return HDBSCANSession(x, min_samples, metric, shared_neighbors)
+
+    session = SESSIONS.get((key, min_samples, metric, shared_neighbors))
+
+    if session is None:
+
+        session = singleflight.call("hdbscan_session", key, (min_samples, metric, shared_neighbors), HDBSCANSession,
+                                    x, min_samples, metric, shared_neighbors)
+        SESSIONS.set((key, min_samples, metric, shared_neighbors), session)
+
+    return session
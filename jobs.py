@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import glob
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import pickle
+import queue as queues
+import re
+import signal
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+import cache
+import shared_data
+
+####################################################
+# number of job workers, i.e. of jobs running at the
+# same time; further jobs wait in the queue until a
+# worker frees
+MAX_JOBS = int(os.environ.get("MAX_JOBS", 2))
+####################################################
+
+####################################################
+# number of finished jobs whose results are kept, so
+# that they can be collected after the browser
+# reconnects
+MAX_FINISHED = 32
+####################################################
+
+# seconds after which the files of a job are removed, e.g. those of a server worker which exited
+STALE_SECONDS = 24 * 3600
+
+# fields of a job shared with the other server workers
+FIELDS = ["name", "status", "progress", "message", "error", "submitted", "started", "finished"]
+
+# the workers are not forked from the threaded server, where another thread may hold a lock,
+# e.g. of the governor, of a cache or of the logging, which would stay locked in the worker
+START_METHOD = os.environ.get("JOBS_START_METHOD",
+                              "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# progress queue of the worker running in the current process
+CURRENT = None
+
+
+def job_path(job_id, extension):
+
+    return os.path.join(shared_data.SHARED_DIR, "jobs", job_id + extension)
+
+
+def report(progress, message=""):
+
+    # outside of a job there is nobody to report to, so that the same code can also run synchronously
+    if CURRENT is not None:
+        CURRENT.put(("progress", progress, message))
+
+
+def abort(message):
+
+    # stop the job running in the current worker from one of its threads, e.g. when it exceeds its
+    # quota; the message is sent before the worker and the pools of its group are killed
+    if CURRENT is None:
+        return
+
+    CURRENT.put(("stopped", message))
+    CURRENT.close()
+    CURRENT.join_thread()
+
+    if hasattr(os, "killpg"):
+        os.killpg(os.getpgrp(), signal.SIGKILL)
+
+    os._exit(1)
+
+
+def serve(tasks, queue):
+
+    # a worker runs the jobs it is given one after the other and outlives them, so that what a job
+    # fits and caches, e.g. the models of a K sweep or the HDBSCAN sessions, is reused by the next ones
+    global CURRENT
+    CURRENT = queue
+
+    # the worker leads a process group, which also holds the pools the jobs start, e.g. those of joblib
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+    while True:
+
+        task = tasks.get()
+
+        if task is None:
+            return
+
+        fn, args, kwargs = task
+
+        try:
+
+            queue.put(("done", fn(*args, **kwargs)))
+
+        except Exception:
+
+            queue.put(("failed", traceback.format_exc()))
+
+
+class Worker:
+
+    def __init__(self, context):
+
+        self.context = context
+
+        self.process = None
+        self.tasks = None
+        self.queue = None
+
+        # the job the worker is running, if any
+        self.job = None
+
+    def run(self, job):
+
+        # the process is started on the first job, and again after it was stopped
+        if self.process is None or not self.process.is_alive():
+
+            self.stop()
+
+            self.tasks, self.queue = self.context.Queue(), self.context.Queue()
+            self.process = self.context.Process(target=serve, args=(self.tasks, self.queue))
+            self.process.start()
+
+        self.job = job
+        self.tasks.put((job.fn, job.args, job.kwargs))
+
+    def stop(self):
+
+        # stop the worker together with the processes of its group; the caches it held are lost
+        if self.process is not None and self.process.is_alive():
+
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except (AttributeError, OSError):
+                self.process.terminate()
+
+            self.process.join()
+
+        self.process, self.tasks, self.queue, self.job = None, None, None, None
+
+
+class Job:
+
+    def __init__(self, name, fn, args, kwargs, admit=None, release=None, affinity=None):
+
+        self.id = uuid.uuid4().hex
+        self.name = name
+
+        # the jobs with the same affinity, e.g. of the same session, run in the same worker
+        self.affinity = affinity
+
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+        # optional admission control: the job starts once admit returns True, and release
+        # gives the resources back when a started job finishes
+        self.admit = admit
+        self.release = release
+
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+        self.worker = None
+        self.saved = None
+
+    @property
+    def done(self):
+
+        return self.status in ("done", "failed", "cancelled", "rejected")
+
+    def start(self, worker):
+
+        self.worker = worker
+        self.worker.run(self)
+
+        self.status = "running"
+        self.started = time.time()
+        self.message = ""
+
+        # the arguments, e.g. the processed data, are no longer needed in the server
+        self.args, self.kwargs = None, None
+
+    def finish(self, status):
+
+        self.status = status
+        self.finished = time.time()
+
+        if self.worker is not None:
+            self.worker.job = None
+
+        if self.release is not None and self.started is not None:
+            self.release()
+
+        self.worker = None
+        self.admit, self.release = None, None
+
+    def drain(self):
+
+        # a stopped process can still have messages in the queue, so check it before reading
+        worker = self.worker
+        alive = worker.process.is_alive()
+
+        while not self.done:
+
+            try:
+
+                message = worker.queue.get_nowait()
+
+            except queues.Empty:
+
+                break
+
+            if message[0] == "progress":
+
+                self.progress, self.message = message[1], message[2]
+
+            elif message[0] == "done":
+
+                self.result, self.progress = message[1], 1.0
+                self.finish("done")
+
+            elif message[0] == "stopped":
+
+                # the worker stopped the job and exits, the reason is displayed with the outcome
+                self.error = self.message = message[1]
+                self.finish("failed")
+
+            else:
+
+                self.error, self.message = message[1], ""
+                self.finish("failed")
+
+        # the worker stopped without reporting, e.g. it was killed by the system
+        if not self.done and not alive:
+
+            self.error = "The job worker exited with code {}.".format(worker.process.exitcode)
+            self.finish("failed")
+
+            worker.stop()
+
+    def cancel(self):
+
+        # a running job is only stopped with its worker
+        if self.status == "running":
+            self.worker.stop()
+
+        if not self.done:
+            self.finish("cancelled")
+
+    def elapsed(self):
+
+        if self.started is None:
+            return 0.0
+
+        return (self.finished or time.time()) - self.started
+
+    def save(self):
+
+        # the status is kept in a file, so that the other server workers can poll the job; it is only
+        # written when it changed, after the results it announces
+        state = dict({x: getattr(self, x) for x in FIELDS}, owner=os.getpid())
+
+        if state == self.saved:
+            return
+
+        os.makedirs(os.path.dirname(job_path(self.id, ".json")), exist_ok=True)
+
+        if self.status == "done" and (self.saved is None or self.saved["status"] != "done"):
+            shared_data.write_atomic(job_path(self.id, ".pkl"),
+                                     lambda f: pickle.dump(self.result, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+        shared_data.write_atomic(job_path(self.id, ".json"), lambda f: f.write(json.dumps(state).encode("utf-8")))
+
+        self.saved = state
+
+    def cancel_requested(self):
+
+        return os.path.exists(job_path(self.id, ".cancel"))
+
+
+def load(job_id):
+
+    # a job of another server worker, as it was last saved; the ids come from the browser
+    if re.fullmatch("[0-9a-f]{32}", job_id) is None:
+        return None
+
+    try:
+
+        with open(job_path(job_id, ".json")) as f:
+            state = json.load(f)
+
+        job = Job(state["name"], None, None, None)
+        job.id = job_id
+
+        for x in FIELDS:
+            setattr(job, x, state[x])
+
+        if job.status == "done":
+
+            with open(job_path(job_id, ".pkl"), "rb") as f:
+                job.result = pickle.load(f)
+
+    except (OSError, ValueError, KeyError):
+
+        return None
+
+    # the server worker running the job exited without finishing it
+    if not job.done and not shared_data.is_alive(state["owner"]):
+        job.status, job.error, job.finished = "failed", "The server worker running the job exited.", time.time()
+
+    return job
+
+
+def remove_files(job_id):
+
+    for extension in [".json", ".pkl", ".cancel"]:
+
+        try:
+            os.remove(job_path(job_id, extension))
+        except OSError:
+            pass
+
+
+class JobRunner:
+
+    # local process pool without an external broker: jobs are queued in the server and run by
+    # long-lived workers, the results stay in the server until collected
+    def __init__(self, max_jobs=MAX_JOBS, max_finished=MAX_FINISHED, interval=0.2):
+
+        self.max_finished = max_finished
+        self.interval = interval
+
+        context = multiprocessing.get_context(START_METHOD)
+
+        self.workers = [Worker(context) for j in range(max_jobs)]
+        self.affinity = cache.LRUCache(1024)
+        self.turn = 0
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, name, fn, *args, admit=None, release=None, affinity=None, **kwargs):
+
+        job = Job(name, fn, args, kwargs, admit, release, affinity)
+
+        self.prune()
+
+        with self.lock:
+
+            self.jobs[job.id] = job
+            self.update()
+
+            # the pump keeps reading the progress and the results while nobody polls
+            if self.thread is None:
+
+                self.thread = threading.Thread(target=self.pump, daemon=True)
+                self.thread.start()
+
+        return job.id
+
+    def reject(self, name, message):
+
+        # record the refusal as a finished job, so that it is displayed like any other outcome
+        job = Job(name, None, None, None)
+        job.status, job.error, job.finished = "rejected", message, time.time()
+
+        with self.lock:
+
+            self.jobs[job.id] = job
+            self.update()
+
+        return job.id
+
+    def get(self, job_id):
+
+        with self.lock:
+
+            job = self.jobs.get(job_id)
+
+        # the job may have been submitted to another server worker
+        if job is None:
+            job = load(job_id)
+
+        return job
+
+    def cancel(self, job_id):
+
+        with self.lock:
+
+            job = self.jobs.get(job_id)
+
+            if job is not None:
+
+                job.cancel()
+                self.update()
+
+                return job
+
+        # the server worker running the job cancels it when it sees the request
+        job = load(job_id)
+
+        if job is not None and not job.done:
+
+            with open(job_path(job_id, ".cancel"), "w"):
+                pass
+
+        return job
+
+    def prune(self):
+
+        # remove the files left behind by the jobs of the server workers which exited
+        for path in glob.glob(job_path("*", "")):
+
+            try:
+
+                if os.path.getmtime(path) < time.time() - STALE_SECONDS:
+                    os.remove(path)
+
+            except OSError:
+
+                pass
+
+    def cancel_all(self):
+
+        with self.lock:
+
+            for job in self.jobs.values():
+                job.cancel()
+
+            for worker in self.workers:
+                worker.stop()
+
+    def worker_for(self, job):
+
+        # the worker which ran the previous jobs of the same affinity holds what they cached,
+        # so the job waits for it rather than starting in another worker
+        index = self.affinity.get(job.affinity) if job.affinity is not None else None
+
+        if index is None:
+
+            # the new affinities are spread over the idle workers in turn
+            idle = [j for j, worker in enumerate(self.workers) if worker.job is None]
+
+            if len(idle) == 0:
+                return None
+
+            index = min(idle, key=lambda j: (j - self.turn) % len(self.workers))
+            self.turn = index + 1
+
+            if job.affinity is not None:
+                self.affinity.set(job.affinity, index)
+
+        if self.workers[index].job is not None:
+            return None
+
+        return self.workers[index]
+
+    def update(self):
+
+        for job in self.jobs.values():
+
+            if not job.done and job.cancel_requested():
+                job.cancel()
+
+            if job.status == "running":
+                job.drain()
+
+        # start the queued jobs in the order of submission
+        for job in self.jobs.values():
+
+            if job.status == "queued":
+
+                worker = self.worker_for(job)
+
+                if worker is None:
+
+                    job.message = "waiting for a worker"
+
+                    continue
+
+                if job.admit is not None and not job.admit():
+
+                    job.message = "waiting for resources"
+
+                    continue
+
+                job.start(worker)
+
+        for job in self.jobs.values():
+            job.save()
+
+        # forget the results of the oldest finished jobs
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+
+            del self.jobs[job_id]
+            remove_files(job_id)
+
+    def pump(self):
+
+        while True:
+
+            time.sleep(self.interval)
+
+            with self.lock:
+
+                self.update()
+
+                if all(job.done for job in self.jobs.values()):
+
+                    self.thread = None
+
+                    return
+
+
+RUNNER = JobRunner()
+
+# do not leave the workers behind when the server stops; multiprocessing, imported above, joins the
+# remaining processes at exit, so this runs first
+atexit.register(RUNNER.cancel_all)
+
+
+def submit(name, fn, *args, admit=None, release=None, affinity=None, **kwargs):
+
+    return RUNNER.submit(name, fn, *args, admit=admit, release=release, affinity=affinity, **kwargs)
+
+
+def reject(name, message):
+
+    return RUNNER.reject(name, message)
+
+
+def get_job(job_id):
+
+    if job_id is None:
+        return None
+
+    return RUNNER.get(job_id)
+
+
+def cancel(job_id):
+
+    if job_id is None:
+        return None
+
+    return RUNNER.cancel(job_id)
+
+
+def describe(job):
+
+    # short status line displayed while polling
+    if job is None:
+        return "The job is no longer available."
+
+    if job.status == "queued":
+
+        message = " ({})".format(job.message) if job.message else ""
+
+        return "{}: queued{}.".format(job.name, message)
+
+    if job.status == "rejected":
+        return "{}: rejected. {}".format(job.name, job.error)
+
+    if job.status == "running":
+
+        message = " ({})".format(job.message) if job.message else ""
+
+        return "{}: {:.0f}% after {:.0f}s{}.".format(job.name, 100 * job.progress, job.elapsed(), message)
+
+    if job.status == "failed":
+
+        message = " " + job.message if job.message else ""
+
+        return "{}: failed after {:.0f}s.{}".format(job.name, job.elapsed(), message)
+
+    return "{}: {} after {:.0f}s.".format(job.name, job.status, job.elapsed())
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import flask
+import pandas as pd
+
+import pipeline
+import profiler
+
+####################################################
+# rolling log of the callback requests, one JSON line
+# per request; set METRICS_LOG to an empty string to
+# disable it
+METRICS_LOG = os.environ.get("METRICS_LOG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs",
+                                                         "callbacks.log"))
+METRICS_LOG_BYTES = 10 * 1024 ** 2
+METRICS_LOG_FILES = 5
+####################################################
+
+####################################################
+# seconds between two samples of the resident memory
+# while callbacks are running
+MEMORY_INTERVAL = 0.01
+####################################################
+
+# upper bounds of the buckets of the wall time histogram, in seconds
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# the url of the callback requests of dash
+DISPATCH_PATH = "/_dash-update-component"
+
+# totals by output id of the callback; every server worker keeps its own, so they are
+# labeled with the process id
+METRICS = OrderedDict()
+LOCK = threading.Lock()
+
+LOGGER = None
+
+# the requests whose peak memory is sampled, by id, and the thread sampling it while there are any
+ACTIVE = {}
+SAMPLING = threading.Event()
+SAMPLER = None
+
+
+def output_id(output):
+
+    # the id dash gives to the callback, which is also sent with its requests
+    if isinstance(output, (list, tuple)):
+        return ".." + "...".join("{}.{}".format(x.component_id, x.component_property) for x in output) + ".."
+
+    return "{}.{}".format(output.component_id, output.component_property)
+
+
+def new_metrics():
+
+    return {"requests": 0, "errors": 0, "wall": 0.0, "cpu": 0.0, "deserialize": 0.0, "function": 0.0,
+            "response bytes": 0, "peak memory delta": 0, "max wall": 0.0, "max peak memory delta": 0,
+            "buckets": [0] * len(BUCKETS)}
+
+
+def get_logger():
+
+    global LOGGER
+
+    if LOGGER is None and METRICS_LOG:
+
+        directory = os.path.dirname(METRICS_LOG)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        handler = logging.handlers.RotatingFileHandler(METRICS_LOG, maxBytes=METRICS_LOG_BYTES,
+                                                       backupCount=METRICS_LOG_FILES)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+        LOGGER = logging.getLogger("callback_metrics")
+        LOGGER.propagate = False
+        LOGGER.setLevel(logging.INFO)
+        LOGGER.addHandler(handler)
+
+    return LOGGER
+
+
+def sample_memory():
+
+    # one thread samples the resident memory for all the running callbacks, it waits while there are none
+    while True:
+
+        SAMPLING.wait()
+        time.sleep(MEMORY_INTERVAL)
+
+        memory = pipeline.current_memory()
+
+        with LOCK:
+
+            for m in ACTIVE.values():
+                m["peak"] = max(m["peak"], memory)
+
+
+def watch_memory(m):
+
+    global SAMPLER
+
+    with LOCK:
+
+        ACTIVE[id(m)] = m
+        SAMPLING.set()
+
+        # a server worker forked from a process which sampled already has no sampler thread
+        if SAMPLER is None or not SAMPLER.is_alive():
+
+            SAMPLER = threading.Thread(target=sample_memory, name="callback-memory", daemon=True)
+            SAMPLER.start()
+
+
+def unwatch_memory(m):
+
+    with LOCK:
+
+        ACTIVE.pop(id(m), None)
+
+        if not ACTIVE:
+            SAMPLING.clear()
+
+
+def read_json(*args, **kwargs):
+
+    # pd.read_json of the data kept in the hidden divs, timed as the deserialization of the callback
+    m = flask.g.get("callback_metrics") if flask.has_request_context() else None
+
+    start = time.perf_counter()
+
+    try:
+
+        return pd.read_json(*args, **kwargs)
+
+    finally:
+
+        if m is not None:
+            m["deserialize"] += time.perf_counter() - start
+
+
+def record(output, wall, cpu, deserialize, function, response_bytes, peak_memory_delta, error):
+
+    with LOCK:
+
+        m = METRICS.setdefault(output, new_metrics())
+
+        m["requests"] += 1
+        m["errors"] += int(error)
+        m["wall"] += wall
+        m["cpu"] += cpu
+        m["deserialize"] += deserialize
+        m["function"] += function
+        m["response bytes"] += response_bytes
+        m["peak memory delta"] += peak_memory_delta
+        m["max wall"] = max(m["max wall"], wall)
+        m["max peak memory delta"] = max(m["max peak memory delta"], peak_memory_delta)
+
+        for j, bound in enumerate(BUCKETS):
+
+            if wall <= bound:
+                m["buckets"][j] += 1
+
+    logger = get_logger()
+
+    if logger is not None:
+
+        logger.info(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "pid": os.getpid(), "output": output,
+                                "wall": round(wall, 6), "cpu": round(cpu, 6), "deserialize": round(deserialize, 6),
+                                "function": round(function, 6), "response bytes": response_bytes,
+                                "peak memory delta": peak_memory_delta, "error": error}))
+
+
+def before_request():
+
+    if flask.request.path.endswith(DISPATCH_PATH):
+
+        # flask keeps the parsed body, so dash does not parse it again; the deserialization measured
+        # is that of the data read from the hidden divs by the callback
+        start = time.perf_counter()
+        body = flask.request.get_json(silent=True) or {}
+        memory = pipeline.current_memory()
+
+        m = {"output": body.get("output"), "start": start, "cpu": time.thread_time(), "memory": memory,
+             "peak": memory, "deserialize": 0.0, "function": 0.0, "session": session_id(body)}
+
+        flask.g.callback_metrics = m
+
+        if memory is not None:
+            watch_memory(m)
+
+
+def session_id(body):
+
+    # the session of the callback, if it reads the hidden session id
+    for x in (body.get("inputs") or []) + (body.get("state") or []):
+
+        if isinstance(x, dict) and x.get("id") == "session_id":
+            return x.get("value")
+
+
+def after_request(response):
+
+    m = flask.g.pop("callback_metrics", None)
+
+    if m is not None:
+        unwatch_memory(m)
+
+    if m is not None and m["output"] is not None:
+
+        # the response is already serialized, a streamed response has no length; the peak is the highest
+        # resident memory of the process sampled during the request, above the memory at its start, which
+        # the other threads of the worker may also have raised meanwhile
+        memory = pipeline.current_memory()
+        peak = max(m["peak"], memory) - m["memory"] if memory is not None and m["memory"] is not None else 0
+
+        record(m["output"], time.perf_counter() - m["start"], time.thread_time() - m["cpu"], m["deserialize"],
+               m["function"], response.calculate_content_length() or 0, peak, response.status_code >= 400)
+
+    return response
+
+
+def timed(fn, output):
+
+    # the time spent in the function itself, the rest of the request is spent by dash and flask;
+    # the function is profiled if the admin armed the profiler for its output and session
+    def wrapper(*args, **kwargs):
+
+        m = flask.g.get("callback_metrics") if flask.has_request_context() else None
+
+        start = time.perf_counter()
+
+        try:
+
+            return profiler.call(output, m["session"] if m is not None else None, fn, *args, **kwargs)
+
+        finally:
+
+            if m is not None:
+                m["function"] += time.perf_counter() - start
+
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+
+    return wrapper
+
+
+def instrument(app):
+
+    # wrap app.callback, so that every callback registered afterwards is measured and listed
+    # in the metrics from the start, and hook the requests which dash dispatches to them
+    register = app.callback
+
+    def callback(output, inputs=[], state=[], *args, **kwargs):
+
+        with LOCK:
+            METRICS.setdefault(output_id(output), new_metrics())
+
+        decorator = register(output, inputs, state, *args, **kwargs)
+
+        return lambda fn: decorator(timed(fn, output_id(output)))
+
+    app.callback = callback
+
+    app.server.before_request(before_request)
+    app.server.after_request(after_request)
+    app.server.add_url_rule("/metrics", "metrics", lambda: flask.Response(prometheus(), mimetype="text/plain"))
+
+
+def escape(value):
+
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus():
+
+    # text exposition format: a counter per measure and a histogram of the wall time, by callback output
+    with LOCK:
+        metrics = [(output, dict(m, buckets=list(m["buckets"]))) for output, m in METRICS.items()]
+
+    counters = [("callback_requests_total", "requests", "Callback requests."),
+                ("callback_errors_total", "errors", "Callback requests which failed."),
+                ("callback_cpu_seconds_total", "cpu", "CPU time of the request thread."),
+                ("callback_deserialize_seconds_total", "deserialize",
+                 "Time spent parsing the data of the hidden divs."),
+                ("callback_function_seconds_total", "function", "Time spent in the callback functions."),
+                ("callback_response_bytes_total", "response bytes", "Size of the serialized responses."),
+                ("callback_peak_memory_delta_bytes_total", "peak memory delta",
+                 "Peak growth of the resident memory of the process during the requests."),
+                ("callback_wall_seconds_max", "max wall", "Longest request."),
+                ("callback_peak_memory_delta_bytes_max", "max peak memory delta",
+                 "Largest peak growth of the resident memory during a request.")]
+
+    pid = str(os.getpid())
+    lines = []
+
+    for name, key, description in counters:
+
+        lines.append("# HELP {} {}".format(name, description))
+        # the maxima are not counters
+        lines.append("# TYPE {} {}".format(name, "counter" if name.endswith("_total") else "gauge"))
+
+        for output, m in metrics:
+            lines.append("{}{{output=\"{}\",pid=\"{}\"}} {}".format(name, escape(output), pid, m[key]))
+
+    lines.append("# HELP callback_wall_seconds Wall time of the callback requests.")
+    lines.append("# TYPE callback_wall_seconds histogram")
+
+    for output, m in metrics:
+
+        labels = "output=\"{}\",pid=\"{}\"".format(escape(output), pid)
+
+        for bound, count in zip(BUCKETS, m["buckets"]):
+            lines.append("callback_wall_seconds_bucket{{{},le=\"{}\"}} {}".format(labels, bound, count))
+
+        lines.append("callback_wall_seconds_bucket{{{},le=\"+Inf\"}} {}".format(labels, m["requests"]))
+        lines.append("callback_wall_seconds_sum{{{}}} {}".format(labels, m["wall"]))
+        lines.append("callback_wall_seconds_count{{{}}} {}".format(labels, m["requests"]))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import cache
+import pipeline
+import shared_data
+
+####################################################
+# directory of the saved pipelines
+MODEL_DIR = os.environ.get("MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models"))
+####################################################
+
+####################################################
+# number of rows labeled at once while scoring
+BATCH_ROWS = 50000
+####################################################
+
+# loaded pipelines, so that repeated scoring requests do not read them from the disk again
+LOADED = cache.LRUCache(8)
+
+# rows and seconds spent scoring with every pipeline since the server started
+THROUGHPUT = {}
+LOCK = threading.Lock()
+
+
+def paths(model_id):
+
+    # the ids are generated by save, anything else could point outside of the directory
+    if re.fullmatch("[0-9a-f]{32}", model_id or "") is None:
+        raise KeyError(model_id)
+
+    return os.path.join(MODEL_DIR, model_id + ".joblib"), os.path.join(MODEL_DIR, model_id + ".json")
+
+
+def describe(analysis):
+
+    return {"algorithm": analysis.cluster.algorithm, "dimension reduction": analysis.reduce.method,
+            "features": analysis.preprocess.columns, "fitted features": analysis.cluster.features,
+            "clusters": None if analysis.cluster.centroids is None else len(analysis.cluster.centroids)}
+
+
+def save(analysis, name=None):
+
+    import joblib
+
+    if not analysis.scorable:
+        raise ValueError("The fitted pipeline cannot label new rows. Choose PCA or UMAP, or no dimension reduction.")
+
+    # keep only the fitted stages; the warm start and the progress reports are bound to the session
+    analysis = pipeline.Pipeline(clean=analysis.clean, preprocess=analysis.preprocess, reduce=analysis.reduce,
+                                 cluster=analysis.cluster, project=pipeline.ProjectStage())
+    analysis.cluster.init = None
+    analysis.reset()
+
+    model_id = uuid.uuid4().hex
+    model_path, metadata_path = paths(model_id)
+
+    metadata = describe(analysis)
+    metadata.update({"id": model_id, "name": name, "created": time.strftime("%Y-%m-%d %H:%M:%S")})
+
+    os.makedirs(MODEL_DIR, exist_ok=True)
+
+    # the metadata is written last, as it is what marks a saved pipeline as complete
+    shared_data.write_atomic(model_path, lambda f: joblib.dump(analysis, f))
+    shared_data.write_atomic(metadata_path, lambda f: f.write(json.dumps(metadata).encode("utf-8")))
+
+    return model_id
+
+
+def metadata(model_id):
+
+    with open(paths(model_id)[1]) as f:
+        result = json.load(f)
+
+    with LOCK:
+        rows, seconds = THROUGHPUT.get(model_id, (0, 0.0))
+
+    result["scored rows"] = rows
+    result["rows per second"] = rows / seconds if seconds > 0 else None
+
+    return result
+
+
+def list_models():
+
+    if not os.path.isdir(MODEL_DIR):
+        return []
+
+    results = []
+
+    for file_name in sorted(os.listdir(MODEL_DIR)):
+
+        if file_name.endswith(".json"):
+
+            try:
+                results.append(metadata(file_name[:-len(".json")]))
+            except (KeyError, OSError, ValueError):
+                continue
+
+    return results
+
+
+def load(model_id):
+
+    import joblib
+
+    analysis = LOADED.get(model_id)
+
+    if analysis is None:
+
+        model_path, metadata_path = paths(model_id)
+
+        if not os.path.exists(metadata_path):
+            raise KeyError(model_id)
+
+        analysis = joblib.load(model_path)
+        LOADED.set(model_id, analysis)
+
+    return analysis
+
+
+def required_columns(analysis):
+
+    # the index is optional, the rows are numbered when it is missing
+    return [x for x in analysis.preprocess.columns if x != "index"]
+
+
+def score(model_id, df, batch_rows=BATCH_ROWS):
+
+    # label the rows in batches with a saved pipeline, returning the labels and the throughput
+    analysis = load(model_id)
+
+    missing = [x for x in required_columns(analysis) if x not in df.columns]
+
+    if len(missing) > 0:
+        raise ValueError("The rows lack the columns the model was fitted on: " + ", ".join(map(str, missing)) + ".")
+
+    start = time.perf_counter()
+
+    results = [analysis.score(df.iloc[j:j + batch_rows, :], j) for j in range(0, df.shape[0], batch_rows)]
+
+    seconds = time.perf_counter() - start
+
+    if len(results) > 0:
+        result = pd.concat(results, ignore_index=True)
+    else:
+        result = pd.DataFrame({"index": np.empty(0, dtype=int), "cluster labels": np.empty(0, dtype=int)})
+
+    with LOCK:
+
+        rows, total = THROUGHPUT.get(model_id, (0, 0.0))
+        THROUGHPUT[model_id] = (rows + df.shape[0], total + seconds)
+
+    metrics = {"rows": df.shape[0], "labeled rows": result.shape[0], "seconds": seconds,
+               "rows per second": df.shape[0] / seconds if seconds > 0 else None}
+
+    return result, metrics
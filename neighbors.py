@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import scipy.sparse
+
+import cache
+import registry
+import singleflight
+
+####################################################
+# minimum number of neighbors stored in a graph, so
+# that one graph covers the T-SNE affinities (three
+# times the default perplexity of 30) as well as the
+# HDBSCAN core distances
+N_NEIGHBORS = 90
+####################################################
+
+####################################################
+# number of rows above which the approximate index
+# (pynndescent) replaces the exact tree-based search
+APPROXIMATE_ROWS = 50000
+####################################################
+
+N_JOBS = int(os.environ.get("NEIGHBORS_JOBS", os.cpu_count() or 1))
+
+# nearest-neighbor graphs of recent datasets, keyed by the dataset digest and the representation
+GRAPHS = cache.LRUCache(8)
+
+
+class KNNGraph:
+
+    # indices and distances of the k nearest neighbors of every row, excluding the row itself
+    def __init__(self, indices, distances):
+
+        self.indices = indices
+        self.distances = distances
+
+    @property
+    def k(self):
+
+        return self.indices.shape[1]
+
+    def head(self, k):
+
+        # the neighbors are sorted by distance, so a smaller graph is a slice of a larger one
+        return KNNGraph(self.indices[:, :k], self.distances[:, :k])
+
+    def to_csr(self, symmetric=True):
+
+        n_rows = self.indices.shape[0]
+
+        rows = np.repeat(np.arange(n_rows), self.k)
+        columns = self.indices.ravel()
+        distances = self.distances.ravel()
+
+        # make the graph symmetric by keeping an edge if either row is a neighbor of the other; the edges
+        # are merged by position rather than with sparse operations, which drop the zero distances of
+        # duplicated rows
+        if symmetric:
+
+            rows, columns = np.concatenate([rows, columns]), np.concatenate([columns, rows])
+            distances = np.concatenate([distances, distances])
+
+            _, first = np.unique(rows * n_rows + columns, return_index=True)
+            rows, columns, distances = rows[first], columns[first], distances[first]
+
+        return scipy.sparse.csr_matrix((distances, (rows, columns)), shape=(n_rows, n_rows))
+
+    def is_connected(self):
+
+        connected_components = registry.get("connected-components")
+
+        return connected_components(self.to_csr(), directed=False)[0] == 1
+
+
+def drop_self(indices, distances):
+
+    # the extra neighbor is the row itself, which is dropped; its duplicates are at the same zero
+    # distance, so it is not necessarily the first one, and without it the farthest neighbor is dropped
+    n_rows, n_columns = indices.shape
+
+    is_self = indices == np.arange(n_rows)[:, None]
+    position = np.where(is_self.any(axis=1), is_self.argmax(axis=1), n_columns - 1)
+
+    keep = np.ones(indices.shape, dtype=bool)
+    keep[np.arange(n_rows), position] = False
+
+    return indices[keep].reshape(n_rows, n_columns - 1), distances[keep].reshape(n_rows, n_columns - 1)
+
+
+def exact_neighbors(x, k, n_jobs):
+
+    NearestNeighbors = registry.get("nearest-neighbors")
+
+    distances, indices = NearestNeighbors(n_neighbors=k + 1, n_jobs=n_jobs).fit(x).kneighbors(x)
+
+    return drop_self(indices, distances)
+
+
+def approximate_neighbors(x, k, n_jobs):
+
+    pynndescent = registry.get("pynndescent")
+
+    index = pynndescent.NNDescent(x, n_neighbors=k + 1, n_jobs=n_jobs, random_state=0)
+    indices, distances = index.neighbor_graph
+
+    return drop_self(indices, distances)
+
+
+def build_graph(x, k, n_jobs=None):
+
+    if n_jobs is None:
+        n_jobs = N_JOBS
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    k = min(k, x.shape[0] - 1)
+
+    if x.shape[0] > APPROXIMATE_ROWS:
+
+        try:
+
+            return KNNGraph(*approximate_neighbors(x, k, n_jobs))
+
+        except ImportError:
+
+            pass
+
+    return KNNGraph(*exact_neighbors(x, k, n_jobs))
+
+
+def get_graph(x, k, key=None, n_jobs=None):
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+
+    # by default the graph is identified by the content of the matrix, which covers
+    # both the dataset version and its representation (processed, PCA, T-SNE, ...)
+    if key is None:
+        key = cache.digest_array(x)
+
+    # serve the graph of the same dataset and representation if it has enough neighbors
+    graph = GRAPHS.get(key)
+
+    if graph is None or graph.k < min(k, x.shape[0] - 1):
+
+        k_build = max(k, N_NEIGHBORS)
+
+        # callers asking for the same graph at the same time wait for a single build
+        graph = singleflight.call("neighbors", key, k_build, build_graph, x, k_build, n_jobs)
+        GRAPHS.set(key, graph)
+
+    return graph.head(k)
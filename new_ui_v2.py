@@ -4,28 +4,28 @@
 
 import base64
 from datetime import datetime
-import io
-import urllib.parse
 import warnings
 
-import plotly.graph_objects as go
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_table as dt
 import dash_daq as daq
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
 
 import pandas as pd
 import numpy as np
 
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler, FunctionTransformer, MinMaxScaler
-from sklearn.utils.random import sample_without_replacement
-from sklearn.manifold import TSNE
-import hdbscan
+import export
+import metrics
+import pipeline
+import profiler
+import registry
+
+# plotly is only imported when the first plot is built
+go = registry.LazyModule("plotly.graph_objects")
 
 pd.options.mode.chained_assignment = None
 warnings.filterwarnings("ignore")
@@ -39,6 +39,12 @@ app.css.config.serve_locally = True
 app.scripts.config.serve_locally = True
 app.config.suppress_callback_exceptions = True
 
+# measure every callback registered below, the totals are served at /metrics
+metrics.instrument(app)
+
+# admin page for profiling the callbacks
+profiler.register(app.server, lambda: list(metrics.METRICS))
+
 app.title = "Clustering Tool"
 
 app.layout = html.Div(children=[
@@ -791,6 +797,7 @@ app.layout = html.Div(children=[
 
     # hidden divs used for storing the data shared across callbacks
     html.Div(id="uploaded_data", style={"display": "none"}),
+    dcc.Store(id="dataset_present", data=False),
     html.Div(id="raw_data", style={"display": "none"}),
     html.Div(id="processed_data", style={"display": "none"}),
     html.Div(id="clustered_data", style={"display": "none"}),
@@ -798,33 +805,27 @@ app.layout = html.Div(children=[
 ])
 
 
-@app.callback([Output("alert_output", "style"),
-               Output("data_output", "style"),
-               Output("cluster_output", "style")],
-              [Input("uploaded_data", "children"),
-               Input("control_tab", "value")])
-def render_switch(uploaded_data, tab):
-
-    if uploaded_data is None:
-
-        return [{"display": "block"}, {"display": "none"}, {"display": "none"}]
-
-    elif tab == "tab1":
-
-        return [{"display": "none"}, {"display": "block"}, {"display": "none"}]
+# the panels are toggled in the browser (assets/clientside.js), from a flag rather than from the uploaded data
+for output, function_name in [("alert_output", "alert_display"),
+                              ("data_output", "data_display"),
+                              ("cluster_output", "cluster_display")]:
 
-    elif tab == "tab2":
+    app.clientside_callback(ClientsideFunction(namespace="clientside", function_name=function_name),
+                            Output(output, "style"),
+                            [Input("dataset_present", "data"),
+                             Input("control_tab", "value")])
 
-        return [{"display": "none"}, {"display": "none"}, {"display": "block"}]
 
-
-@app.callback(Output("uploaded_data", "children"),
+@app.callback([Output("uploaded_data", "children"),
+               Output("dataset_present", "data")],
               [Input("uploaded_file", "contents")],
               [State("uploaded_file", "filename")])
 def load_file(contents, file_name):
     if contents is not None:
         df_json = parse_contents(contents, file_name)
-        return df_json
+        return [df_json, True]
+
+    return [None, False]
 
 
 @app.callback([Output("data_features", "options"),
@@ -835,30 +836,15 @@ def load_data(selected_file):
 
     if selected_file is not None:
 
-        # load the data from the hidden div
-        df = pd.read_json(selected_file)
-
-        # process the missing values
-        df[df == "-"] = np.nan
-        df[df == "?"] = np.nan
-        df[df == "."] = np.nan
-        df[df == " "] = np.nan
-
-        # include the indices in the first columns
+        # load the data from the hidden div, process the missing values and include the indices in the first columns
         # TODO add user customized index options
-        # TODO This one may need further modification to deal with some special cases
-        df.rename(columns={"Unnamed: 0": "index"}, inplace=True)
+        df = pipeline.CleanStage(dropna=False)(metrics.read_json(selected_file))
 
         # save the raw data in the hidden div
         raw_data = df.to_json(orient="split")
 
-        # transform the categorical variables into dummy variables
-        df = pd.get_dummies(df, dummy_na=False, drop_first=True)
-
-        # transform the indices to integers
-        df["index"] = df.index
-
-        # extract all features
+        # transform the categorical variables into dummy variables and extract all features
+        df = pipeline.CleanStage(dropna=False, dummies=True, drop_first=True)(df)
         features = list(df.columns)
         features.remove("index")
 
@@ -911,7 +897,7 @@ def data_preprocessing(clicks, raw_data, selected_features, data_weights, data_t
     # TODO set index options
     # Missing Numerical and Categorical Value Processing Options in new_ui version 1
     # load the raw data from the hidden div
-    df = pd.read_json(raw_data["raw_data"], orient="split")
+    df = metrics.read_json(raw_data["raw_data"], orient="split")
 
     if len(df) != 0:
 
@@ -919,83 +905,45 @@ def data_preprocessing(clicks, raw_data, selected_features, data_weights, data_t
         raw_data_rows = df.to_dict(orient="records")
         raw_data_columns = [{"id": x, "name": x} for x in list(df.columns)]
 
-        # process the missing numerical values
-        num = df.loc[:, np.logical_and(df.dtypes != "object", df.dtypes != "category")]
-
-        num.dropna(inplace=True)
-        df = df.iloc[num.index, :]
-        df.reset_index(inplace=True, drop=True)
-
-        # process the missing categorical values
-        cat = df.loc[:, np.logical_or(df.dtypes == "object", df.dtypes == "category")]
-
-        cat.dropna(inplace=True)
-        df = df.iloc[cat.index, :]
-        df = pd.get_dummies(df, dummy_na=False, drop_first=True)
-        df.reset_index(inplace=True, drop=True)
+        # process the missing values and transform the categorical variables into dummy variables
+        df = pipeline.CleanStage(dummies=True, drop_first=True)(df)
 
         # process the features selection
-        if selected_features is not None:
-
-            features = list(set(selected_features))
-
-            if len(features) > 0:
-
-                columns = ["index"]
-                columns.extend(features)
+        if selected_features is not None and len(set(selected_features)) > 0:
 
-            else:
-
-                columns = list(df.columns)
+            columns = list(set(selected_features))
 
         else:
 
-            columns = list(df.columns)
-
-        # extract the selected features
-        df = df[columns]
+            columns = [x for x in df.columns if x != "index"]
 
-        # drop the indices
-        indices = df["index"]
-        df.drop("index", axis=1, inplace=True)
-        columns.remove("index")
+        # check the weights
+        if data_weights is not None and len(data_weights) != len(columns):
 
-        # apply the weights
-        if data_weights is not None:
+            data_alert = ["The number of weights is different from the number of features. No weights applied."]
+            n_clicks = 0
 
-            if len(data_weights) == df.shape[1]:
-
-                data_weights = data_weights / np.sum(data_weights)
-                data_alert, n_clicks = None, None
-
-                for i in range(df.shape[1]):
-
-                    df.iloc[:, i] = df.iloc[:, i] * data_weights[i]
-
-            else:
-
-                data_alert = ["The number of weights is different from the number of features. No weights applied."]
-                n_clicks = 0
+            data_weights = None
 
         else:
 
             data_alert, n_clicks = None, None
 
-        # apply the selected transformation
-        if data_transformation == "log":
+        # apply the weights and the selected transformation to the selected features
+        transformation = data_transformation if data_transformation in ["log", "z-score", "minmax"] else "none"
 
-            df = pd.DataFrame(data=FunctionTransformer(np.log1p, validate=True).fit_transform(df),
-                              columns=df.columns, index=df.index)
-            df = df.astype(float).round(4)
-
-        elif data_transformation == "z-score":
+        selection = pd.DataFrame({"feature": ["index"] + columns, "type": "numerical",
+                                  "weight": [1] + (list(data_weights) if data_weights is not None else [1] * len(columns)),
+                                  "transformation": transformation})
 
-            df = pd.DataFrame(data=StandardScaler().fit_transform(df), columns=df.columns, index=df.index)
-            df = df.astype(float).round(4)
+        df = pipeline.PreprocessStage(selection, normalize_weights=data_weights is not None)(df)
 
-        elif data_transformation == "minmax":
+        # drop the indices
+        indices = df["index"]
+        df.drop("index", axis=1, inplace=True)
+        columns = list(df.columns)
 
-            df = pd.DataFrame(data=MinMaxScaler().fit_transform(df), columns=df.columns, index=df.index)
+        if transformation != "none":
             df = df.astype(float).round(4)
 
         # create the table containing the descriptive statistics
@@ -1107,7 +1055,7 @@ def data_preprocessing(clicks, raw_data, selected_features, data_weights, data_t
               Input("correlation_features", "value")])
 def update_correlation_matrix(processed_data, correlation_features):
 
-    df = pd.read_json(processed_data["processed_data"], orient="split")
+    df = metrics.read_json(processed_data["processed_data"], orient="split")
 
     if len(df) != 0:
 
@@ -1165,7 +1113,7 @@ def update_correlation_matrix(processed_data, correlation_features):
               Input("histogram_features", "value")])
 def update_histogram(processed_data, histogram_features):
 
-    df = pd.read_json(processed_data["processed_data"], orient="split")
+    df = metrics.read_json(processed_data["processed_data"], orient="split")
 
     if len(df) != 0:
 
@@ -1244,7 +1192,7 @@ def update_histogram(processed_data, histogram_features):
                Input("scatter-y-axis", "value")])
 def update_scatter_plot(processed_data, x_axis, y_axis):
     # TODO
-    df = pd.read_json(processed_data["processed_data"], orient="split")
+    df = metrics.read_json(processed_data["processed_data"], orient="split")
 
     # x_axis = df.column[0]
     # y_axis = df.column[1]
@@ -1336,13 +1284,13 @@ def update_scatter_plot(processed_data, x_axis, y_axis):
               [Input("processed_data", "children")])
 def update_scree_plot(processed_data):
 
-    df = pd.read_json(processed_data["processed_data"], orient="split")
+    df = metrics.read_json(processed_data["processed_data"], orient="split")
 
     if len(df) != 0:
 
         df.drop("index", axis=1, inplace=True)
 
-        pca = PCA(n_components=np.min([10, df.shape[1]]), random_state=0).fit(df)
+        pca = registry.get("pca")(n_components=np.min([10, df.shape[1]]), random_state=0).fit(df)
         # placeholder for calculating cumulative explained variance
         cum_explained_var = []
         for i in range(0, len(pca.explained_variance_ratio_)):
@@ -1406,7 +1354,9 @@ def update_scree_plot(processed_data):
 
 
 @app.callback([Output("display_cluster_table", "children"),
-               Output("clustered_data", "children")],
+               Output("clustered_data", "children"),
+               Output("cluster_data_link", "href"),
+               Output("cluster_data_link", "download")],
               [Input("cluster_button", "n_clicks"),
                Input("processed_data", "children")],
               [State("cluster_random_sampling", "value"),
@@ -1420,117 +1370,64 @@ def cluster_analysis(clicks, processed_data, random_sampling, sample_size, dimen
                      cluster_algorithm, num_clusters, cluster_size):
 
     # load the processed data from the hidden div
-    df = pd.read_json(processed_data["processed_data"], orient="split")
+    df = metrics.read_json(processed_data["processed_data"], orient="split")
 
     if len(df) != 0:
 
-        # create a copy of the data frame
-        df_copy = df.copy()
-
         # perform random sampling
-        if random_sampling == "True":
-
-            if sample_size is not None:
-
-                # calculate the number of samples
-                n_samples = np.int(sample_size * df.shape[0] / 100)
-
-                # generate the random sample
-                sample = sample_without_replacement(n_population=df.shape[0], n_samples=n_samples, random_state=0)
-                sample = np.sort(sample)   
- 
-                # extract the random sample
-                df = df.iloc[sample, :]
-                df.reset_index(inplace=True, drop=True)
+        sample = pipeline.SampleStage(sample_size if random_sampling == "True" else None)
 
-                sample_message = "Sampled " + str(df.shape[0]) + " records."
-
-            else:
-
-                sample_message = "Sample size not selected. Random sampling not performed."
-
-        else:
+        if random_sampling != "True":
 
             sample_message = "Random sampling not performed."
 
-        # drop the indices
-        indices = df["index"]
-        df.drop("index", axis=1, inplace=True)
-
-        # run the dimension reduction algorithm
-        if dimension_reduction == "pca":
+        elif sample_size is None:
 
-            if 0 < num_components <= df.shape[1]:
+            sample_message = "Sample size not selected. Random sampling not performed."
 
-                df = PCA(n_components=np.int(num_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component " + str(x) for x in range(1, num_components + 1)])
-
-                reduction_message = "Extracted " + str(num_components) + " components with PCA."
-
-            else:
+        else:
 
-                reduction_message = "Invalid number of components. PCA not performed."
+            sample_message = "Sampled " + str(int(sample_size * df.shape[0] / 100)) + " records."
 
-        elif dimension_reduction == "tsne":
+        # run the dimension reduction and the clustering algorithms
+        reduce = pipeline.ReduceStage(dimension_reduction, num_components)
+        cluster = pipeline.ClusterStage(cluster_algorithm, num_clusters, cluster_size)
 
-            if 0 < num_components <= df.shape[1]:
+        df = pipeline.Pipeline(sample=sample, reduce=reduce, cluster=cluster).analyze(df)
 
-                df = TSNE(n_components=np.int(num_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component" + str(x) for x in range(1, num_components + 1)])
+        if reduce.active:
 
-                reduction_message = "Extracted " + str(num_components) + " components with TSNE."
+            reduction_message = "Extracted " + str(reduce.components) + " components with " + \
+                                dimension_reduction.upper() + "."
 
-            else:
+            if reduce.components != num_components:
 
-                reduction_message = "Invalid number of components. TSNE not performed."
+                reduction_message += " The selected number of components is not supported."
 
         else:
 
             reduction_message = "Dimension reduction not performed."
 
-        # run the clustering algorithm
         if cluster_algorithm == "kmeans":
 
-            if 0 < num_clusters <= df.shape[0]:
-
-                algo = KMeans(n_clusters=num_clusters, random_state=0).fit(df)
-
-            else:
-
-                algo = KMeans(n_clusters=3).fit(df)
-
             algo_message = "Performed K-means clustering."
 
         elif cluster_algorithm == "hdbscan":
 
-            if 1 < cluster_size <= df.shape[0]:
-
-                algo = hdbscan.HDBSCAN(min_cluster_size=cluster_size).fit(df)
-
-            else:
-
-                algo = hdbscan.HDBSCAN(min_cluster_size=2).fit(df)
-
             algo_message = "Performed HDBSCAN clustering."
 
-        # round all values to 2 digits
-        df = df.astype(float).round(2)
-
-        # add the cluster labels
-        df["cluster labels"] = algo.labels_
-        df["cluster labels"] = 1 + df["cluster labels"]
-
         cluster_message = "Found " + str(len(df["cluster labels"].unique())) + " clusters."
         n_clicks = 0
 
-        # add back the indices
-        df["index"] = indices
-        df = df[["index", "cluster labels"]]
-        df = pd.merge(left=df, right=df_copy, on="index", how="left")
-
         # save the results in the hidden div
         cluster_data = df.to_json(orient="split")
 
+        # keep the results on the server, the download route only generates the file when the link is clicked
+        result_id = export.store_result(df)
+
+        file_for_download = "/results/" + result_id + ".csv"
+        file_name = "clustering_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".csv"
+
         # display the results in the table
         cluster_data_rows = df.to_dict("records")
         cluster_data_columns = [{"id": x, "name": x} for x in list(df.columns)]
@@ -1566,7 +1463,7 @@ def cluster_analysis(clicks, processed_data, random_sampling, sample_size, dimen
             style={"overflow": "auto"}
         )
 
-        return [display_cluster_table, {"clustered_data": cluster_data}]
+        return [display_cluster_table, {"clustered_data": cluster_data}, file_for_download, file_name]
 
     else:
 
@@ -1578,7 +1475,7 @@ def cluster_analysis(clicks, processed_data, random_sampling, sample_size, dimen
         cluster_message = []
         n_clicks = None
 
-        return [display_cluster_table, {"clustered_data": cluster_data}]
+        return [display_cluster_table, {"clustered_data": cluster_data}, None, None]
 
 
 @app.callback([Output("x-axis", "options"),
@@ -1592,7 +1489,7 @@ def cluster_analysis(clicks, processed_data, random_sampling, sample_size, dimen
 def update_cluster_plot_data(clustered_data, plot_button, plot_dimension_reduction, plot_components):
 
     # load the clustering results from the hidden div
-    df = pd.read_json(clustered_data["clustered_data"], orient="split")
+    df = metrics.read_json(clustered_data["clustered_data"], orient="split")
 
     if len(df) != 0:
 
@@ -1602,19 +1499,7 @@ def update_cluster_plot_data(clustered_data, plot_button, plot_dimension_reducti
         df.drop(["index", "cluster labels"], axis=1, inplace=True)
 
         # run the dimension reduction algorithm
-        if plot_dimension_reduction == "pca":
-
-            if 0 < plot_components <= df.shape[1]:
-
-                df = PCA(n_components=np.int(plot_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component " + str(x) for x in range(1, plot_components + 1)])
-
-        elif plot_dimension_reduction == "tsne":
-
-            if 0 < plot_components <= df.shape[1]:
-
-                df = TSNE(n_components=np.int(plot_components), random_state=0).fit_transform(df)
-                df = pd.DataFrame(data=df, columns=["Component" + str(x) for x in range(1, plot_components + 1)])
+        df = pipeline.ReduceStage(plot_dimension_reduction, plot_components)(df)
 
         # create the lists of features to be shown in the dropdown menus
         columns = list(df.columns)
@@ -1653,7 +1538,7 @@ def update_cluster_plot_data(clustered_data, plot_button, plot_dimension_reducti
               [State("plot_dimensions", "value")])
 def update_cluster_plot(plot_data, x_axis, y_axis, z_axis, plot_dimensions):
 
-    df = pd.read_json(plot_data["plot_data"], orient="split")
+    df = metrics.read_json(plot_data["plot_data"], orient="split")
 
     if len(df) != 0:
 
@@ -1806,54 +1691,29 @@ def update_cluster_plot(plot_data, x_axis, y_axis, z_axis, plot_dimensions):
     return scatter_plot
 
 
-@app.callback(Output("data_alerts_modal", "style"), [Input("data_alerts_messages", "children"),
-              Input("data_alerts_button", "n_clicks")])
-def data_messages(messages, n_clicks):
-
-    if messages is not None and n_clicks == 0:
-
-        return {"display": "block"}
-
-    elif messages is not None and n_clicks != 0:
-
-        return {"display": "none"}
-
-    else:
-
-        return {"display": "none"}
-
-
-@app.callback(Output("cluster_alerts_modal", "style"), [Input("cluster_alerts_button", "n_clicks")])
-def cluster_messages(n_clicks):
-
-    if n_clicks == 0:
-
-        return {"display": "block"}
-
-    else:
+app.clientside_callback(ClientsideFunction(namespace="clientside", function_name="data_messages"),
+                        Output("data_alerts_modal", "style"),
+                        [Input("data_alerts_messages", "children"),
+                         Input("data_alerts_button", "n_clicks")])
 
-        return {"display": "none"}
 
+app.clientside_callback(ClientsideFunction(namespace="clientside", function_name="cluster_messages"),
+                        Output("cluster_alerts_modal", "style"),
+                        [Input("cluster_alerts_button", "n_clicks")])
 
-@app.callback([Output("cluster_data_link", "href"),
-               Output("cluster_data_link", "download")],
-              [Input("cluster_data_button", "n_clicks"),
-               Input("clustered_data", "children")])
-def download_file(n_clicks, clustered_data):
 
-    # load the clustering results from the hidden div
-    df = pd.read_json(clustered_data["clustered_data"], orient="split")
+@app.server.route("/results/<result_id>.<path:fmt>")
+def download_file(result_id, fmt):
 
-    # convert the table to csv
-    csv = df.to_csv(index=False, encoding="utf-8")
+    df = export.load_result(result_id)
 
-    # create the file for download
-    file_for_download = "data:text/csv;charset=utf-8," + urllib.parse.quote(csv)
+    if df is None:
+        flask.abort(404)
 
     # use the current time as the file name
-    file_name = "clustering_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".csv"
+    file_name = "clustering_" + datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    return file_for_download, file_name
+    return export.stream(df, fmt, file_name)
 
 
 def parse_contents(contents, filename):
@@ -1863,17 +1723,7 @@ def parse_contents(contents, filename):
 
     try:
 
-        if "csv" in filename:
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-
-        elif "xls" in filename:
-            df = pd.read_excel(io.BytesIO(decoded))
-
-        elif "json" in filename:
-            df = pd.read_json(contents)
-
-        elif "txt" or "tsv" in filename:
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), delimiter=r"\s+")
+        df = pipeline.LoadStage()(decoded, filename)
 
     except Exception as e:
         print(e)
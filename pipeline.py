@@ -0,0 +1,729 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import clustering
+import compression
+import embedding
+import registry
+import sampling
+
+# values which mark a missing entry in the uploaded files
+MISSING_VALUES = ["-", "?", ".", " "]
+
+
+def peak_memory():
+
+    # peak resident memory of the process in bytes, where the platform reports it
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_memory():
+
+    # resident memory of the process in bytes at the moment, where the platform reports it
+    try:
+
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    except (OSError, ValueError, AttributeError):
+
+        return None
+
+
+class Stage:
+
+    # a step of the pipeline: load -> clean -> preprocess -> (sample) -> reduce -> cluster -> project;
+    # calling a stage runs it and records how long it took and the peak memory of the process
+    # afterwards, so that the pipeline can be profiled; a stage run on chunks adds up their times
+    name = "stage"
+
+    def __init__(self):
+
+        self.seconds = None
+        self.memory = None
+
+    def __call__(self, *args, **kwargs):
+
+        return self.timed(self.run, *args, **kwargs)
+
+    def timed(self, fn, *args, **kwargs):
+
+        # the other methods of a stage, e.g. the passes of a fit in chunks, are profiled through here
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.seconds = (self.seconds or 0.0) + time.perf_counter() - start
+        self.memory = peak_memory()
+
+        return result
+
+    def reset(self):
+
+        self.seconds = None
+        self.memory = None
+
+    def run(self, *args, **kwargs):
+
+        raise NotImplementedError
+
+
+class LoadStage(Stage):
+
+    # parse a file, given as the uploaded bytes or as a path, optionally sampling it while it is read
+    name = "load"
+
+    def __init__(self, sampling_mode="none", sample_rows=None, strata_column=None, seed=0,
+                 chunk_size=sampling.CHUNK_SIZE):
+
+        Stage.__init__(self)
+
+        self.sampling_mode = sampling_mode
+        self.sample_rows = sample_rows
+        self.strata_column = strata_column
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def chunks(self, source, filename):
+
+        # iterate over the file without sampling it, e.g. for scoring every row
+        return self.open_chunks(source, filename)()
+
+    def open_chunks(self, source, filename):
+
+        # every call reopens the file, the stratified sampler reads it twice
+        def open_chunks():
+
+            f = io.BytesIO(source) if isinstance(source, bytes) else source
+
+            if "csv" in filename:
+                return pd.read_csv(f, chunksize=self.chunk_size)
+
+            elif "xls" in filename:
+                return [pd.read_excel(f)]
+
+            elif "json" in filename:
+                return [pd.read_json(f)]
+
+            else:
+                return pd.read_csv(f, delimiter=r"\s+", chunksize=self.chunk_size)
+
+        return open_chunks
+
+    def run(self, source, filename):
+
+        open_chunks = self.open_chunks(source, filename)
+
+        if self.sampling_mode != "none" and self.sample_rows is not None and self.sample_rows > 0:
+            return sampling.sample_chunks(open_chunks, self.sampling_mode, int(self.sample_rows), self.strata_column,
+                                          self.seed)
+
+        return sampling.sample_chunks(open_chunks, "none", None)
+
+
+class CleanStage(Stage):
+
+    # mark the missing values, drop the incomplete rows and identify the rows by the index column;
+    # a file without an index column is numbered by the position of the rows, starting at the offset
+    # of the chunk; with dummies the categorical features are replaced by their dummy variables, as
+    # the second UI selects and weights those instead of the features
+    name = "clean"
+
+    def __init__(self, missing_values=MISSING_VALUES, dropna=True, index_column="Unnamed: 0", dummies=False,
+                 drop_first=False):
+
+        Stage.__init__(self)
+
+        self.missing_values = missing_values
+        self.dropna = dropna
+        self.index_column = index_column
+        self.dummies = dummies
+        self.drop_first = drop_first
+
+    def run(self, df, offset=0):
+
+        # include the indices in the first columns, numbering the rows if the file has no index
+        df = df.rename(columns={self.index_column: "index"})
+
+        if "index" not in df.columns:
+            df.insert(0, "index", offset + np.arange(df.shape[0]))
+
+        # process the missing values
+        df = df.replace(self.missing_values, np.nan)
+
+        # drop the missing values
+        if self.dropna:
+
+            df.dropna(inplace=True)
+            df.reset_index(drop=True, inplace=True)
+
+        # make sure that the indices are treated as integers
+        df["index"] = df["index"].astype(int)
+
+        # transform the categorical variables into dummy variables
+        if self.dummies:
+            df = pd.get_dummies(df, dummy_na=False, drop_first=self.drop_first)
+
+        return df
+
+
+def default_selection(df):
+
+    # initial data types, weights and transformations of the features
+    selection = pd.DataFrame({"feature": df.columns, "type": df.dtypes, "weight": np.ones(df.shape[1]),
+                              "transformation": ["none"] * df.shape[1]})
+    selection["type"][(selection["type"] == "object") | (selection["type"] == "category")] = "categorical"
+    selection["type"][-(selection["type"] == "categorical")] = "numerical"
+    selection.reset_index(drop=True, inplace=True)
+
+    return selection
+
+
+def sort_values(values):
+
+    try:
+        return sorted(values)
+    except TypeError:
+        return sorted(values, key=str)
+
+
+def cut_bins(x_min, x_max, n_bins=3):
+
+    # equal-width bins as in pd.cut, open at both ends so that new rows outside the range still fall in a bin
+    if x_min == x_max:
+
+        adjustment = 0.001 * abs(x_min) if x_min != 0 else 0.001
+        edges = np.linspace(x_min - adjustment, x_max + adjustment, n_bins + 1)
+
+    else:
+
+        edges = np.linspace(x_min, x_max, n_bins + 1)
+
+    return [-np.inf] + list(edges[1:-1]) + [np.inf]
+
+
+def update_moments(moments, x):
+
+    # combine the count, mean, sum of squared deviations, minimum and maximum of the
+    # columns seen so far with those of a new chunk
+    n, mean, m2, x_min, x_max = moments
+    x = np.asarray(x, dtype=np.float64)
+
+    if x.shape[0] == 0:
+        return moments
+
+    n_chunk = x.shape[0]
+    mean_chunk = x.mean(axis=0)
+    m2_chunk = ((x - mean_chunk) ** 2).sum(axis=0)
+
+    if n == 0:
+        return n_chunk, mean_chunk, m2_chunk, x.min(axis=0), x.max(axis=0)
+
+    delta = mean_chunk - mean
+    total = n + n_chunk
+
+    return (total, mean + delta * n_chunk / total, m2 + m2_chunk + delta ** 2 * n * n_chunk / total,
+            np.minimum(x_min, x.min(axis=0)), np.maximum(x_max, x.max(axis=0)))
+
+
+def transform(x, transformation, moments=None):
+
+    # the scalers use the moments of the whole data, which are fitted in chunks
+    if transformation == "log":
+        return np.log1p(x)
+
+    if moments is None:
+        moments = update_moments((0, None, None, None, None), x)
+
+    n, mean, m2, x_min, x_max = moments
+
+    if transformation == "z-score":
+
+        # constant columns are only centered, as in StandardScaler
+        scale = np.sqrt(m2 / n)
+        scale = np.where(scale == 0, 1.0, scale)
+
+        return (x - mean) / scale
+
+    elif transformation == "minmax":
+
+        scale = x_max - x_min
+        scale = np.where(scale == 0, 1.0, scale)
+
+        return (x - x_min) / scale
+
+    return x
+
+
+class PreprocessStage(Stage):
+
+    # encode, weight and transform the selected features; the selection is a frame with
+    # the feature, type ("numerical", "categorical" or "none"), weight and transformation;
+    # the encodings and the scalers are fitted in two passes over the chunks of the data,
+    # the first learns the categories and the ranges, the second the moments of the encoded
+    # columns, after which any chunk or new rows can be transformed in the same way
+    name = "preprocess"
+
+    def __init__(self, selection=None, normalize_weights=True):
+
+        Stage.__init__(self)
+
+        self.selection = selection
+        self.normalize_weights = normalize_weights
+
+        self.columns = None
+        self.features = None
+
+    def select(self, df):
+
+        selection = default_selection(df) if self.selection is None else self.selection
+
+        # discard the features with zero weight and / or "none" data type
+        selection = selection[(selection["weight"] != 0) & (selection["type"] != "none")]
+        self.columns = list(selection["feature"])
+
+        # discard the index
+        selection = selection[selection["feature"] != "index"]
+
+        # normalize the weights
+        weights = selection["weight"].values.astype(float)
+
+        if self.normalize_weights:
+            weights = weights / weights.sum()
+
+        self.features = []
+
+        for feature, dtype, weight, transformation in zip(selection["feature"], selection["type"], weights,
+                                                           selection["transformation"]):
+
+            categorical = df[feature].dtype == "object"
+
+            if categorical and dtype == "numerical": # from categorical to numerical
+                encoding = "label"
+
+            elif not categorical and dtype == "categorical": # from numerical to categorical
+                encoding = "bins"
+
+            elif not categorical and dtype == "numerical": # from numerical to numerical
+                encoding = "numeric"
+
+            else: # from categorical to categorical
+                encoding = "dummies"
+
+            self.features.append({"feature": feature, "encoding": encoding, "weight": weight,
+                                  "transformation": transformation, "categories": set(), "range": None,
+                                  "moments": (0, None, None, None, None)})
+
+    def learn(self, df):
+
+        # first pass: the categories of the categorical features and the ranges of the binned ones
+        if self.features is None:
+            self.select(df)
+
+        for spec in self.features:
+
+            x = df[spec["feature"]]
+
+            if spec["encoding"] in ["label", "dummies"]:
+
+                spec["categories"].update(x.dropna().unique())
+
+            elif spec["encoding"] == "bins" and x.shape[0] > 0:
+
+                x_range = (x.min(), x.max())
+
+                if spec["range"] is not None:
+                    x_range = (min(spec["range"][0], x_range[0]), max(spec["range"][1], x_range[1]))
+
+                spec["range"] = x_range
+
+    def learned(self):
+
+        # fix the vocabularies and the bins before the second pass
+        for spec in self.features:
+
+            if spec["encoding"] in ["label", "dummies"]:
+
+                spec["categories"] = sort_values(spec["categories"])
+
+            elif spec["encoding"] == "bins":
+
+                spec["categories"] = [spec["feature"] + "_cat1", spec["feature"] + "_cat2", spec["feature"] + "_cat3"]
+                spec["bins"] = cut_bins(*spec["range"])
+
+    def encode(self, df, spec):
+
+        x = df[spec["feature"]]
+
+        if spec["encoding"] == "label":
+
+            # unknown categories are encoded as -1
+            x = pd.Categorical(x, categories=spec["categories"]).codes.astype(float).reshape(-1, 1)
+
+        elif spec["encoding"] == "numeric":
+
+            x = x.values.astype(float).reshape(-1, 1)
+
+        elif spec["encoding"] == "bins":
+
+            x = pd.get_dummies(pd.cut(x, spec["bins"], labels=spec["categories"])).values.astype(float)
+
+        else:
+
+            x = pd.get_dummies(pd.Categorical(x, categories=spec["categories"])).values.astype(float)
+
+        return spec["weight"] * x
+
+    def accumulate(self, df):
+
+        # second pass: the moments of the encoded and weighted columns, used by the scalers
+        for spec in self.features:
+            spec["moments"] = update_moments(spec["moments"], self.encode(df, spec))
+
+    def fit(self, open_chunks):
+
+        # open_chunks returns a new iterator over the chunks of the data for every pass
+        self.features = None
+
+        for chunk in open_chunks():
+            self.learn(chunk)
+
+        self.learned()
+
+        for chunk in open_chunks():
+            self.accumulate(chunk)
+
+        return self
+
+    def transform(self, df):
+
+        df = df[self.columns].copy()
+
+        # process the data
+        for spec in self.features:
+
+            feature = spec["feature"]
+            x = transform(self.encode(df, spec), spec["transformation"], spec["moments"])
+
+            if spec["encoding"] in ["label", "numeric"]:
+
+                df[feature] = x[:, 0]
+
+            else:
+
+                if spec["encoding"] == "bins":
+                    columns = spec["categories"]
+                else:
+                    columns = [feature + "_" + str(category) for category in spec["categories"]]
+
+                df = df.drop(feature, axis=1).join(pd.DataFrame(x, index=df.index, columns=columns))
+
+        return df
+
+    def run(self, df):
+
+        return self.fit(lambda: [df]).transform(df)
+
+
+class SampleStage(Stage):
+
+    # uniform random sample of the given percentage of the rows; the positions of the
+    # sampled rows are kept, so that the other rows can be projected afterwards
+    name = "sample"
+
+    def __init__(self, sample_size=None, random_state=0):
+
+        Stage.__init__(self)
+
+        self.sample_size = sample_size
+        self.random_state = random_state
+
+    def run(self, df):
+
+        if self.sample_size is None:
+            return df, None
+
+        # calculate the number of samples
+        n_samples = int(self.sample_size * df.shape[0] / 100)
+
+        # generate the random sample
+        sample_without_replacement = registry.get("sample-without-replacement")
+
+        sample = sample_without_replacement(n_population=df.shape[0], n_samples=n_samples,
+                                            random_state=self.random_state)
+        sample = np.sort(sample)
+
+        # extract the random sample
+        df = df.iloc[sample, :]
+        df.reset_index(inplace=True, drop=True)
+
+        return df, sample
+
+
+class ReduceStage(Stage):
+
+    # dimension reduction with one of the embedding engines, any other method keeps the features
+    name = "reduce"
+
+    def __init__(self, method, n_components, key=None, shared_neighbors=True, n_jobs=None):
+
+        Stage.__init__(self)
+
+        self.method = method
+        self.n_components = n_components
+        self.key = key
+        self.shared_neighbors = shared_neighbors
+        self.n_jobs = n_jobs
+
+        self.model = None
+        self.components = None
+
+    @property
+    def active(self):
+
+        return self.method in embedding.ENGINES
+
+    def run(self, df, keep_model=False):
+
+        if not self.active:
+            return df
+
+        # the shared nearest-neighbor graph cannot embed new rows, so it is not used
+        # when the fitted reduction is needed for projecting them
+        self.model, df = embedding.fit_embedding(df, self.method, self.n_components, self.n_jobs, key=self.key,
+                                                 shared_neighbors=self.shared_neighbors and not keep_model)
+
+        # the engine falls back to 3 components when the requested number is not supported
+        self.components = df.shape[1]
+
+        return df
+
+    def transform(self, df):
+
+        if not self.active:
+            return df
+
+        return embedding.transform_embedding(self.model, df)
+
+
+class ClusterStage(Stage):
+
+    # fit one of the clustering algorithms; init is either the initial centroids or a
+    # function returning them for the given features, e.g. the centroids of a previous run;
+    # HDBSCAN builds its tree on the shared nearest-neighbor graph, as T-SNE its affinities
+    name = "cluster"
+
+    def __init__(self, algorithm, num_clusters=None, cluster_size=None, min_samples=None, batch_size=None,
+                 threshold=None, coreset_size=None, compress=False, key=None, init=None, shared_neighbors=True):
+
+        Stage.__init__(self)
+
+        self.algorithm = algorithm
+        self.num_clusters = num_clusters
+        self.cluster_size = cluster_size
+        self.min_samples = min_samples
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.coreset_size = coreset_size
+        self.compress = compress
+        self.key = key
+        self.init = init
+        self.shared_neighbors = shared_neighbors
+
+        self.algo = None
+        self.features = None
+
+    def run(self, df, prediction_data=False):
+
+        self.features = list(df.columns)
+
+        # collapse the identical rows and weight the unique rows by their multiplicities
+        compress = self.compress and self.algorithm == "kmeans"
+
+        if compress:
+
+            x, inverse, weights = compression.compress_rows(df.values)
+
+        else:
+
+            x, inverse, weights = df, None, None
+
+        init = self.init(self.features) if callable(self.init) else self.init
+
+        self.algo, labels = clustering.fit_clusters(x, self.algorithm, self.num_clusters, self.cluster_size,
+                                                    self.batch_size, self.threshold, prediction_data=prediction_data,
+                                                    key=None if self.key is None else tuple(self.key) + (compress,),
+                                                    min_samples=self.min_samples, init=init,
+                                                    coreset_size=self.coreset_size, sample_weight=weights,
+                                                    shared_neighbors=self.shared_neighbors)
+
+        # broadcast the labels of the unique rows back to the original rows
+        if inverse is not None:
+            labels = labels[inverse]
+
+        return labels
+
+    @property
+    def centroids(self):
+
+        return getattr(self.algo, "cluster_centers_", None)
+
+
+class ProjectStage(Stage):
+
+    # assign the rows left out of the sample to the fitted clusters
+    name = "project"
+
+    def run(self, df, reduce, cluster):
+
+        x = reduce.transform(df)
+
+        return clustering.assign_labels(cluster.algo, x)
+
+
+class Pipeline:
+
+    # the whole analysis without the user interface; the stages can also be run one by one;
+    # with keep_model the fitted reduction and clusters can label new rows afterwards
+    def __init__(self, load=None, clean=None, preprocess=None, sample=None, reduce=None, cluster=None, project=None,
+                 progress=None, keep_model=False):
+
+        self.load = load if load is not None else LoadStage()
+        self.clean = clean if clean is not None else CleanStage()
+        self.preprocess = preprocess if preprocess is not None else PreprocessStage()
+        self.sample = sample if sample is not None else SampleStage()
+        self.reduce = reduce if reduce is not None else ReduceStage("none", None)
+        self.cluster = cluster
+        self.project = project
+        self.progress = progress
+        self.keep_model = keep_model
+
+        # notices of the last run for the user, e.g. when the rows could not be processed as requested
+        self.messages = []
+
+    def report(self, progress, message):
+
+        if self.progress is not None:
+            self.progress(progress, message)
+
+    def reset(self):
+
+        for stage in self.stages():
+            stage.reset()
+
+        self.messages = []
+
+    def stages(self):
+
+        return [stage for stage in [self.load, self.clean, self.preprocess, self.sample, self.reduce, self.cluster,
+                                    self.project] if stage is not None]
+
+    def timings(self):
+
+        # seconds spent in every stage and peak memory after it during the last run
+        return [(stage.name, stage.seconds, stage.memory) for stage in self.stages() if stage.seconds is not None]
+
+    def run(self, source, filename):
+
+        self.reset()
+
+        df = self.load(source, filename)
+        df = self.clean(df)
+        df = self.preprocess(df)
+
+        return self.analyze(df)
+
+    def analyze(self, df):
+
+        # cluster the processed data, which includes the index column
+        df_copy = df
+        self.messages = []
+
+        df, sample = self.sample(df)
+
+        # drop the indices
+        indices = df["index"].values
+        df = df.drop("index", axis=1)
+
+        # project the unsampled rows only if the sample does not cover the whole dataset
+        project = self.project is not None and sample is not None and len(sample) < df_copy.shape[0]
+
+        # run the dimension reduction algorithm
+        self.report(0.1, "reducing dimensions")
+
+        df = self.reduce(df, keep_model=project or self.keep_model)
+
+        if project and self.reduce.active and self.reduce.model is None:
+
+            self.messages.append("The selected dimension reduction cannot project new rows. Unsampled rows dropped.")
+            self.report(0.1, self.messages[-1])
+
+            project = False
+
+        # run the clustering algorithm
+        self.report(0.5, "clustering")
+
+        fitted_labels = self.cluster(df, prediction_data=project or self.keep_model)
+
+        if project:
+
+            self.report(0.8, "assigning the unsampled rows")
+
+            # project the unsampled rows with the fitted reduction and assign them to the fitted clusters
+            rest = np.setdiff1d(np.arange(df_copy.shape[0]), sample)
+
+            labels = np.empty(df_copy.shape[0], dtype=int)
+            labels[sample] = fitted_labels
+            labels[rest], strengths = self.project(df_copy.iloc[rest, :].drop("index", axis=1), self.reduce,
+                                                   self.cluster)
+
+            # add the cluster labels to all the rows
+            result = pd.DataFrame({"index": df_copy["index"].values, "cluster labels": 1 + labels})
+
+            # add the membership strengths of the HDBSCAN clusters
+            if self.cluster.algorithm == "hdbscan":
+
+                membership = np.empty(df_copy.shape[0])
+                membership[sample] = self.cluster.algo.probabilities_
+                membership[rest] = strengths
+
+                result["membership strength"] = membership
+
+        else:
+
+            # add the cluster labels to the fitted rows
+            result = pd.DataFrame({"index": indices, "cluster labels": 1 + fitted_labels})
+
+        return pd.merge(left=result, right=df_copy, on="index", how="left")
+
+    @property
+    def scorable(self):
+
+        # new rows can be labeled if every fitted stage can be applied to them
+        return (self.preprocess.features is not None and self.cluster is not None and self.cluster.algo is not None
+                and (not self.reduce.active or self.reduce.model is not None))
+
+    def score(self, df, offset=0):
+
+        # label new raw rows with the fitted stages, the rows with missing values are dropped
+        df = self.clean(df, offset)
+
+        x = self.preprocess.timed(self.preprocess.transform, df).drop("index", axis=1, errors="ignore")
+
+        labels, strengths = self.project(x, self.reduce, self.cluster)
+
+        result = pd.DataFrame({"index": df["index"].values, "cluster labels": 1 + labels})
+
+        if self.cluster.algorithm == "hdbscan":
+            result["membership strength"] = strengths
+
+        return result
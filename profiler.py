@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import html
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+import flask
+
+####################################################
+# directory of the profiles and of the armed targets,
+# shared by the server workers and the job processes
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs",
+                                                         "profiles"))
+####################################################
+
+####################################################
+# seconds between two samples of the call stack
+INTERVAL = 0.005
+####################################################
+
+# token required by the admin pages; without it they are disabled, since behind a reverse proxy
+# every request comes from the local address
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# most calls profiled by arming a target once
+MAX_COUNT = 100
+
+# share of the samples below which a branch of the call tree is not displayed
+MIN_SHARE = 0.005
+
+ARMED_PATH = os.path.join(PROFILE_DIR, "armed.json")
+LOCK = threading.Lock()
+
+
+@contextmanager
+def armed_targets():
+
+    # the targets are kept in a file, so that arming them in one worker applies to all of them;
+    # the file lock serializes the processes and the thread lock the threads of a worker
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    with LOCK, open(os.path.join(PROFILE_DIR, "armed.lock"), "a") as lock:
+
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+
+            try:
+                with open(ARMED_PATH) as f:
+                    targets = json.load(f)
+            except (OSError, ValueError):
+                targets = []
+
+            yield targets
+
+            targets[:] = [x for x in targets if x["remaining"] > 0]
+
+            if len(targets) > 0:
+
+                with open(ARMED_PATH + ".tmp", "w") as f:
+                    json.dump(targets, f)
+
+                os.replace(ARMED_PATH + ".tmp", ARMED_PATH)
+
+            elif os.path.exists(ARMED_PATH):
+
+                os.remove(ARMED_PATH)
+
+        finally:
+
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def arm(target, session_id=None, count=1):
+
+    # profile the next invocations of a callback, given by its output id, or of a job, given by its name
+    with armed_targets() as targets:
+        targets.append({"target": target, "session": session_id or None, "remaining": int(count)})
+
+
+def take(target, session_id=None):
+
+    # nothing is armed most of the time, which only costs a file system lookup
+    if not os.path.exists(ARMED_PATH):
+        return False
+
+    with armed_targets() as targets:
+
+        for x in targets:
+
+            if x["target"] == target and x["session"] in (None, session_id) and x["remaining"] > 0:
+
+                x["remaining"] -= 1
+
+                return True
+
+    return False
+
+
+def frame_name(frame):
+
+    code = frame.f_code
+
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler:
+
+    # statistical profiler: a thread reads the call stack of the profiled thread at a fixed
+    # interval, the number of samples of a stack is proportional to the time spent in it
+    def __init__(self, thread_id=None, interval=INTERVAL):
+
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+
+        self.stacks = Counter()
+        self.running = False
+        self.thread = None
+
+    def sample(self):
+
+        while self.running:
+
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+
+            if len(stack) > 0:
+                self.stacks[tuple(reversed(stack))] += 1
+
+            time.sleep(self.interval)
+
+    def start(self):
+
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        self.running = False
+        self.thread.join()
+
+        return self.stacks
+
+
+def save(target, session_id, stacks, seconds):
+
+    profile_id = time.strftime("%Y%m%d_%H%M%S") + "_" + uuid.uuid4().hex[:8]
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    # collapsed stacks, the input format of flamegraph.pl and speedscope
+    with open(os.path.join(PROFILE_DIR, profile_id + ".folded"), "w") as f:
+
+        for stack, count in stacks.most_common():
+            f.write(";".join(stack) + " " + str(count) + "\n")
+
+    metadata = {"id": profile_id, "target": target, "session": session_id, "pid": os.getpid(), "seconds": seconds,
+                "samples": sum(stacks.values()), "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    with open(os.path.join(PROFILE_DIR, profile_id + ".json"), "w") as f:
+        json.dump(metadata, f)
+
+    return profile_id
+
+
+def profile_call(target, session_id, fn, *args, **kwargs):
+
+    sampler = Sampler()
+    sampler.start()
+
+    start = time.perf_counter()
+
+    try:
+
+        return fn(*args, **kwargs)
+
+    finally:
+
+        seconds = time.perf_counter() - start
+
+        save(target, session_id, sampler.stop(), seconds)
+
+
+def call(target, session_id, fn, *args, **kwargs):
+
+    # run a callback, profiling it if it is armed for the session
+    if take(target, session_id):
+        return profile_call(target, session_id, fn, *args, **kwargs)
+
+    return fn(*args, **kwargs)
+
+
+class Profiled:
+
+    # a job function profiled in the job process; a class rather than a closure, so that it can
+    # be sent to processes which are not forked
+    def __init__(self, fn, target, session_id):
+
+        self.fn = fn
+        self.target = target
+        self.session_id = session_id
+
+    def __call__(self, *args, **kwargs):
+
+        return profile_call(self.target, self.session_id, self.fn, *args, **kwargs)
+
+
+def list_profiles():
+
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+
+    results = []
+
+    for file_name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+
+        if file_name.endswith(".json") and file_name != "armed.json":
+
+            try:
+                with open(os.path.join(PROFILE_DIR, file_name)) as f:
+                    results.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    return results
+
+
+def read_stacks(profile_id):
+
+    stacks = Counter()
+
+    with open(os.path.join(PROFILE_DIR, profile_id + ".folded")) as f:
+
+        for line in f:
+
+            stack, count = line.rstrip("\n").rsplit(" ", 1)
+            stacks[tuple(stack.split(";"))] += int(count)
+
+    return stacks
+
+
+def call_tree(stacks, min_share=MIN_SHARE):
+
+    # total samples of every path of the call tree, printed depth first with the share of the time
+    total = sum(stacks.values())
+    tree = {}
+
+    for stack, count in stacks.items():
+
+        node = tree
+
+        for name in stack:
+
+            child = node.setdefault(name, [0, {}])
+            child[0] += count
+            node = child[1]
+
+    lines = []
+
+    def walk(node, depth):
+
+        for name, (count, children) in sorted(node.items(), key=lambda x: -x[1][0]):
+
+            if count < min_share * total:
+                continue
+
+            lines.append("{:6.1f}%  {}{}".format(100.0 * count / total, "  " * depth, name))
+            walk(children, depth + 1)
+
+    walk(tree, 0)
+
+    return "\n".join(lines)
+
+
+def check_admin():
+
+    token = flask.request.values.get("token") or flask.request.headers.get("X-Admin-Token")
+
+    if not ADMIN_TOKEN:
+        flask.abort(404)
+
+    if token is None or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        flask.abort(403)
+
+
+def parse_count(value):
+
+    # number of calls to profile, from the form
+    try:
+        count = int(value or 1)
+    except ValueError:
+        flask.abort(400)
+
+    return min(max(count, 1), MAX_COUNT)
+
+
+def token_query():
+
+    token = flask.request.values.get("token")
+
+    return "?" + urllib.parse.urlencode({"token": token}) if token else ""
+
+
+def admin_page(targets=None):
+
+    check_admin()
+
+    query = token_query()
+    token = flask.request.values.get("token") or ""
+
+    rows = "".join("<tr><td><a href='/admin/profiles/{0}{1}'>{0}</a></td><td>{2}</td><td>{3}</td><td>{4:.2f}</td>"
+                   "<td>{5}</td><td><a href='/admin/profiles/{0}.folded{1}'>folded</a></td></tr>".format(
+                       html.escape(x["id"]), query, html.escape(str(x["target"])), html.escape(str(x["session"])),
+                       x["seconds"], x["samples"]) for x in list_profiles())
+
+    options = "".join("<option value='{}'>".format(html.escape(x)) for x in (targets() if targets else []))
+
+    with armed_targets() as armed:
+        pending = "".join("<li>{} (session {}): {} left</li>".format(html.escape(x["target"]),
+                          html.escape(str(x["session"])), x["remaining"]) for x in armed)
+
+    return ("<html><head><title>Profiles</title></head><body style='font-family: Open Sans, sans-serif'>"
+            "<h3>Profile a callback or a job</h3>"
+            "<form method='post' action='/admin/profiles/arm'>"
+            "<input type='hidden' name='token' value='{}'>"
+            "<input name='target' list='targets' size='60' placeholder='callback output id or job name'> "
+            "<datalist id='targets'>{}</datalist>"
+            "<input name='session' size='36' placeholder='session id (any if empty)'> "
+            "<input name='count' type='number' value='1' min='1' max='{}'> "
+            "<button type='submit'>arm</button></form>"
+            "<ul>{}</ul>"
+            "<h3>Profiles</h3><table cellpadding='4'><tr><th>profile</th><th>target</th><th>session</th>"
+            "<th>seconds</th><th>samples</th><th></th></tr>{}</table></body></html>").format(
+                html.escape(token), options, MAX_COUNT, pending, rows)
+
+
+def register(server, targets=None):
+
+    # targets returns the names offered in the admin page, e.g. the ids of the callbacks
+    def index():
+
+        return admin_page(targets)
+
+    def arm_target():
+
+        check_admin()
+
+        if flask.request.form.get("target"):
+            arm(flask.request.form["target"], flask.request.form.get("session"),
+                parse_count(flask.request.form.get("count")))
+
+        return flask.redirect("/admin/profiles" + token_query())
+
+    def view(profile_id):
+
+        check_admin()
+
+        try:
+
+            if profile_id.endswith(".folded"):
+                return flask.send_from_directory(os.path.abspath(PROFILE_DIR), profile_id, mimetype="text/plain")
+
+            stacks = read_stacks(os.path.basename(profile_id))
+
+        except OSError:
+
+            flask.abort(404)
+
+        return ("<html><body><p><a href='/admin/profiles{}'>profiles</a></p><pre>{}</pre></body></html>").format(
+            token_query(), html.escape(call_tree(stacks)))
+
+    server.add_url_rule("/admin/profiles", "profiles", index)
+    server.add_url_rule("/admin/profiles/arm", "arm_profile", arm_target, methods=["POST"])
+    server.add_url_rule("/admin/profiles/<path:profile_id>", "profile", view)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# heavy modules used by the algorithms and the plots, by name: (module, attribute); they are
+# imported on first use, so that a server worker only pays for the algorithms its sessions run
+REGISTRY = OrderedDict([
+    ("pca", ("sklearn.decomposition", "PCA")),
+    ("kmeans", ("sklearn.cluster", "KMeans")),
+    ("minibatch", ("sklearn.cluster", "MiniBatchKMeans")),
+    ("birch", ("sklearn.cluster", "Birch")),
+    ("silhouette", ("sklearn.metrics", "silhouette_score")),
+    ("sample-without-replacement", ("sklearn.utils.random", "sample_without_replacement")),
+    ("nearest-neighbors", ("sklearn.neighbors", "NearestNeighbors")),
+    ("connected-components", ("scipy.sparse.csgraph", "connected_components")),
+    ("minimum-spanning-tree", ("scipy.sparse.csgraph", "minimum_spanning_tree")),
+    ("sklearn-tsne", ("sklearn.manifold", "TSNE")),
+    ("tsne", ("openTSNE", "TSNE")),
+    ("tsne-affinity", ("openTSNE", "affinity")),
+    ("umap", ("umap", None)),
+    ("pynndescent", ("pynndescent", None)),
+    ("hdbscan", ("hdbscan", None)),
+    ("hdbscan-tree", ("hdbscan._hdbscan_tree", None)),
+    ("hdbscan-linkage", ("hdbscan._hdbscan_linkage", None)),
+    ("plotly", ("plotly.graph_objects", None)),
+])
+
+# seconds spent importing every module, including the dependencies it was the first to import,
+# and whether it was preloaded or imported on first use
+IMPORTS = OrderedDict()
+LOCK = threading.Lock()
+
+# locks of the first imports, by module name
+IMPORT_LOCKS = {}
+
+
+def initialized(module_name):
+
+    # sys.modules holds a module before its import finishes, the spec marks it until then
+    module = sys.modules.get(module_name)
+
+    if module is None or getattr(getattr(module, "__spec__", None), "_initializing", False):
+        return None
+
+    return module
+
+
+def import_module(module_name, when="first use"):
+
+    # the modules are imported once, so the lookups of the requests do not take a lock
+    module = initialized(module_name)
+
+    if module is not None:
+        return module
+
+    # a single thread imports a module, the others wait for it instead of timing a partial import;
+    # a slow import, e.g. of UMAP, does not hold up the lookups of the other modules
+    with IMPORT_LOCKS.setdefault(module_name, threading.Lock()):
+
+        loaded = initialized(module_name) is not None
+
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+
+        if not loaded:
+
+            with LOCK:
+                IMPORTS.setdefault(module_name, (time.perf_counter() - start, when))
+
+    return module
+
+
+def get(name, when="first use"):
+
+    module_name, attribute = REGISTRY[name]
+    module = import_module(module_name, when)
+
+    if attribute is None:
+        return module
+
+    return getattr(module, attribute)
+
+
+class LazyModule:
+
+    # stands for a module at the top of a file and imports it on the first attribute access
+    def __init__(self, module_name):
+
+        self.__dict__["module_name"] = module_name
+
+    def __getattr__(self, name):
+
+        return getattr(import_module(self.module_name), name)
+
+
+def preload(names=None):
+
+    # import the modules ahead of time, e.g. in the master process before forking the workers,
+    # which then share the imported modules instead of each importing them again
+    for name in (REGISTRY if names is None else names):
+
+        try:
+
+            get(name, "preload")
+
+        except ImportError:
+
+            # the optional engines, e.g. openTSNE or UMAP, may not be installed
+            continue
+
+
+def report():
+
+    with LOCK:
+
+        rows = [{"module": module_name, "seconds": seconds, "when": when}
+                for module_name, (seconds, when) in IMPORTS.items()]
+
+    return sorted(rows, key=lambda x: -x["seconds"])
+
+
+def format_report():
+
+    lines = ["import costs (pid {}):".format(os.getpid())]
+
+    for row in report():
+        lines.append("  {:8.3f}s  {:<10}  {}".format(row["seconds"], row["when"], row["module"]))
+
+    lines.append("  {:8.3f}s  total".format(sum(row["seconds"] for row in report())))
+
+    return "\n".join(lines)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+####################################################
+# number of rows parsed at once while streaming the
+# uploaded file through the sampler
+CHUNK_SIZE = 50000
+####################################################
+
+
+def keep_smallest(frame, keys, positions, n_rows):
+
+    # keep the rows with the smallest random keys, which is a uniform sample
+    if len(keys) > n_rows:
+
+        keep = np.argpartition(keys, n_rows - 1)[:n_rows]
+
+        frame, keys, positions = frame.iloc[keep, :], keys[keep], positions[keep]
+
+    return frame, keys, positions
+
+
+def reservoir_sample(chunks, n_rows, seed=0):
+
+    rng = np.random.RandomState(seed)
+
+    frame, keys, positions = None, np.empty(0), np.empty(0, dtype=int)
+    offset = 0
+
+    # a random key per row and the n smallest keys seen so far form the reservoir,
+    # so only the reservoir and the current chunk are ever held in memory
+    for chunk in chunks:
+
+        chunk_keys = rng.random_sample(chunk.shape[0])
+        chunk_positions = offset + np.arange(chunk.shape[0])
+        offset += chunk.shape[0]
+
+        if frame is None:
+            frame = chunk
+        else:
+            frame = pd.concat([frame, chunk], ignore_index=True, sort=False)
+
+        keys = np.concatenate([keys, chunk_keys])
+        positions = np.concatenate([positions, chunk_positions])
+
+        frame, keys, positions = keep_smallest(frame, keys, positions, n_rows)
+
+    if frame is None:
+        return pd.DataFrame()
+
+    # restore the order of the rows in the file
+    return frame.iloc[np.argsort(positions), :].reset_index(drop=True)
+
+
+def allocate(counts, n_rows):
+
+    # allocate the sample proportionally to the size of the strata, keeping at least one row of each
+    allocation = np.maximum(1, np.round(n_rows * counts / counts.sum())).astype(int)
+    allocation = np.minimum(allocation, counts.astype(int))
+
+    # the rounding and the single rows of the small strata can exceed the requested size, the excess
+    # is taken from the largest strata, one row each
+    excess = allocation.sum() - n_rows
+
+    while excess > 0 and (allocation > 1).any():
+
+        largest = allocation[allocation > 1].sort_values(ascending=False, kind="mergesort").index[:excess]
+
+        allocation[largest] -= 1
+        excess -= len(largest)
+
+    # with more strata than rows, the smallest strata are left out
+    if excess > 0:
+
+        smallest = counts[allocation > 0].sort_values(kind="mergesort").index[:excess]
+        allocation[smallest] = 0
+
+    return allocation
+
+
+def stratified_sample(open_chunks, column, n_rows, seed=0):
+
+    # first pass: count the rows of every stratum
+    counts = None
+
+    for chunk in open_chunks():
+
+        chunk_counts = chunk[column].astype(str).value_counts()
+        counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+
+    if counts is None:
+        return pd.DataFrame()
+
+    allocation = allocate(counts, n_rows)
+
+    # second pass: one reservoir per stratum, again based on random keys
+    rng = np.random.RandomState(seed)
+
+    frame, keys, positions = None, np.empty(0), np.empty(0, dtype=int)
+    offset = 0
+
+    for chunk in open_chunks():
+
+        chunk_keys = rng.random_sample(chunk.shape[0])
+        chunk_positions = offset + np.arange(chunk.shape[0])
+        offset += chunk.shape[0]
+
+        if frame is None:
+            frame = chunk
+        else:
+            frame = pd.concat([frame, chunk], ignore_index=True, sort=False)
+
+        keys = np.concatenate([keys, chunk_keys])
+        positions = np.concatenate([positions, chunk_positions])
+
+        # keep the rows whose key ranks within the allocation of their stratum
+        strata = frame[column].astype(str)
+        rank = pd.Series(keys).groupby(strata.values).rank(method="first").values
+        keep = rank <= allocation.reindex(strata.values).values
+
+        frame, keys, positions = frame.iloc[keep, :].reset_index(drop=True), keys[keep], positions[keep]
+
+    return frame.iloc[np.argsort(positions), :].reset_index(drop=True)
+
+
+def sample_chunks(open_chunks, mode, n_rows, column=None, seed=0):
+
+    if seed is None:
+        seed = 0
+
+    if mode == "reservoir":
+
+        return reservoir_sample(open_chunks(), n_rows, seed)
+
+    elif mode == "stratified" and column is not None:
+
+        return stratified_sample(open_chunks, column, n_rows, seed)
+
+    return pd.concat(list(open_chunks()), ignore_index=True, sort=False)
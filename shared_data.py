@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+####################################################
+# directory of the published matrices; /dev/shm keeps
+# them in memory, where every process of the machine
+# (server workers, jobs) maps the same pages
+SHARED_DIR = os.environ.get("SHARED_DIR", os.path.join("/dev/shm" if os.path.isdir("/dev/shm")
+                                                       else tempfile.gettempdir(), "cluster_analysis"))
+####################################################
+
+####################################################
+# total size of the published matrices, above which
+# the least recently used ones are removed
+SHARED_BYTES = int(os.environ.get("SHARED_BYTES", 2 * 1024 ** 3))
+####################################################
+
+####################################################
+# seconds after which a pin is considered left behind,
+# e.g. by a job cancelled before it attached the data
+PIN_SECONDS = 3600
+####################################################
+
+# thread locks of the shared state files, by name
+LOCKS = {}
+
+
+def paths(key):
+
+    return os.path.join(SHARED_DIR, key + ".npy"), os.path.join(SHARED_DIR, key + ".json")
+
+
+def text_path(key):
+
+    return os.path.join(SHARED_DIR, key + ".txt")
+
+
+def lookup(key):
+
+    matrix_path, descriptor_path = paths(key)
+
+    try:
+
+        with open(descriptor_path) as f:
+            descriptor = json.load(f)
+
+        # keep the recently used matrices when cleaning up
+        os.utime(matrix_path)
+
+    except (OSError, ValueError):
+
+        return None
+
+    return descriptor
+
+
+def is_alive(pid):
+
+    # whether a process, e.g. the server worker holding a grant or running a job, still exists
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+
+    return True
+
+
+def state_path(name):
+
+    return os.path.join(SHARED_DIR, "state", name + ".json")
+
+
+def read_state(name):
+
+    # the state file is replaced atomically, so it is read without the lock
+    try:
+
+        with open(state_path(name)) as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+
+        return {}
+
+
+@contextmanager
+def locked_state(name):
+
+    # state shared by the server workers, e.g. the admission counters of the governor, is kept in a
+    # file; the file lock serializes the processes and the thread lock the threads of a process, the
+    # state is written back unless the update raised
+    path = state_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with LOCKS.setdefault(name, threading.Lock()), open(path + ".lock", "a") as lock:
+
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+
+            state = read_state(name)
+
+            yield state
+
+            write_atomic(path, lambda f: f.write(json.dumps(state).encode("utf-8")))
+
+        finally:
+
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_atomic(path, write):
+
+    # write to a temporary file and rename it, so that other processes never attach to a partial file
+    temporary_path = path + "." + str(os.getpid()) + ".tmp"
+
+    with open(temporary_path, "wb") as f:
+        write(f)
+
+    os.replace(temporary_path, path)
+
+
+def publish(df, key):
+
+    descriptor = lookup(key)
+
+    if descriptor is not None:
+        return descriptor
+
+    try:
+
+        x = np.ascontiguousarray(df.values, dtype=np.float64)
+
+    except (TypeError, ValueError):
+
+        # only numeric data can be shared as a matrix
+        return None
+
+    os.makedirs(SHARED_DIR, exist_ok=True)
+
+    matrix_path, descriptor_path = paths(key)
+
+    # the descriptor is small, so it can be passed around instead of the data
+    columns = [c.item() if hasattr(c, "item") else c for c in df.columns]
+
+    descriptor = {"key": key, "path": matrix_path, "shape": list(x.shape), "dtype": x.dtype.str, "columns": columns,
+                  "integer_columns": [c for c, dtype in zip(columns, df.dtypes) if pd.api.types.is_integer_dtype(dtype)]}
+
+    # the descriptor is written last, since it marks the matrix as complete
+    write_atomic(matrix_path, lambda f: np.save(f, x))
+    write_atomic(descriptor_path, lambda f: f.write(json.dumps(descriptor).encode("utf-8")))
+
+    cleanup(keep=key)
+
+    return descriptor
+
+
+def publish_text(text, key):
+
+    # data which cannot be shared as a matrix, e.g. the raw data, is stored as it is, so that other
+    # processes read it from the file instead of receiving it
+    path = text_path(key)
+
+    try:
+
+        # keep the recently used entries when cleaning up
+        os.utime(path)
+
+    except OSError:
+
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        write_atomic(path, lambda f: f.write(text.encode("utf-8")))
+
+        cleanup(keep=key)
+
+    return {"key": key, "path": path}
+
+
+def read_text(descriptor):
+
+    with open(descriptor["path"], encoding="utf-8") as f:
+        text = f.read()
+
+    unpin(descriptor)
+
+    return text
+
+
+def pin(descriptor):
+
+    # keep the files of a descriptor until another process has attached them, e.g. a queued job;
+    # returns None if they were removed in the meantime
+    pin_path = os.path.join(SHARED_DIR, descriptor["key"] + "." + uuid.uuid4().hex + ".pin")
+
+    with open(pin_path, "w"):
+        pass
+
+    if not os.path.exists(descriptor["path"]):
+
+        os.remove(pin_path)
+
+        return None
+
+    return dict(descriptor, pin=pin_path)
+
+
+def unpin(descriptor):
+
+    if "pin" in descriptor:
+
+        try:
+            os.remove(descriptor["pin"])
+        except OSError:
+            pass
+
+
+def attach(descriptor):
+
+    # read-only zero-copy view, backed by the pages shared with the other processes
+    x = np.load(descriptor["path"], mmap_mode="r")
+
+    # the mapped pages outlive the file, so it no longer needs to be kept
+    unpin(descriptor)
+
+    return x
+
+
+def attach_frame(descriptor):
+
+    # a new frame object for every caller, all of them on the same shared matrix
+    df = pd.DataFrame(attach(descriptor), columns=descriptor["columns"], copy=False)
+
+    for column in descriptor["integer_columns"]:
+        df[column] = df[column].astype(np.int64)
+
+    return df
+
+
+def cleanup(keep=None, max_bytes=None):
+
+    if max_bytes is None:
+        max_bytes = SHARED_BYTES
+
+    # the pinned entries are kept, the pins left behind are removed
+    pinned = set()
+
+    for pin_path in glob.glob(os.path.join(SHARED_DIR, "*.pin")):
+
+        try:
+
+            if os.path.getmtime(pin_path) < time.time() - PIN_SECONDS:
+                os.remove(pin_path)
+            else:
+                pinned.add(os.path.basename(pin_path).split(".")[0])
+
+        except OSError:
+
+            pass
+
+    entries = []
+
+    for entry_path in glob.glob(os.path.join(SHARED_DIR, "*.npy")) + glob.glob(os.path.join(SHARED_DIR, "*.txt")):
+
+        try:
+            entries.append((os.path.getmtime(entry_path), os.path.getsize(entry_path), entry_path))
+        except OSError:
+            pass
+
+    total = sum(size for mtime, size, entry_path in entries)
+
+    # remove the least recently used entries; processes which have already mapped them keep their pages
+    for mtime, size, entry_path in sorted(entries):
+
+        if total <= max_bytes:
+            break
+
+        key, extension = os.path.splitext(os.path.basename(entry_path))
+
+        if key == keep or key in pinned:
+            continue
+
+        for path in (paths(key)[::-1] if extension == ".npy" else [entry_path]):
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        total -= size
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from concurrent.futures import Future
+
+# computations in progress, keyed by the operation, the digest of the input and the parameters
+IN_FLIGHT = {}
+LOCK = threading.Lock()
+
+
+def call(operation, digest, params, fn, *args, **kwargs):
+
+    key = (operation, digest, params)
+
+    with LOCK:
+
+        future = IN_FLIGHT.get(key)
+        leader = future is None
+
+        if leader:
+
+            future = Future()
+            IN_FLIGHT[key] = future
+
+    # concurrent callers wait for the first one and share its result, which they must not modify
+    if not leader:
+        return future.result()
+
+    try:
+
+        result = fn(*args, **kwargs)
+        future.set_result(result)
+
+    except BaseException as e:
+
+        future.set_exception(e)
+
+        raise
+
+    finally:
+
+        # later callers start a new computation, or find the result in the caches
+        with LOCK:
+            del IN_FLIGHT[key]
+
+    return result
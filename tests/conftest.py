@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+# the modules sit at the root of the repository, next to application.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def shared_dir(tmp_path, monkeypatch):
+
+    # the files shared by the server workers, e.g. the published data and the job status, go to a
+    # directory of the test
+    import shared_data
+
+    monkeypatch.setattr(shared_data, "SHARED_DIR", str(tmp_path))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pq = pytest.importorskip("pyarrow.parquet")
+
+import batch
+
+
+def test_write_stage_with_drifting_dtypes(tmp_path):
+
+    # the second chunk has a float in a column of integers and the first chunk has no value in the text column
+    chunks = [pd.DataFrame({"index": [0, 1], "age": [25, 40], "workclass": [None, None]}),
+              pd.DataFrame({"index": [2, 3], "age": [31.5, 52.0], "workclass": ["Private", "State-gov"]})]
+
+    dtypes = {}
+
+    for chunk in chunks:
+        batch.update_dtypes(dtypes, chunk)
+
+    assert dtypes["age"] == np.float64
+    assert dtypes["workclass"] == object
+
+    path = str(tmp_path / "labels.parquet")
+    write = batch.WriteStage(path, dtypes)
+
+    for chunk in chunks:
+        write(chunk)
+
+    write.close()
+
+    table = pq.read_table(path)
+
+    assert table.column("age").to_pylist() == [25.0, 40.0, 31.5, 52.0]
+    assert table.column("workclass").to_pylist() == [None, None, "Private", "State-gov"]
+    assert not os.path.exists(path + ".partial")
+
+
+def test_write_stage_removes_incomplete_file(tmp_path):
+
+    path = str(tmp_path / "labels.parquet")
+    write = batch.WriteStage(path)
+
+    write(pd.DataFrame({"index": [0, 1], "cluster labels": [1, 2]}))
+    write.close(complete=False)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".partial")
+
+
+def test_numeric_column_with_missing_markers_in_the_first_chunk(tmp_path):
+
+    # "?" makes pandas read the first chunk of age as text; it is cleaned and the column stays numeric
+    path = str(tmp_path / "data.csv")
+    pd.DataFrame({"age": ["?", "30", "41", "52", "63", "24"],
+                  "workclass": ["Private", "Private", "State-gov", "Private", "State-gov", "Private"]}).to_csv(
+        path, index=False)
+
+    dtypes = {}
+
+    for chunk in pd.read_csv(path, chunksize=2):
+        batch.update_dtypes(dtypes, batch.coerce_numbers(chunk.replace("?", np.nan)))
+
+    assert dtypes["age"] == np.float64
+    assert dtypes["workclass"] == object
+
+    output = str(tmp_path / "labels.parquet")
+    messages = []
+
+    stages = batch.run_batch(path, output, cluster_algorithm="kmeans", num_clusters=2, chunk_size=2,
+                             progress=messages.append)
+
+    preprocess = stages[2]
+    encodings = {spec["feature"]: spec["encoding"] for spec in preprocess.features}
+
+    assert encodings == {"age": "numeric", "workclass": "dummies"}
+    assert pq.read_table(output).column("age").to_pylist() == [30.0, 41.0, 52.0, 63.0, 24.0]
+    assert messages[0] == "learning the encodings"
+
+
+def test_numeric_looking_column_with_text_in_a_later_chunk(tmp_path):
+
+    # the codes look like numbers in the first chunk only, the encodings are learned again as text
+    path = str(tmp_path / "data.csv")
+    pd.DataFrame({"code": ["1", "2", "3", "A", "B", "1"], "age": [30, 41, 52, 63, 24, 35]}).to_csv(path, index=False)
+
+    stages = batch.run_batch(path, str(tmp_path / "labels.parquet"), cluster_algorithm="kmeans", num_clusters=2,
+                             chunk_size=3)
+
+    spec = [spec for spec in stages[2].features if spec["feature"] == "code"][0]
+
+    assert spec["encoding"] == "dummies"
+    assert spec["categories"] == ["1", "2", "3", "A", "B"]
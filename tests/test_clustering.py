@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import cache
+import clustering
+
+
+def blobs(n_rows=600):
+
+    rng = np.random.RandomState(0)
+    centers = np.array([[0.0, 0.0], [6.0, 0.0], [3.0, 6.0]])
+
+    return centers[np.arange(n_rows) % 3] + rng.normal(size=(n_rows, 2))
+
+
+def test_warm_starts_are_cached_apart_from_the_cold_fits(monkeypatch):
+
+    monkeypatch.setattr(clustering, "MODELS", cache.LRUCache(8))
+
+    x = blobs()
+    init = np.array([[10.0, 10.0], [-10.0, -10.0], [10.0, -10.0]])
+
+    cold, _ = clustering.fit_clusters(x, "kmeans", 3, None, key="data")
+    warm, _ = clustering.fit_clusters(x, "kmeans", 3, None, key="data", init=init)
+
+    assert warm is not cold
+    assert warm.n_init == 1
+
+    # each is served from the cache to the same request
+    assert clustering.fit_clusters(x, "kmeans", 3, None, key="data")[0] is cold
+    assert clustering.fit_clusters(x, "kmeans", 3, None, key="data", init=init.copy())[0] is warm
+
+
+def test_hdbscan_chunks_are_labeled_as_a_whole():
+
+    hdbscan = pytest.importorskip("hdbscan")
+
+    x = blobs()
+    algo, _ = clustering.fit_clusters(x, "hdbscan", None, 20, prediction_data=True)
+
+    new_rows = blobs(90) + 0.1
+    labels, strengths = clustering.assign_labels(algo, new_rows, chunk_size=25, n_jobs=2)
+    expected, expected_strengths = hdbscan.approximate_predict(algo, new_rows)
+
+    assert np.array_equal(labels, expected)
+    assert np.allclose(strengths, expected_strengths)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+import compression
+
+
+def test_unique_rows_rebuild_the_matrix():
+
+    rng = np.random.RandomState(0)
+    x = rng.randint(0, 3, size=(500, 3)).astype(float)
+
+    unique, inverse, counts = compression.compress_rows(x)
+
+    assert unique.shape[0] == len(np.unique(x, axis=0))
+    assert np.array_equal(unique[inverse], x)
+    assert counts.sum() == x.shape[0]
+
+    # the same matrix is compressed once
+    assert compression.compress_rows(x.copy())[0] is unique
+
+
+def test_weighted_statistics_match_the_expanded_rows():
+
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(rng.randint(0, 5, size=(200, 2)).astype(float), columns=["a", "b"])
+
+    unique, inverse, counts = compression.compress_rows(df.values)
+    stats = compression.weighted_describe(unique, counts, df.columns)
+
+    pd.testing.assert_frame_equal(stats, df.describe().transpose(), check_names=False)
+
+
+def test_empty_matrix():
+
+    unique, inverse, counts = compression.compress_rows(np.empty((0, 2)))
+
+    assert unique.shape == (0, 2)
+    assert inverse.shape == (0,)
+    assert counts.shape == (0,)
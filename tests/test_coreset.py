@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import coreset
+
+
+def blobs(n_rows, rng):
+
+    centers = np.array([[0.0, 0.0], [10.0, 0.0], [0.0, 10.0]])
+
+    return centers[rng.randint(0, 3, n_rows)] + rng.normal(size=(n_rows, 2))
+
+
+def test_coreset_weights_estimate_the_size_and_the_mean():
+
+    rng = np.random.RandomState(0)
+    x = blobs(20000, rng)
+
+    points, weights = coreset.build_coreset(np.array_split(x, 10), size=1000)
+
+    assert points.shape == (1000, 2)
+    assert abs(weights.sum() / x.shape[0] - 1) < 0.1
+    assert np.allclose(np.average(points, axis=0, weights=weights), x.mean(axis=0), atol=0.5)
+
+
+def test_small_data_is_kept_as_it_is():
+
+    x = blobs(50, np.random.RandomState(0))
+
+    points, weights = coreset.build_coreset([x[:20], x[20:]], size=100)
+
+    assert np.array_equal(points, x)
+    assert np.array_equal(weights, np.ones(50))
+
+
+def test_no_chunks():
+
+    points, weights = coreset.build_coreset([], size=100)
+
+    assert points.shape[0] == 0
+    assert weights.shape[0] == 0
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+import export
+
+
+def frame(n_rows):
+
+    return pd.DataFrame({"index": np.arange(n_rows), "cluster labels": np.arange(n_rows) % 3 + 1,
+                         "workclass": ["Private", "State-gov"] * (n_rows // 2) + ["Private"] * (n_rows % 2)})
+
+
+def test_stored_results_are_loaded_by_id():
+
+    df = frame(10)
+    result_id = export.store_result(df)
+
+    pd.testing.assert_frame_equal(export.load_result(result_id), df)
+
+
+def test_unknown_and_invalid_ids_are_not_loaded():
+
+    assert export.load_result(os.urandom(16).hex()) is None
+    assert export.load_result("../results/" + "0" * 21) is None
+
+
+def test_the_oldest_results_are_forgotten(monkeypatch):
+
+    monkeypatch.setattr(export, "MAX_RESULTS", 2)
+
+    result_ids = []
+
+    for j in range(3):
+
+        result_ids.append(export.store_result(frame(2)))
+
+        # the results are ordered by their modification times
+        path = export.result_path(result_ids[-1])
+        os.utime(path, (j, j))
+
+    assert export.load_result(result_ids[0]) is None
+    assert export.load_result(result_ids[1]) is not None
+    assert export.load_result(result_ids[2]) is not None
+
+
+def test_streamed_csv_matches_the_whole_file():
+
+    df = frame(11)
+
+    data = b"".join(export.iter_csv(df, chunk_rows=4))
+
+    assert data == df.to_csv(index=False).encode("utf-8")
+    assert gzip.decompress(b"".join(export.iter_gzip(export.iter_csv(df, chunk_rows=4)))) == data
+
+    # an empty table still has its header
+    assert b"".join(export.iter_csv(df.iloc[:0], chunk_rows=4)) == df.iloc[:0].to_csv(index=False).encode("utf-8")
+
+
+def test_streamed_parquet_has_a_row_group_per_chunk():
+
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    df = frame(11)
+
+    data = b"".join(export.iter_parquet(df, chunk_rows=4))
+    f = pq.ParquetFile(io.BytesIO(data))
+
+    assert f.num_row_groups == 3
+    pd.testing.assert_frame_equal(f.read().to_pandas(), df)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import generations
+
+
+def test_a_new_request_supersedes_the_previous_one():
+
+    first = generations.begin("session", "plot")
+
+    assert generations.is_current("session", "plot", first)
+
+    second = generations.begin("session", "plot")
+
+    assert second > first
+    assert not generations.is_current("session", "plot", first)
+    assert generations.is_current("session", "plot", second)
+
+    # the other outputs and sessions are not affected
+    assert generations.is_current("other", "plot", first)
+
+
+def test_the_oldest_pairs_are_forgotten(monkeypatch):
+
+    monkeypatch.setattr(generations, "MAX_ENTRIES", 2)
+
+    first = generations.begin("a", "plot")
+    generations.begin("a", "plot")
+    generations.begin("b", "plot")
+    generations.begin("c", "plot")
+
+    # nothing newer is known for a forgotten pair
+    assert generations.is_current("a", "plot", first)
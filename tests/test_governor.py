@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import governor
+import jobs
+import pipeline
+
+
+def blas_threads():
+
+    from threadpoolctl import threadpool_info
+
+    return [x["num_threads"] for x in threadpool_info()]
+
+
+def test_limits_are_restored_when_the_last_request_leaves():
+
+    pytest.importorskip("threadpoolctl")
+
+    original = blas_threads()
+    limits = governor.SharedLimits()
+
+    # the requests leave in another order than they entered
+    limits.enter(2)
+    limits.enter(3)
+    limits.leave(2)
+
+    assert blas_threads() == [3] * len(original)
+
+    limits.leave(3)
+
+    assert blas_threads() == original
+
+
+def test_admission_within_the_quotas():
+
+    gov = governor.Governor(total_threads=4, total_memory=1000, session_threads=2, session_memory=600)
+    grant = gov.grant({"threads": 8, "memory": 400})
+
+    assert grant["threads"] == 2
+    assert gov.try_acquire("a", grant)
+
+    # the session quota is used up, another session still fits the server
+    assert not gov.try_acquire("a", grant)
+    assert gov.try_acquire("b", grant)
+
+    # the server is full
+    assert not gov.try_acquire("c", grant)
+
+    gov.release("a", grant)
+
+    assert gov.try_acquire("c", grant)
+    assert gov.utilization()["memory"]["used"] == 800
+
+
+def test_estimates_beyond_the_session_quota_are_rejected():
+
+    gov = governor.Governor(total_threads=4, total_memory=1000, session_threads=2, session_memory=600)
+
+    assert gov.check({"rows": 10, "columns": 2, "threads": 1, "memory": 700}) is not None
+    assert gov.check({"rows": 10, "columns": 2, "threads": 1, "memory": 500}) is None
+
+
+def test_jobs_exceeding_the_memory_quota_are_stopped(monkeypatch):
+
+    if pipeline.current_memory() is None:
+        pytest.skip("the resident memory is not reported on this platform")
+
+    messages = []
+    monkeypatch.setattr(jobs, "abort", messages.append)
+
+    stopped = threading.Event()
+    watchdog = threading.Thread(target=governor.watch_memory, args=(50 * 1024 ** 2, stopped, 0.01))
+    watchdog.start()
+
+    x = np.ones((200 * 1024 ** 2) // 8)
+    watchdog.join(5)
+    stopped.set()
+
+    assert x.sum() > 0
+    assert len(messages) == 1 and "available to a session" in messages[0]
+
+
+def test_governed_requests_release_their_grant(monkeypatch):
+
+    gov = governor.Governor(total_threads=4, total_memory=1000, session_threads=2, session_memory=600)
+    monkeypatch.setattr(governor, "GOVERNOR", gov)
+
+    with governor.governed("a", {"rows": 10, "columns": 2, "threads": 2, "memory": 500}) as grant:
+
+        assert grant["threads"] == 2
+        assert gov.utilization()["memory"]["used"] == 500
+
+    assert gov.utilization()["memory"]["used"] == 0
+
+    with pytest.raises(RuntimeError):
+
+        with governor.governed("a", {"rows": 10, "columns": 2, "threads": 1, "memory": 700}):
+            pass
+
+    # a request which does not get its resources in time gives up
+    assert gov.try_acquire("b", gov.grant({"threads": 1, "memory": 600}))
+
+    with pytest.raises(RuntimeError):
+
+        with governor.governed("a", {"rows": 10, "columns": 2, "threads": 1, "memory": 500}, timeout=0.2):
+            pass
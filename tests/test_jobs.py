@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def runner():
+
+    runner = jobs.JobRunner(max_jobs=1, interval=0.05)
+
+    yield runner
+
+    runner.cancel_all()
+
+
+def wait_for(condition, timeout=30):
+
+    deadline = time.time() + timeout
+
+    while not condition():
+
+        assert time.time() < deadline
+
+        time.sleep(0.05)
+
+
+def test_finished_jobs_are_seen_by_the_other_workers(runner):
+
+    job_id = runner.submit("max", max, 1, 2)
+
+    wait_for(lambda: runner.get(job_id).done)
+
+    # another server worker reads the job from its files
+    job = jobs.load(job_id)
+
+    assert job.status == "done"
+    assert job.result == 2
+    assert jobs.describe(job).startswith("max: done")
+
+
+def test_jobs_are_cancelled_from_the_other_workers(runner):
+
+    job_id = runner.submit("sleep", time.sleep, 30)
+
+    wait_for(lambda: jobs.load(job_id) is not None and jobs.load(job_id).status == "running")
+
+    jobs.RUNNER.cancel(job_id)
+
+    wait_for(lambda: runner.get(job_id).status == "cancelled")
+
+    assert jobs.load(job_id).status == "cancelled"
+
+
+def test_jobs_of_exited_workers_are_failed():
+
+    # the id of a process which exited
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+
+    job = jobs.Job("sleep", None, None, None)
+    job.status, job.started = "running", time.time()
+    job.save()
+
+    path = jobs.job_path(job.id, ".json")
+
+    with open(path) as f:
+        state = json.load(f)
+
+    with open(path, "w") as f:
+        json.dump(dict(state, owner=process.pid), f)
+
+    assert jobs.load(job.id).status == "failed"
+
+
+def test_unknown_ids_are_not_looked_up():
+
+    assert jobs.load("../" + "0" * 29) is None
+    assert jobs.load(os.urandom(16).hex()) is None
+
+
+def test_failed_jobs_report_the_error(runner):
+
+    job_id = runner.submit("parse", int, "not a number")
+
+    wait_for(lambda: runner.get(job_id).done)
+
+    job = jobs.load(job_id)
+
+    assert job.status == "failed"
+    assert "ValueError" in job.error
+    assert jobs.describe(job).startswith("parse: failed")
+
+
+def test_rejected_jobs_are_displayed_with_the_reason(runner):
+
+    job_id = runner.reject("sweep", "The data is too large.")
+
+    assert jobs.describe(runner.get(job_id)) == "sweep: rejected. The data is too large."
+    assert jobs.load(job_id).status == "rejected"
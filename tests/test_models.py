@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("joblib")
+
+import cache
+import models
+import pipeline
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "adult.csv")
+
+
+@pytest.fixture(autouse=True)
+def model_dir(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(models, "MODEL_DIR", str(tmp_path / "models"))
+    monkeypatch.setattr(models, "LOADED", cache.LRUCache(8))
+    monkeypatch.setattr(models, "THROUGHPUT", {})
+
+
+def fitted(dimension_reduction="pca"):
+
+    analysis = pipeline.Pipeline(reduce=pipeline.ReduceStage(dimension_reduction, 3),
+                                 cluster=pipeline.ClusterStage("kmeans", num_clusters=3),
+                                 project=pipeline.ProjectStage(), keep_model=True)
+
+    with open(DATA, "rb") as f:
+        result = analysis.run(f.read(), "adult.csv")
+
+    return analysis, result
+
+
+def test_saved_pipeline_labels_the_rows_as_fitted():
+
+    analysis, result = fitted()
+    model_id = models.save(analysis, "adult")
+
+    # a new server worker reads the pipeline from the disk
+    models.LOADED = cache.LRUCache(8)
+
+    labels, metrics = models.score(model_id, pd.read_csv(DATA))
+
+    merged = pd.merge(result[["index", "cluster labels"]], labels, on="index", suffixes=("", " scored"))
+
+    assert merged.shape[0] == result.shape[0]
+    assert (merged["cluster labels"] == merged["cluster labels scored"]).all()
+    assert metrics["labeled rows"] == result.shape[0]
+
+    metadata = models.metadata(model_id)
+
+    assert metadata["name"] == "adult"
+    assert metadata["clusters"] == 3
+    assert metadata["scored rows"] == metrics["rows"]
+    assert [x["id"] for x in models.list_models()] == [model_id]
+
+
+def test_rows_without_the_fitted_columns_are_rejected():
+
+    analysis, _ = fitted()
+    model_id = models.save(analysis)
+
+    with pytest.raises(ValueError):
+        models.score(model_id, pd.read_csv(DATA).drop("age", axis=1))
+
+
+def test_unknown_and_invalid_ids_are_not_loaded():
+
+    with pytest.raises(KeyError):
+        models.load(os.urandom(16).hex())
+
+    with pytest.raises(KeyError):
+        models.load("../" + "0" * 29)
+
+    with pytest.raises(KeyError):
+        models.metadata("not an id")
+
+
+def test_pipelines_which_cannot_label_new_rows_are_not_saved(monkeypatch):
+
+    analysis, _ = fitted()
+
+    # e.g. T-SNE, which has no model for new rows
+    monkeypatch.setattr(analysis.reduce, "model", None)
+
+    with pytest.raises(ValueError):
+        models.save(analysis)
+
+    assert models.list_models() == []
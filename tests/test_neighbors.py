@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("sklearn")
+
+import neighbors
+
+
+def duplicated_rows():
+
+    # two blobs of rows repeated three times, as with one-hot encoded categories
+    rng = np.random.RandomState(0)
+    x = np.vstack([rng.normal(0, 1, (40, 2)), rng.normal(8, 1, (40, 2))])
+
+    return np.vstack([x, x, x])
+
+
+def test_exact_neighbors_drop_the_row_itself():
+
+    x = duplicated_rows()
+    indices, distances = neighbors.exact_neighbors(x, 5, 1)
+
+    assert indices.shape == (x.shape[0], 5)
+    assert not (indices == np.arange(x.shape[0])[:, None]).any()
+
+    # the two duplicates of every row are its nearest neighbors
+    assert (distances[:, :2] == 0).all()
+
+
+def test_drop_self_without_the_row():
+
+    indices = np.array([[1, 2, 3], [0, 1, 2]])
+    distances = np.array([[0.0, 1.0, 2.0], [0.0, 0.0, 1.0]])
+
+    indices, distances = neighbors.drop_self(indices, distances)
+
+    assert indices.tolist() == [[1, 2], [0, 2]]
+    assert distances.tolist() == [[0.0, 1.0], [0.0, 1.0]]
+
+
+def test_sparse_graph_keeps_zero_distances():
+
+    x = duplicated_rows()
+    graph = neighbors.build_graph(x, 5).to_csr()
+
+    assert graph.nnz >= x.shape[0] * 5
+    assert graph[0, 80] == 0 and 80 in graph[0].indices
+
+
+def blobs():
+
+    # three blobs of distinct rows, close enough for the neighbor graph to be connected
+    rng = np.random.RandomState(0)
+
+    return np.vstack([rng.normal(center, 1, (150, 2)) for center in [(0, 0), (4, 0), (2, 4)]])
+
+
+def assert_exact_tree(session, x, min_cluster_size, min_samples):
+
+    hdbscan = pytest.importorskip("hdbscan")
+    metrics = pytest.importorskip("sklearn.metrics")
+
+    exact = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, min_samples=min_samples, algorithm="generic").fit(x)
+
+    # the tree was built from the graph and has the merge distances of the exact tree; the rows at
+    # equal distances can be merged in another order, which may change the label of a border row
+    assert session.shared_neighbors
+    assert np.allclose(np.sort(session.single_linkage_tree[:, 2]), np.sort(exact._single_linkage_tree[:, 2]))
+
+    labels = session.extract(min_cluster_size)[1]
+
+    assert len(set(labels)) == len(set(exact.labels_))
+    assert metrics.adjusted_rand_score(labels, exact.labels_) > 0.98
+
+
+def test_hdbscan_tree_from_the_graph():
+
+    import hdbscan_session
+
+    x = blobs()
+
+    assert_exact_tree(hdbscan_session.HDBSCANSession(x, 5, shared_neighbors=True), x, 15, 5)
+
+
+def test_hdbscan_tree_from_the_graph_with_duplicates():
+
+    import hdbscan_session
+
+    # the zero distances between the duplicates are kept as edges of the graph
+    x = np.vstack([blobs()] * 3)
+
+    assert_exact_tree(hdbscan_session.HDBSCANSession(x, 5, shared_neighbors=True), x, 30, 5)
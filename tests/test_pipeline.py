@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+import pipeline
+
+
+def raw_frame():
+
+    return pd.DataFrame({"age": [25, "?", 40, 31, 52, 47], "workclass": ["Private", "State-gov", " ", "Private",
+                                                                            "Self-emp", "State-gov"],
+                         "hours": [40.0, 20.0, 45.0, 38.0, 60.0, 40.0]})
+
+
+def test_clean_stage_drops_the_missing_values_and_numbers_the_rows():
+
+    df = pipeline.CleanStage()(raw_frame(), offset=100)
+
+    assert list(df["index"]) == [100, 103, 104, 105]
+    assert list(df.columns) == ["index", "age", "workclass", "hours"]
+
+    # the second UI keeps the incomplete rows and selects the dummy variables
+    df = pipeline.CleanStage(dropna=False, dummies=True, drop_first=True)(raw_frame())
+
+    assert df.shape[0] == 6
+    assert [x for x in df.columns if x.startswith("workclass")] == ["workclass_Self-emp", "workclass_State-gov"]
+
+
+def test_preprocessing_fitted_in_chunks_matches_a_single_fit():
+
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({"index": np.arange(300), "x": rng.normal(size=300), "y": rng.exponential(size=300),
+                       "c": rng.choice(["a", "b", "c"], 300)})
+
+    selection = pd.DataFrame({"feature": ["index", "x", "y", "c"], "type": ["numerical", "numerical", "categorical",
+                                                                            "categorical"],
+                              "weight": [1, 2, 1, 1], "transformation": ["none", "z-score", "minmax", "none"]})
+
+    whole = pipeline.PreprocessStage(selection)(df)
+
+    chunked = pipeline.PreprocessStage(selection).fit(lambda: [df.iloc[:100], df.iloc[100:250], df.iloc[250:]])
+
+    pd.testing.assert_frame_equal(chunked.transform(df), whole)
+    assert list(whole.columns) == ["index", "x", "y_cat1", "y_cat2", "y_cat3", "c_a", "c_b", "c_c"]
+
+
+def test_pipeline_projects_the_unsampled_rows():
+
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({"index": np.arange(400), "x": np.r_[rng.normal(size=200), 10 + rng.normal(size=200)],
+                       "y": rng.normal(size=400)})
+
+    analysis = pipeline.Pipeline(sample=pipeline.SampleStage(25), reduce=pipeline.ReduceStage("pca", 2),
+                                 cluster=pipeline.ClusterStage("kmeans", num_clusters=2),
+                                 project=pipeline.ProjectStage())
+
+    result = analysis.analyze(pipeline.PreprocessStage()(df))
+
+    assert result.shape[0] == 400
+    assert set(result["cluster labels"]) == {1, 2}
+
+    # the rows of each blob are in one cluster
+    labels = result.sort_values("index")["cluster labels"].values
+
+    assert len(set(labels[:200])) == 1 and len(set(labels[200:])) == 1
+    assert [stage for stage, seconds, memory in analysis.timings()] == ["sample", "reduce", "cluster", "project"]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import flask
+import pytest
+
+import profiler
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiler, "ARMED_PATH", str(tmp_path / "armed.json"))
+
+    server = flask.Flask(__name__)
+    profiler.register(server)
+
+    return server.test_client()
+
+
+def test_the_admin_pages_are_disabled_without_a_token(client, monkeypatch):
+
+    monkeypatch.setattr(profiler, "ADMIN_TOKEN", None)
+
+    # a reverse proxy forwards every request from the local address
+    assert client.get("/admin/profiles", environ_base={"REMOTE_ADDR": "127.0.0.1"}).status_code == 404
+    assert client.post("/admin/profiles/arm", data={"target": "plot.figure"}).status_code == 404
+
+
+def test_the_admin_pages_require_the_token(client, monkeypatch):
+
+    monkeypatch.setattr(profiler, "ADMIN_TOKEN", "secret")
+
+    assert client.get("/admin/profiles").status_code == 403
+    assert client.get("/admin/profiles?token=wrong").status_code == 403
+    assert client.get("/admin/profiles?token=secret").status_code == 200
+    assert client.get("/admin/profiles", headers={"X-Admin-Token": "secret"}).status_code == 200
+
+
+def test_the_count_is_validated_and_clamped(client, monkeypatch):
+
+    monkeypatch.setattr(profiler, "ADMIN_TOKEN", "secret")
+
+    response = client.post("/admin/profiles/arm", data={"token": "secret", "target": "plot.figure", "count": "many"})
+
+    assert response.status_code == 400
+
+    response = client.post("/admin/profiles/arm", data={"token": "secret", "target": "plot.figure", "count": "1e9"})
+
+    assert response.status_code == 400
+
+    response = client.post("/admin/profiles/arm", data={"token": "secret", "target": "plot.figure",
+                                                        "count": "1000000"})
+
+    assert response.status_code == 302
+
+    with profiler.armed_targets() as armed:
+        assert [x["remaining"] for x in armed] == [profiler.MAX_COUNT]
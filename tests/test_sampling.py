@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+import sampling
+
+
+def chunks_of(df, chunk_rows):
+
+    return lambda: (df.iloc[j:j + chunk_rows] for j in range(0, df.shape[0], chunk_rows))
+
+
+def test_more_strata_than_rows():
+
+    df = pd.DataFrame({"stratum": np.repeat(np.arange(20), 5), "value": np.arange(100)})
+
+    sample = sampling.stratified_sample(chunks_of(df, 30), "stratum", 10, seed=1)
+
+    assert sample.shape[0] == 10
+    assert sample["stratum"].value_counts().max() == 1
+
+
+def test_small_strata_do_not_exceed_the_sample_size():
+
+    # nine strata of a single row and a large one, each small stratum keeps its row
+    df = pd.DataFrame({"stratum": ["small_" + str(j) for j in range(9)] + ["large"] * 91, "value": np.arange(100)})
+
+    sample = sampling.stratified_sample(chunks_of(df, 30), "stratum", 10)
+
+    assert sample.shape[0] == 10
+    assert (sample["stratum"] == "large").sum() == 1
+
+
+def test_allocation_is_proportional():
+
+    counts = pd.Series({"a": 600, "b": 300, "c": 100})
+
+    assert sampling.allocate(counts, 10).to_dict() == {"a": 6, "b": 3, "c": 1}
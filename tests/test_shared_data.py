@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+import shared_data
+
+
+def frame(n_rows):
+
+    return pd.DataFrame({"index": np.arange(n_rows), "x": np.linspace(0, 1, n_rows)})
+
+
+def test_attached_frame_matches_the_published_one():
+
+    df = frame(100)
+    descriptor = shared_data.publish(df, "a")
+
+    attached = shared_data.attach_frame(descriptor)
+
+    assert list(attached.columns) == ["index", "x"]
+    assert attached["index"].dtype == np.int64
+    assert np.allclose(attached["x"], df["x"])
+
+
+def test_pinned_entries_are_kept_until_attached():
+
+    descriptor = shared_data.pin(shared_data.publish(frame(100), "a"))
+
+    # publishing another dataset over the size limit keeps the pinned one
+    shared_data.publish(frame(100), "b")
+    shared_data.cleanup(max_bytes=0)
+
+    assert os.path.exists(descriptor["path"])
+
+    shared_data.attach(descriptor)
+    shared_data.cleanup(max_bytes=0)
+
+    assert not os.path.exists(descriptor["path"])
+    assert shared_data.lookup("a") is None
+
+
+def test_removed_entries_cannot_be_pinned():
+
+    descriptor = shared_data.publish(frame(100), "a")
+    shared_data.cleanup(max_bytes=0)
+
+    assert shared_data.pin(descriptor) is None
+
+    with pytest.raises(FileNotFoundError):
+        shared_data.attach(descriptor)
+
+
+def test_text_round_trip():
+
+    descriptor = shared_data.pin(shared_data.publish_text('{"a": 1}', "raw"))
+
+    assert shared_data.read_text(descriptor) == '{"a": 1}'
+    assert not os.path.exists(descriptor["pin"])
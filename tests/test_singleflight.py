@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+import singleflight
+
+
+def test_concurrent_callers_share_one_computation():
+
+    calls = []
+    results = []
+
+    def compute():
+
+        calls.append(1)
+        time.sleep(0.2)
+
+        return object()
+
+    threads = [threading.Thread(target=lambda: results.append(singleflight.call("op", "digest", None, compute)))
+               for j in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert singleflight.IN_FLIGHT == {}
+
+
+def test_the_calls_after_a_computation_run_it_again():
+
+    calls = []
+
+    singleflight.call("op", "digest", None, calls.append, 1)
+    singleflight.call("op", "digest", None, calls.append, 2)
+
+    # a different digest or parameters are a different computation
+    assert calls == [1, 2]
+
+
+def test_errors_are_raised_to_every_caller():
+
+    started = threading.Event()
+    errors = []
+
+    def fail():
+
+        started.set()
+        time.sleep(0.2)
+
+        raise ValueError("failed")
+
+    def follow():
+
+        started.wait()
+
+        try:
+            singleflight.call("op", "digest", None, fail)
+        except ValueError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=follow)
+    thread.start()
+
+    with pytest.raises(ValueError):
+        singleflight.call("op", "digest", None, fail)
+
+    thread.join()
+
+    assert len(errors) == 1
+    assert singleflight.IN_FLIGHT == {}